@@ -12,30 +12,154 @@ openai_text_call = text_completion
 
 from .prompt import (
     compose_prompt,
+    compile_prompt,
+    PromptTemplate,
     trim_prompt,
+    trim_segments,
     chunk_prompt,
+    chunk_stream,
     count_tokens,
     compose_function,
     get_tokens,
 )
 
+from .functions import (
+    function_schema,
+    FunctionRegistry,
+)
+
+from .segmenter import (
+    Segmenter,
+    segment_text,
+)
+
+from .corpus import (
+    prepare_corpus,
+    open_corpus,
+)
+
+from .embedding import (
+    embed,
+    embed_async,
+    EmbeddingCache,
+)
+
+from .batch import (
+    run_batch,
+    run_batch_async,
+    export_batch_results,
+)
+
+from .concurrency import (
+    AdaptiveLimiter,
+    get_limiter,
+)
+
+from .scheduler import (
+    Scheduler,
+    RequestRejected,
+)
+
+from .results import (
+    CompletionResult,
+    FunctionCallResult,
+    Usage,
+    Prefix,
+)
+
+from .config import (
+    Config,
+    get_config,
+    configure,
+)
+
+from .client import Client
+
+from .cache import SemanticCache
+
+from .cascade import ModelCascade
+
+from .metrics import (
+    LatencyMetrics,
+    get_metrics,
+)
+
+from .backends import (
+    OpenAIBackend,
+    LocalBackend,
+    CassetteBackend,
+    BackendError,
+    register_backend,
+    get_backend,
+)
+
+from .ledger import (
+    UsageLedger,
+    get_ledger,
+)
+
 from .constants import (
     TEXT_MODEL,
+    EMBEDDING_MODEL,
     DEFAULT_CHUNK_LENGTH,
 )
 
 __all__ = [
     "function_completion",
+    "function_completion_async",
     "text_completion",
+    "text_completion_async",
     "chat_completion",
+    "chat_completion_async",
     "openai_function_call",
     "openai_text_call",
     "compose_prompt",
+    "compile_prompt",
+    "PromptTemplate",
     "compose_function",
     "trim_prompt",
+    "trim_segments",
     "chunk_prompt",
+    "chunk_stream",
+    "function_schema",
+    "FunctionRegistry",
+    "Segmenter",
+    "segment_text",
+    "prepare_corpus",
+    "open_corpus",
     "count_tokens",
     "get_tokens",
+    "embed",
+    "embed_async",
+    "EmbeddingCache",
+    "run_batch",
+    "run_batch_async",
+    "export_batch_results",
+    "AdaptiveLimiter",
+    "get_limiter",
+    "Scheduler",
+    "RequestRejected",
+    "CompletionResult",
+    "FunctionCallResult",
+    "Usage",
+    "Prefix",
+    "Config",
+    "get_config",
+    "configure",
+    "Client",
+    "SemanticCache",
+    "ModelCascade",
+    "LatencyMetrics",
+    "get_metrics",
+    "OpenAIBackend",
+    "LocalBackend",
+    "CassetteBackend",
+    "BackendError",
+    "register_backend",
+    "get_backend",
+    "UsageLedger",
+    "get_ledger",
     "TEXT_MODEL",
+    "EMBEDDING_MODEL",
     "DEFAULT_CHUNK_LENGTH",
 ]
@@ -0,0 +1,406 @@
+import os
+import copy
+import json
+import asyncio
+import atexit
+import hashlib
+import functools
+import threading
+import urllib.error
+import urllib.request
+
+import openai
+
+from .constants import EASYCOMPLETION_LOCAL_API_ENDPOINT, EASYCOMPLETION_CASSETTE, EASYCOMPLETION_CASSETTE_MODE
+from .config import get_config
+
+# Added to function call requests, since local models are not trained on the functions API
+LOCAL_FUNCTIONS_PROMPT = (
+    "Respond only with JSON that calls one of these functions, "
+    'as {{"name": <function name>, "arguments": <arguments object>}}:\n{functions}'
+)
+LOCAL_PARALLEL_FUNCTIONS_PROMPT = (
+    "Respond only with a JSON array of calls to these functions, "
+    'each as {{"name": <function name>, "arguments": <arguments object>}}:\n{functions}'
+)
+
+
+class BackendError(Exception):
+    """
+    An error response from a backend. status_code lets the limiter tell overload (429, 503) from bad requests.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OpenAIBackend:
+    """
+    Sends chat requests to the OpenAI API, or to the endpoint set in EASYCOMPLETION_API_ENDPOINT.
+
+    The key and endpoint are passed with each request, never set on the openai
+    module, so requests with different keys can be sent at the same time.
+    """
+
+    name = "openai"
+    requires_api_key = True
+
+    def options(self, api_key, api_base, timeout):
+        config = get_config()
+        options = {
+            "api_key": config.api_key if api_key is None else api_key,
+            "api_base": config.api_base if api_base is None else api_base,
+        }
+        if timeout is not None:
+            # Bounds the whole HTTP request, so a stuck connection can't outlive the caller's deadline
+            options["request_timeout"] = timeout
+        return options
+
+    def create(self, request, api_key=None, api_base=None, timeout=None):
+        return openai.ChatCompletion.create(**request, **self.options(api_key, api_base, timeout))
+
+    async def acreate(self, request, api_key=None, api_base=None, timeout=None):
+        return await openai.ChatCompletion.acreate(**request, **self.options(api_key, api_base, timeout))
+
+
+class LocalBackend:
+    """
+    Sends chat requests to a local OpenAI-compatible server, such as the llama.cpp server.
+
+    Function calls are sent as JSON-constrained generation instead of the
+    functions API: the functions become a JSON schema in response_format,
+    which the server compiles into a grammar, so the model can only produce a
+    valid call. The JSON it returns is converted back into a function call
+    response, so validation and repair work as they do for OpenAI.
+
+    Usage:
+        local = LocalBackend("http://localhost:8080/v1")
+        function_completion(text, functions=[classify_function], backend=local)
+    """
+
+    name = "local"
+    requires_api_key = False
+
+    def __init__(self, base_url=EASYCOMPLETION_LOCAL_API_ENDPOINT, model=None, api_key=None, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        # Local servers usually serve one model; if set, it replaces the model in every request
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def translate(self, request):
+        """
+        Converts an OpenAI chat request into a request for the local server.
+        """
+        payload = {key: value for key, value in request.items() if key not in ("functions", "function_call", "tools", "tool_choice")}
+        if self.model is not None:
+            payload["model"] = self.model
+        functions, function_call, parallel = request_functions(request)
+        if functions is None:
+            return payload
+        if function_call not in (None, "auto"):
+            functions = [function for function in functions if function["name"] == function_call["name"]]
+        schema = {"oneOf": [call_schema(function) for function in functions]}
+        if parallel:
+            schema = {"type": "array", "items": schema, "minItems": 1}
+        prompt = LOCAL_PARALLEL_FUNCTIONS_PROMPT if parallel else LOCAL_FUNCTIONS_PROMPT
+        payload["messages"] = [
+            {"role": "system", "content": prompt.format(functions=json.dumps(functions))}
+        ] + request["messages"]
+        payload["response_format"] = {"type": "json_object", "schema": schema}
+        return payload
+
+    def convert(self, request, response):
+        """
+        Converts the local server's response back into an OpenAI function call response.
+        """
+        functions, _, parallel = request_functions(request)
+        if functions is None or not response.get("choices"):
+            return response
+        choice = response["choices"][0]
+        content = choice["message"].get("content") or ""
+        try:
+            calls = json.loads(content)
+        except ValueError:
+            # Leave the text as is, validation reports it and retries
+            return response
+        if parallel:
+            calls = calls if isinstance(calls, list) else [calls]
+            choice["message"] = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{index}",
+                        "type": "function",
+                        "function": {"name": call.get("name"), "arguments": json.dumps(call.get("arguments", {}))},
+                    }
+                    for index, call in enumerate(calls)
+                    if isinstance(call, dict)
+                ],
+            }
+            choice["finish_reason"] = "tool_calls"
+        elif isinstance(calls, dict):
+            choice["message"] = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {"name": calls.get("name"), "arguments": json.dumps(calls.get("arguments", {}))},
+            }
+            choice["finish_reason"] = "function_call"
+        return response
+
+    def post(self, payload, timeout=None):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        http_request = urllib.request.Request(
+            self.base_url + "/chat/completions",
+            data=json.dumps(payload).encode("utf-8"),
+            headers=headers,
+            method="POST",
+        )
+        try:
+            timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+            with urllib.request.urlopen(http_request, timeout=timeout) as http_response:
+                return json.loads(http_response.read())
+        except urllib.error.HTTPError as e:
+            raise BackendError(f"Local backend returned {e.code}: {e.read().decode('utf-8', 'replace')}", e.code) from e
+
+    def create(self, request, api_key=None, api_base=None, timeout=None):
+        # The server's own base_url and api_key are used, not those for OpenAI
+        return self.convert(request, self.post(self.translate(request), timeout))
+
+    async def acreate(self, request, api_key=None, api_base=None, timeout=None):
+        # urllib blocks, so the request runs in a worker thread. A cancelled call
+        # stops waiting at once; the thread stops at the timeout
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.create, request, timeout=timeout))
+
+
+def request_functions(request):
+    """
+    Returns (functions, function_call, parallel) for a chat request, or (None, None, False) if it has no functions.
+    """
+    if "tools" in request:
+        tool_choice = request.get("tool_choice", "auto")
+        function_call = tool_choice if tool_choice == "auto" else tool_choice["function"]
+        return [tool["function"] for tool in request["tools"]], function_call, True
+    if "functions" in request:
+        return request["functions"], request.get("function_call", "auto"), False
+    return None, None, False
+
+
+def call_schema(function):
+    """
+    Returns the JSON schema of a call to a function: its name and its arguments.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "name": {"const": function["name"]},
+            "arguments": function.get("parameters", {"type": "object"}),
+        },
+        "required": ["name", "arguments"],
+    }
+
+
+def request_hash(request):
+    """
+    Identifies a chat request by its content, independent of key order.
+    """
+    serialized = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class CassetteBackend:
+    """
+    Records chat requests and responses to a file and replays them, so tests run quickly with no network.
+
+    Requests are matched by request_hash. A request that is sent several
+    times, such as a retry, replays its recorded responses in order. Modes:
+    "replay" only replays, and fails requests that were not recorded;
+    "record" sends every request and records the new responses; "auto"
+    replays the responses that were in the file when it was opened, and
+    sends and records everything past them.
+
+    New responses are written to the file by close(), when the cassette is
+    used as a context manager, or when the process exits.
+
+    Usage:
+        with CassetteBackend("tests/cassettes/model.json") as cassette:
+            text_completion("Hello", backend=cassette)
+            cassette.stats()
+
+    Setting EASYCOMPLETION_CASSETTE (and optionally EASYCOMPLETION_CASSETTE_MODE)
+    makes a cassette the default backend.
+    """
+
+    def __init__(self, path, mode="auto", backend=None):
+        if mode not in ("replay", "record", "auto"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        # The backend that recorded requests are sent to, default OpenAI
+        self.backend = get_backend("openai" if backend is None else backend)
+        self.name = self.backend.name
+        # Replaying needs no key, so tests can run without one
+        self.requires_api_key = self.backend.requires_api_key and mode != "replay"
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.interactions = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.interactions = json.load(f)["interactions"]
+        # Responses in the file when it was opened: in auto mode, only these are replayed
+        self.loaded = {key: len(interaction["responses"]) for key, interaction in self.interactions.items()}
+        # Responses replayed so far for each request, and requests re-recorded in this session
+        self.positions = {}
+        self.rerecorded = set()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.dirty = False
+        if mode != "replay":
+            atexit.register(self.close)
+
+    def play(self, key):
+        """
+        Returns the next recorded response for a request hash, or None if there is none.
+        """
+        with self.lock:
+            interaction = self.interactions.get(key, None)
+            position = self.positions.get(key, 0)
+            # In auto mode, a request sent more often than when it was recorded, like a
+            # retry of an invalid response, is sent again rather than given the same response
+            if (
+                self.mode == "record"
+                or interaction is None
+                or (self.mode == "auto" and position >= self.loaded.get(key, 0))
+            ):
+                self.misses += 1
+                return None
+            self.positions[key] = position + 1
+            self.hits += 1
+            # Past the end, the last response is repeated
+            return copy.deepcopy(interaction["responses"][min(position, len(interaction["responses"]) - 1)])
+
+    def record(self, key, request, response):
+        # Provider response objects are dictionaries, which are saved as plain JSON
+        response = json.loads(json.dumps(response))
+        with self.lock:
+            if self.mode == "record" and key not in self.rerecorded:
+                self.interactions.pop(key, None)
+                self.rerecorded.add(key)
+            interaction = self.interactions.setdefault(key, {"request": request, "responses": []})
+            interaction["responses"].append(response)
+            self.recorded += 1
+            self.dirty = True
+
+    def save(self):
+        """
+        Writes the cassette to its file if anything was recorded since it was last saved.
+        """
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                serialized = json.dumps({"version": 1, "interactions": self.interactions}, indent=1, sort_keys=True)
+                self.dirty = False
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Written to a temporary file first, so an interrupted run can't leave a broken cassette
+            temporary = self.path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                f.write(serialized)
+            os.replace(temporary, self.path)
+
+    def close(self):
+        """
+        Saves the cassette. After close(), it is no longer saved, or kept alive, at process exit.
+        """
+        self.save()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def missing(self, key):
+        return BackendError(f"No recorded response for request {key[:16]} in {self.path}", 404)
+
+    def create(self, request, api_key=None, api_base=None, timeout=None):
+        key = request_hash(request)
+        response = self.play(key)
+        if response is not None:
+            return response
+        if self.mode == "replay":
+            raise self.missing(key)
+        response = self.backend.create(request, api_key=api_key, api_base=api_base, timeout=timeout)
+        self.record(key, request, response)
+        return response
+
+    async def acreate(self, request, api_key=None, api_base=None, timeout=None):
+        key = request_hash(request)
+        response = self.play(key)
+        if response is not None:
+            return response
+        if self.mode == "replay":
+            raise self.missing(key)
+        response = await self.backend.acreate(request, api_key=api_key, api_base=api_base, timeout=timeout)
+        self.record(key, request, response)
+        return response
+
+    def stats(self):
+        """
+        Returns "hits" (requests replayed), "misses" (requests not found), "recorded" (responses recorded),
+        "interactions" (requests in the cassette) and "unused" (recorded requests that were not replayed).
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+                "interactions": len(self.interactions),
+                "unused": len([key for key in self.loaded if key not in self.positions and key not in self.rerecorded]),
+            }
+
+
+backends = {"openai": OpenAIBackend()}
+backends_lock = threading.Lock()
+
+
+def register_backend(name, backend):
+    """
+    Registers a backend under a name, so completions can select it with backend=name.
+    """
+    with backends_lock:
+        backends[name] = backend
+    return backend
+
+
+def get_backend(backend=None):
+    """
+    Returns a backend given a backend, a registered name, or None for the default backend.
+
+    The default backend is OpenAI, or a CassetteBackend if EASYCOMPLETION_CASSETTE is set,
+    and can be replaced with register_backend("default", backend).
+    """
+    if backend is None:
+        return backends["default"]
+    if isinstance(backend, str):
+        with backends_lock:
+            if backend not in backends:
+                raise ValueError(f"Unknown backend: {backend}")
+            return backends[backend]
+    return backend
+
+
+backends["default"] = (
+    CassetteBackend(EASYCOMPLETION_CASSETTE, EASYCOMPLETION_CASSETTE_MODE, backends["openai"])
+    if EASYCOMPLETION_CASSETTE
+    else backends["openai"]
+)
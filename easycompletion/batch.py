@@ -0,0 +1,295 @@
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+
+from .constants import DEBUG
+from .logger import log
+from .model import (
+    function_completion_async,
+    text_completion_async,
+    chat_completion_async,
+)
+
+BATCH_COMPLETIONS = {
+    "function": function_completion_async,
+    "text": text_completion_async,
+    "chat": chat_completion_async,
+}
+
+BATCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS lines (line INTEGER PRIMARY KEY, id TEXT, hash TEXT);
+CREATE TABLE IF NOT EXISTS requests (
+    hash TEXT PRIMARY KEY,
+    request TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    result TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS requests_status ON requests (status, attempts);
+"""
+
+
+def hash_request(request):
+    """
+    Return a stable hash for a request dictionary, ignoring its "id".
+
+    Requests that differ only in id or key order hash the same, so they are sent once.
+    """
+    request = {key: value for key, value in request.items() if key != "id"}
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def open_batch_store(store_path):
+    """
+    Open (or create) the SQLite store that holds a batch job's progress and results.
+    """
+    connection = sqlite3.connect(store_path)
+    # WAL keeps results durable across crashes without a full sync per commit
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(BATCH_SCHEMA)
+    return connection
+
+
+def ingest_batch(connection, input_path, debug=DEBUG):
+    """
+    Read new lines from a JSONL request file into the store.
+
+    The byte offset of the last ingested line is checkpointed, so resuming a
+    job only reads lines appended since the previous run.
+
+    Returns:
+        The number of lines ingested.
+    """
+    row = connection.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+    offset = int(row[0]) if row else 0
+    row = connection.execute("SELECT MAX(line) FROM lines").fetchone()
+    line_number = row[0] + 1 if row[0] is not None else 0
+
+    ingested = 0
+    with open(input_path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break  # the last line is still being written
+            offset += len(raw)
+            if not raw.strip():
+                continue
+            request, error = parse_batch_line(raw)
+            if error is None:
+                request_hash = hash_request(request)
+            else:
+                log(f"Line {line_number} of {input_path} is invalid: {error}", type="warning", log=debug)
+                request = request if isinstance(request, dict) else {}
+                request_hash = hashlib.sha256(raw.strip()).hexdigest()
+            connection.execute(
+                "INSERT INTO lines (line, id, hash) VALUES (?, ?, ?)",
+                (line_number, json.dumps(request.get("id")), request_hash),
+            )
+            # Invalid lines are stored with their error and never sent
+            connection.execute(
+                "INSERT OR IGNORE INTO requests (hash, request, status, result, updated) VALUES (?, ?, ?, ?, ?)",
+                (
+                    request_hash,
+                    raw.decode("utf-8", "replace"),
+                    "pending" if error is None else "invalid",
+                    None if error is None else json.dumps({"error": error}),
+                    None if error is None else time.time(),
+                ),
+            )
+            line_number += 1
+            ingested += 1
+            if ingested % 10000 == 0:
+                save_offset(connection, offset)
+    save_offset(connection, offset)
+    log(f"Ingested {ingested} requests from {input_path}", log=debug)
+    return ingested
+
+
+def parse_batch_line(raw):
+    """
+    Parses one line of a batch file.
+
+    Returns:
+        A tuple of (request, error). error is set if the line is not a JSON object or has an unknown "type".
+    """
+    try:
+        request = json.loads(raw)
+    except ValueError as e:
+        return None, f"Invalid JSON: {e}"
+    if not isinstance(request, dict):
+        return request, "Each line must be a JSON object"
+    if request.get("type", "function") not in BATCH_COMPLETIONS:
+        return request, f"Unknown type: {request['type']}. Should be one of {', '.join(BATCH_COMPLETIONS)}"
+    return request, None
+
+
+def save_offset(connection, offset):
+    connection.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('offset', ?)", (str(offset),)
+    )
+    connection.commit()
+
+
+async def run_batch_async(
+    input_path,
+    store_path=None,
+    output_path=None,
+    concurrency=8,
+    max_attempts=3,
+    commit_interval=100,
+    debug=DEBUG,
+    **defaults,
+):
+    """
+    Run every request in a JSONL file, persisting progress so the job can resume.
+
+    Each line is a JSON object of keyword arguments for function_completion. A
+    line may also set "type" to "text" or "chat" to call text_completion or
+    chat_completion instead, and an "id" that is copied to the output. Requests
+    are deduplicated by hash, requests already completed in the store are
+    skipped, and failed requests are retried on later runs up to max_attempts.
+    Lines that are not JSON objects, or have an unknown "type", fail without being sent.
+
+    Args:
+        input_path (str): Path to the JSONL file of requests.
+        store_path (str | None): Path to the SQLite store. Defaults to input_path + ".db".
+        output_path (str | None): If set, results are exported to this JSONL file when the run ends.
+        concurrency (int): Maximum number of requests in flight at once.
+        max_attempts (int): Maximum number of runs in which a failing request is attempted.
+        commit_interval (int): Number of results written between commits.
+        **defaults: Keyword arguments applied to every request, e.g. functions or model.
+
+    Returns:
+        dict: "total" (distinct requests), "done", "failed", "completed" (requests finished in this run) and "error".
+
+    Example:
+        >>> run_batch("requests.jsonl", output_path="results.jsonl", functions=[summarize_function])
+    """
+    store_path = store_path or input_path + ".db"
+    connection = open_batch_store(store_path)
+    ingest_batch(connection, input_path, debug=debug)
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    pending_writes = []
+    completed = 0
+
+    def flush():
+        connection.executemany(
+            "UPDATE requests SET status = ?, attempts = attempts + 1, result = ?, updated = ? WHERE hash = ?",
+            pending_writes,
+        )
+        connection.commit()
+        pending_writes.clear()
+
+    async def worker():
+        nonlocal completed
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            request_hash, raw = item
+            try:
+                request = {**defaults, **json.loads(raw)}
+                request.pop("id", None)
+                completion = BATCH_COMPLETIONS[request.pop("type", "function")]
+                result = await completion(**request)
+            except Exception as e:
+                result = {"error": str(e)}
+            status = "failed" if result.get("error") else "done"
+            if hasattr(result, "to_dict"):
+                result = result.to_dict()
+            pending_writes.append((status, json.dumps(result), time.time(), request_hash))
+            completed += 1
+            if len(pending_writes) >= commit_interval:
+                flush()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        # Page through unfinished requests rather than loading them all at once
+        last_hash = ""
+        while True:
+            rows = connection.execute(
+                "SELECT hash, request FROM requests WHERE status IN ('pending', 'failed') AND attempts < ? AND hash > ? ORDER BY hash LIMIT 1000",
+                (max_attempts, last_hash),
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                await queue.put(row)
+            last_hash = rows[-1][0]
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        flush()
+
+    counts = dict(
+        connection.execute("SELECT status, COUNT(*) FROM requests GROUP BY status").fetchall()
+    )
+    connection.close()
+
+    if output_path is not None:
+        export_batch_results(store_path, output_path)
+
+    summary = {
+        "total": sum(counts.values()),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0) + counts.get("invalid", 0),
+        "completed": completed,
+        "error": None,
+    }
+    log(f"Batch finished:\n{summary}", type="success", log=debug)
+    return summary
+
+
+def run_batch(input_path, store_path=None, output_path=None, concurrency=8, max_attempts=3, commit_interval=100, debug=DEBUG, **defaults):
+    """
+    Run every request in a JSONL file, persisting progress so the job can resume.
+
+    Blocking wrapper around run_batch_async, see it for arguments.
+    """
+    return asyncio.run(
+        run_batch_async(
+            input_path,
+            store_path=store_path,
+            output_path=output_path,
+            concurrency=concurrency,
+            max_attempts=max_attempts,
+            commit_interval=commit_interval,
+            debug=debug,
+            **defaults,
+        )
+    )
+
+
+def export_batch_results(store_path, output_path):
+    """
+    Write one JSON line per input line, in input order, with its id and result.
+
+    Requests that have not completed are written with a null result.
+    """
+    connection = open_batch_store(store_path)
+    with open(output_path, "w") as f:
+        for line, request_id, result in connection.execute(
+            "SELECT lines.line, lines.id, requests.result FROM lines JOIN requests ON lines.hash = requests.hash ORDER BY lines.line"
+        ):
+            f.write(
+                json.dumps(
+                    {
+                        "line": line,
+                        "id": json.loads(request_id),
+                        "result": json.loads(result) if result else None,
+                    }
+                )
+                + "\n"
+            )
+    connection.close()
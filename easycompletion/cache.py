@@ -0,0 +1,218 @@
+import re
+import copy
+import json
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .constants import EMBEDDING_MODEL
+from .embedding import embed, embed_async, NUMPY_REQUIRED_ERROR
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Punctuation at the ends of a prompt rarely changes what is being asked
+EDGE_PUNCTUATION = " \t\n.!?;:,"
+
+
+def normalize_prompt(text):
+    """
+    Normalizes a prompt for cache lookups: Unicode compatibility form, case, whitespace and trailing punctuation.
+
+    Example:
+        >>> normalize_prompt("  What is  the capital of France?? ")
+        'what is the capital of france'
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return WHITESPACE_PATTERN.sub(" ", text).strip(EDGE_PUNCTUATION)
+
+
+def hash_cache_context(context):
+    """
+    Returns a stable hash for everything besides the prompt that determines a response (model, functions, ...).
+    """
+    return hashlib.sha256(
+        json.dumps(context, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def copy_result(result):
+    # Callers may modify the result they get, including its arguments and usage, which must not change the cached one
+    return type(result)(**{field: copy.deepcopy(getattr(result, field)) for field in result.fields()})
+
+
+class SemanticCache:
+    """
+    Serves stored responses for prompts that are the same, or nearly the same, as earlier ones.
+
+    Prompts are normalized first, so differences in whitespace, case and
+    trailing punctuation still hit the cache. If similarity_threshold is set,
+    prompts that miss are also embedded and compared by cosine similarity with
+    the cached prompts that share the same model, functions and settings; the
+    closest one at or above the threshold is served.
+
+    Only successful responses are stored. The least recently used entries are
+    evicted once max_entries is reached.
+
+    Usage:
+        cache = SemanticCache(similarity_threshold=0.95)
+        text_completion("What is the capital of France?", cache=cache)
+        text_completion("what is the capital of france", cache=cache)  # served from the cache
+        cache.stats()
+    """
+
+    def __init__(self, similarity_threshold=None, max_entries=10000, embedding_model=EMBEDDING_MODEL, embed_function=None):
+        if similarity_threshold is not None and np is None:
+            raise ImportError(NUMPY_REQUIRED_ERROR)
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.embedding_model = embedding_model
+        # Optional callable taking a list of texts and returning their vectors, instead of the embeddings API
+        self.embed_function = embed_function
+        self.lock = threading.Lock()
+        # key -> (context hash, normalized prompt vector or None, result)
+        self.entries = OrderedDict()
+        # context hash -> [keys, matrix of their unit vectors or None until rebuilt]
+        self.indexes = {}
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def make_key(self, prompt, context):
+        """
+        Returns (key, context hash, normalized prompt) for a prompt and its context.
+        """
+        context_hash = hash_cache_context(context)
+        normalized = normalize_prompt(prompt)
+        key = hashlib.sha256((context_hash + "\0" + normalized).encode("utf-8")).hexdigest()
+        return key, context_hash, normalized
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.exact_hits += 1
+            return copy_result(entry[2])
+
+    def _nearest(self, context_hash, vector):
+        with self.lock:
+            index = self.indexes.get(context_hash)
+            if index is None or not index[0]:
+                return None
+            keys, matrix = index
+            if matrix is None:
+                matrix = index[1] = np.stack([self.entries[key][1] for key in keys])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            key = keys[best]
+            self.entries.move_to_end(key)
+            self.similar_hits += 1
+            return copy_result(self.entries[key][2])
+
+    def _miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def _unit_vector(self, vectors):
+        if vectors is None or len(vectors) == 0:
+            return None
+        vector = np.asarray(vectors[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _embed(self, normalized, api_key):
+        if self.embed_function is not None:
+            return self._unit_vector(self.embed_function([normalized]))
+        response = embed([normalized], model=self.embedding_model, api_key=api_key)
+        return None if response["error"] else self._unit_vector(response["embeddings"])
+
+    async def _embed_async(self, normalized, api_key):
+        if self.embed_function is not None:
+            return self._unit_vector(self.embed_function([normalized]))
+        response = await embed_async([normalized], model=self.embedding_model, api_key=api_key)
+        return None if response["error"] else self._unit_vector(response["embeddings"])
+
+    def lookup(self, prompt, context, api_key=None):
+        """
+        Returns a lookup tuple (result, key, context hash, vector). result is None on a miss.
+
+        The rest of the tuple is passed back to store once the response is known,
+        so the prompt is not normalized or embedded twice.
+        """
+        key, context_hash, normalized = self.make_key(prompt, context)
+        result = self._get(key)
+        vector = None
+        if result is None and self.similarity_threshold is not None:
+            vector = self._embed(normalized, api_key)
+            if vector is not None:
+                result = self._nearest(context_hash, vector)
+        if result is None:
+            self._miss()
+        return result, key, context_hash, vector
+
+    async def lookup_async(self, prompt, context, api_key=None):
+        """
+        Looks up a prompt without blocking the event loop. See lookup.
+        """
+        key, context_hash, normalized = self.make_key(prompt, context)
+        result = self._get(key)
+        vector = None
+        if result is None and self.similarity_threshold is not None:
+            vector = await self._embed_async(normalized, api_key)
+            if vector is not None:
+                result = self._nearest(context_hash, vector)
+        if result is None:
+            self._miss()
+        return result, key, context_hash, vector
+
+    def store(self, lookup, result):
+        """
+        Stores the result for a lookup that missed. Results with an error are not stored.
+        """
+        _, key, context_hash, vector = lookup
+        if result is None or result.get("error"):
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (context_hash, vector, copy_result(result))
+            if vector is not None:
+                index = self.indexes.setdefault(context_hash, [[], None])
+                index[0].append(key)
+                index[1] = None
+            while len(self.entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        key, (context_hash, vector, _) = self.entries.popitem(last=False)
+        if vector is not None:
+            index = self.indexes[context_hash]
+            index[0].remove(key)
+            index[1] = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.indexes.clear()
+
+    def stats(self):
+        """
+        Returns the number of entries, exact and similar hits, misses and the hit rate.
+        """
+        with self.lock:
+            lookups = self.exact_hits + self.similar_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "exact_hits": self.exact_hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,141 @@
+import time
+import threading
+
+from .ledger import estimate_cost
+from .model import function_completion_steps
+from .results import Usage
+
+# Counter positions in each tier's stats
+ATTEMPTS, ACCEPTED, PROMPT_TOKENS, COMPLETION_TOKENS, COST, LATENCY = range(6)
+
+
+def track_usage(completion, counters):
+    """
+    Passes the steps of a completion generator through, adding the usage of every response to counters.
+    """
+    try:
+        step, value = next(completion)
+        while True:
+            sent = yield step, value
+            if step != "sleep" and sent is not None and sent[0] is not None:
+                usage = sent[0].get("usage", None) or {}
+                counters[PROMPT_TOKENS] += usage.get("prompt_tokens", 0) or 0
+                counters[COMPLETION_TOKENS] += usage.get("completion_tokens", 0) or 0
+            step, value = completion.send(sent)
+    except StopIteration as stop:
+        return stop.value
+
+
+class ModelCascade:
+    """
+    Tries function calls on the cheapest model first, escalating to larger models only when the call is not accepted.
+
+    A call is accepted when it passes validation (after local repair) and, if
+    given, the accept check. Models before the last get tier_retries attempts
+    each; the last model gets the caller's function_failure_retries. Stats on
+    how often each tier is accepted, and what it costs, show whether the
+    cheaper tiers are paying for themselves.
+
+    Usage:
+        cascade = ModelCascade(["gpt-3.5-turbo", "gpt-4"])
+        function_completion(text, functions=[classify_function], cascade=cascade)
+        cascade.stats()
+    """
+
+    def __init__(self, models, accept=None, tier_retries=1):
+        """
+        Args:
+            models (list): Model names, cheapest first.
+            accept (callable | None): Called with a valid FunctionCallResult, returns False to escalate anyway,
+                e.g. when a confidence field in the arguments is too low.
+            tier_retries (int): Attempts on each model before the last one.
+        """
+        if not models:
+            raise ValueError("A cascade needs at least one model")
+        self.models = list(models)
+        self.accept = accept
+        self.tier_retries = tier_retries
+        self.lock = threading.Lock()
+        self.tiers = {model: [0, 0, 0, 0, 0.0, 0.0] for model in self.models}
+        self.calls = 0
+
+    def accepts(self, result):
+        if result["error"] is not None:
+            return False
+        return self.accept is None or bool(self.accept(result))
+
+    def steps(self, model=None, function_failure_retries=None, deadline=None, **options):
+        """
+        A completion generator, like function_completion_steps, that runs the cascade.
+
+        The cascade's models replace model. The returned result's usage is the total over every tier that was tried.
+        """
+        usage = Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        for tier, model in enumerate(self.models):
+            last = tier == len(self.models) - 1
+            counters = [1, 0, 0, 0, 0.0, 0.0]
+            start = time.monotonic()
+            result = yield from track_usage(
+                function_completion_steps(
+                    model=model,
+                    function_failure_retries=function_failure_retries if last else self.tier_retries,
+                    deadline=deadline,
+                    **options,
+                ),
+                counters,
+            )
+            accepted = self.accepts(result)
+            counters[ACCEPTED] = int(accepted)
+            counters[COST] = estimate_cost(model, counters[PROMPT_TOKENS], counters[COMPLETION_TOKENS])
+            counters[LATENCY] = time.monotonic() - start
+            self._record(model, counters, finished=accepted or last)
+
+            usage["prompt_tokens"] += counters[PROMPT_TOKENS]
+            usage["completion_tokens"] += counters[COMPLETION_TOKENS]
+            usage["total_tokens"] += counters[PROMPT_TOKENS] + counters[COMPLETION_TOKENS]
+            # Past the deadline, a worse answer now beats a better one later
+            if accepted or (deadline is not None and time.monotonic() >= deadline):
+                break
+        if result["error"] is None:
+            result["usage"] = usage
+        return result
+
+    def _record(self, model, counters, finished):
+        with self.lock:
+            entry = self.tiers[model]
+            for i, value in enumerate(counters):
+                entry[i] += value
+            if finished:
+                self.calls += 1
+
+    def stats(self):
+        """
+        Returns how each tier has done.
+
+        Returns:
+            dict: "calls" (completed cascades), "average_cost" and "average_latency" (per call, in USD and seconds),
+            and "tiers", a dictionary of model to attempts, accepted, acceptance_rate, prompt_tokens,
+            completion_tokens, cost and average_latency.
+        """
+        with self.lock:
+            tiers = {
+                model: {
+                    "attempts": entry[ATTEMPTS],
+                    "accepted": entry[ACCEPTED],
+                    "acceptance_rate": entry[ACCEPTED] / entry[ATTEMPTS] if entry[ATTEMPTS] else 0.0,
+                    "prompt_tokens": entry[PROMPT_TOKENS],
+                    "completion_tokens": entry[COMPLETION_TOKENS],
+                    "cost": entry[COST],
+                    "average_latency": entry[LATENCY] / entry[ATTEMPTS] if entry[ATTEMPTS] else 0.0,
+                }
+                for model, entry in self.tiers.items()
+            }
+            calls = self.calls
+        return {
+            "calls": calls,
+            "average_cost": sum(tier["cost"] for tier in tiers.values()) / calls if calls else 0.0,
+            "average_latency": (
+                sum(tier["average_latency"] * tier["attempts"] for tier in tiers.values()) / calls if calls else 0.0
+            ),
+            "tiers": tiers,
+        }
@@ -0,0 +1,84 @@
+from .config import get_config
+from .model import (
+    text_completion,
+    text_completion_async,
+    chat_completion,
+    chat_completion_async,
+    function_completion,
+    function_completion_async,
+)
+from .embedding import embed, embed_async
+
+
+class Client:
+    """
+    Sends requests with its own Config, so callers with different keys, endpoints or models can share a process.
+
+    Every setting travels with each request instead of through global state,
+    so clients can be used concurrently from threads and tasks. Arguments
+    passed to a method override the client's settings for that call.
+
+    Usage:
+        client = Client(api_key=tenant_key, text_model="gpt-4")
+        client.text_completion("Hello, how are you?")
+    """
+
+    __slots__ = ("config",)
+
+    def __init__(self, config=None, **changes):
+        """
+        Args:
+            config (Config | None): The settings to use. Default is the current default Config.
+            **changes: Config fields to change, e.g. api_key or text_model.
+        """
+        config = config or get_config()
+        self.config = config.replace(**changes) if changes else config
+
+    def options(self, options, **defaults):
+        config = self.config
+        defaults.update(
+            api_key=config.api_key, api_base=config.api_base, model_failure_retries=config.model_failure_retries
+        )
+        defaults.update((key, value) for key, value in options.items() if value is not None)
+        return defaults
+
+    def completion_options(self, options, **defaults):
+        config = self.config
+        return self.options(
+            options,
+            model=config.text_model,
+            long_text_model=config.long_text_model,
+            chunk_length=config.chunk_length,
+            **defaults,
+        )
+
+    def text_completion(self, text, **options):
+        return text_completion(text, **self.completion_options(options))
+
+    async def text_completion_async(self, text, **options):
+        return await text_completion_async(text, **self.completion_options(options))
+
+    def chat_completion(self, messages, **options):
+        return chat_completion(messages, **self.completion_options(options))
+
+    async def chat_completion_async(self, messages, **options):
+        return await chat_completion_async(messages, **self.completion_options(options))
+
+    def function_completion(self, text=None, **options):
+        return function_completion(
+            text, **self.completion_options(options, function_failure_retries=self.config.function_failure_retries)
+        )
+
+    async def function_completion_async(self, text=None, **options):
+        return await function_completion_async(
+            text, **self.completion_options(options, function_failure_retries=self.config.function_failure_retries)
+        )
+
+    def embed(self, texts, **options):
+        return embed(texts, **self.options(options, model=self.config.embedding_model))
+
+    async def embed_async(self, texts, **options):
+        return await embed_async(texts, **self.options(options, model=self.config.embedding_model))
+
+    def __repr__(self):
+        return f"Client({self.config!r})"
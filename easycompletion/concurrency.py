@@ -0,0 +1,293 @@
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+
+# Exceptions that mean the backend is overloaded, as opposed to a bad request.
+# Matched by name so this works across openai library versions.
+OVERLOAD_ERRORS = {
+    "RateLimitError",
+    "Timeout",
+    "APITimeoutError",
+    "TimeoutError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "TryAgain",
+}
+
+# Timeouts, which after the caller's own deadline mean the caller gave up, not that the backend is slow
+TIMEOUT_ERRORS = {
+    "Timeout",
+    "APITimeoutError",
+    "TimeoutError",
+}
+
+
+def is_overload_error(error):
+    """
+    Returns True if an exception indicates that the backend is overloaded (429s, timeouts, 503s).
+    """
+    if type(error).__name__ in OVERLOAD_ERRORS:
+        return True
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    return status in (429, 502, 503, 504)
+
+
+class Waiter:
+    __slots__ = ("event", "loop", "future", "granted")
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def grant(self):
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdaptiveLimiter:
+    """
+    A concurrency limit that adapts to the latency and errors of a backend.
+
+    The limit follows a gradient: while request latency stays close to the
+    long-term average it grows by roughly sqrt(limit) per round, and as latency
+    rises above the average it shrinks proportionally. Overload errors (429s,
+    timeouts) cut the limit multiplicatively, at most once per round trip.
+
+    The same limiter can be shared by threads and asyncio tasks. Waiters are
+    served in arrival order.
+
+    Usage:
+        limiter = get_limiter("openai")
+        async with limiter.slot():
+            ...
+        response = function_completion(text, functions, limiter=limiter)
+    """
+
+    def __init__(
+        self,
+        initial_limit=4,
+        min_limit=1,
+        max_limit=64,
+        backoff=0.5,
+        tolerance=1.5,
+        smoothing=0.2,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self.last_backoff = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.waiters = deque()
+
+    def _has_capacity(self):
+        return self.in_flight < max(self.min_limit, math.floor(self.limit))
+
+    def _wake(self):
+        while self.waiters and self._has_capacity():
+            self.in_flight += 1
+            self.waiters.popleft().grant()
+
+    def acquire(self, timeout=None):
+        """
+        Block until a slot is free. Returns False if the timeout passes first.
+        """
+        with self.lock:
+            if not self.waiters and self._has_capacity():
+                self.in_flight += 1
+                return True
+            waiter = Waiter(event=threading.Event())
+            self.waiters.append(waiter)
+        if waiter.event.wait(timeout):
+            return True
+        with self.lock:
+            if waiter.granted:
+                return True
+            self.waiters.remove(waiter)
+        return False
+
+    async def acquire_async(self, timeout=None):
+        """
+        Wait without blocking the event loop until a slot is free. Returns False if the timeout passes first.
+        """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if not self.waiters and self._has_capacity():
+                self.in_flight += 1
+                return True
+            waiter = Waiter(loop=loop, future=loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if waiter.granted:
+                    return True
+                self.waiters.remove(waiter)
+            return False
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter.granted:
+                    # The slot was handed over as the caller gave up, pass it on
+                    self.in_flight -= 1
+                    self._wake()
+                else:
+                    self.waiters.remove(waiter)
+            raise
+        return True
+
+    def release(self, latency=None, error=False):
+        """
+        Free a slot and record how the request went.
+
+        Args:
+            latency: Seconds the request took, or None if it should not be measured.
+            error: True if the request failed because the backend was overloaded.
+        """
+        with self.lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if error:
+                self._on_overload()
+            elif latency is not None:
+                self._on_success(latency, in_flight)
+            self._wake()
+
+    def _on_overload(self):
+        self.errors += 1
+        now = time.monotonic()
+        # Requests in flight together fail together, so back off once per round trip
+        if now - self.last_backoff >= (self.long_latency or 0):
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self.last_backoff = now
+
+    def _on_success(self, latency, in_flight):
+        self.successes += 1
+        self.short_latency = latency
+        if self.long_latency is None:
+            self.long_latency = latency
+            return
+        self.long_latency += (latency - self.long_latency) * 0.05
+        # Let the baseline follow a sustained drop in latency quickly
+        if self.long_latency > 2 * latency:
+            self.long_latency *= 0.95
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / latency))
+        # Only grow when the current limit is actually being used
+        headroom = math.sqrt(self.limit) if in_flight >= self.limit / 2 else 0
+        target = self.limit * gradient + headroom
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def slot(self, deadline=None):
+        """
+        Returns a context manager that holds a slot and records its latency.
+
+        Works with both "with" and "async with". Exceptions that indicate
+        overload shrink the limit; set error on the slot to report overload
+        without raising. If deadline (a time.monotonic() value) passes while
+        waiting for a slot, entering raises TimeoutError, and a request that
+        times out at the deadline is not counted as overload.
+        """
+        return Slot(self, deadline)
+
+    def stats(self):
+        """
+        Returns the current limit, requests in flight and waiting, and observed latency.
+        """
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiters),
+                "latency": self.short_latency,
+                "baseline_latency": self.long_latency,
+                "successes": self.successes,
+                "errors": self.errors,
+            }
+
+
+class Slot:
+    __slots__ = ("limiter", "deadline", "start", "error")
+
+    def __init__(self, limiter, deadline=None):
+        self.limiter = limiter
+        self.deadline = deadline
+        self.start = None
+        self.error = False
+
+    def timeout(self):
+        return None if self.deadline is None else max(0, self.deadline - time.monotonic())
+
+    def __enter__(self):
+        if not self.limiter.acquire(self.timeout()):
+            raise TimeoutError("Request dropped: deadline passed waiting for the limiter")
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._release(exc)
+
+    async def __aenter__(self):
+        if not await self.limiter.acquire_async(self.timeout()):
+            raise TimeoutError("Request dropped: deadline passed waiting for the limiter")
+        self.start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release(exc)
+
+    def _release(self, exc):
+        if exc is not None and not is_overload_error(exc):
+            # The request was bad, which says nothing about the backend's load
+            self.limiter.release()
+            return
+        if (
+            exc is not None
+            and type(exc).__name__ in TIMEOUT_ERRORS
+            and self.deadline is not None
+            and time.monotonic() >= self.deadline
+        ):
+            # Cut off by this caller's deadline, so neither an overload nor a latency sample
+            self.limiter.release()
+            return
+        self.limiter.release(
+            latency=time.monotonic() - self.start,
+            error=self.error or exc is not None,
+        )
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_limiter(key="default", **kwargs):
+    """
+    Returns the shared AdaptiveLimiter for a backend, creating it on first use.
+
+    Args:
+        key: Identifies the backend, e.g. an API endpoint or model name.
+        **kwargs: Settings for the limiter if it is created by this call.
+    """
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = AdaptiveLimiter(**kwargs)
+        return limiters[key]
@@ -0,0 +1,69 @@
+import threading
+import dataclasses
+
+from .constants import (
+    EASYCOMPLETION_API_KEY,
+    EASYCOMPLETION_API_ENDPOINT,
+    TEXT_MODEL,
+    LONG_TEXT_MODEL,
+    EMBEDDING_MODEL,
+    DEFAULT_CHUNK_LENGTH,
+)
+from .ledger import key_fingerprint
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    """
+    Settings for sending requests: API key and endpoint, default models, chunk length and retry policy.
+
+    A Config can't be changed once created, so it can be shared between
+    threads and tasks; replace() returns a changed copy. The defaults come
+    from the environment variables read in constants.py.
+    """
+
+    api_key: str = EASYCOMPLETION_API_KEY
+    api_base: str = EASYCOMPLETION_API_ENDPOINT
+    text_model: str = TEXT_MODEL
+    long_text_model: str = LONG_TEXT_MODEL
+    embedding_model: str = EMBEDDING_MODEL
+    chunk_length: int = DEFAULT_CHUNK_LENGTH
+    model_failure_retries: int = 5
+    function_failure_retries: int = 10
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+    def __repr__(self):
+        # Keeps the key itself out of logs and tracebacks
+        fields = ", ".join(
+            f"{field.name}={key_fingerprint(self.api_key) if field.name == 'api_key' else getattr(self, field.name)!r}"
+            for field in dataclasses.fields(self)
+        )
+        return f"Config({fields})"
+
+
+default_config = Config()
+config_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Returns the default Config, which module-level functions use for any setting they are not given.
+    """
+    return default_config
+
+
+def configure(**changes):
+    """
+    Replaces the default Config with a copy that has the given changes, and returns it.
+
+    Requests already running keep the Config they started with.
+
+    Example:
+        >>> configure(api_key="sk-...", text_model="gpt-4")
+    """
+    global default_config
+    with config_lock:
+        default_config = default_config.replace(**changes)
+        return default_config
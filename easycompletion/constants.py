@@ -15,7 +15,55 @@ if EASYCOMPLETION_API_KEY is None:
     EASYCOMPLETION_API_KEY = os.getenv("EASYCOMPLETION_API_KEY")
 
 EASYCOMPLETION_API_ENDPOINT = os.getenv("EASYCOMPLETION_API_ENDPOINT") or "https://api.openai.com/v1"
+EASYCOMPLETION_LOCAL_API_ENDPOINT = os.getenv("EASYCOMPLETION_LOCAL_API_ENDPOINT") or "http://localhost:8080/v1"
+
+# Record and replay chat requests from this file, see CassetteBackend
+EASYCOMPLETION_CASSETTE = os.getenv("EASYCOMPLETION_CASSETTE")
+EASYCOMPLETION_CASSETTE_MODE = os.getenv("EASYCOMPLETION_CASSETTE_MODE") or "auto"
 
 DEBUG = os.environ.get("EASYCOMPLETION_DEBUG") == "true" or os.environ.get("EASYCOMPLETION_DEBUG") == "True"
 
-DEFAULT_CHUNK_LENGTH = 4096 * 3 / 4  # 3/4ths of the context window size
+DEFAULT_CHUNK_LENGTH = 4096 * 3 // 4  # 3/4ths of the context window size
+
+EMBEDDING_MODEL = os.getenv("EASYCOMPLETION_EMBEDDING_MODEL")
+if EMBEDDING_MODEL == None or EMBEDDING_MODEL == "":
+    EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Provider limits for a single embeddings request
+EMBEDDING_MAX_BATCH_SIZE = 2048  # inputs per request
+EMBEDDING_MAX_INPUT_TOKENS = 8191  # tokens per input
+EMBEDDING_MAX_BATCH_TOKENS = 300000  # tokens across all inputs in a request
+
+# Estimated price in USD per 1000 tokens, as (prompt, completion). Models are
+# matched exactly first, then by the longest matching prefix.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+# Context window in tokens (prompt and response together), matched like MODEL_PRICES
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Sent to ask the model to go on after a response was cut off at max_tokens
+CONTINUE_PROMPT = "Continue exactly where you left off, without repeating anything."
+
+
+def match_model(table, model, default=None):
+    """
+    Looks up a model in a table keyed by model name, exactly first, then by the longest matching prefix.
+    """
+    if model in table:
+        return table[model]
+    prefixes = [prefix for prefix in table if model.startswith(prefix)]
+    if not prefixes:
+        return default
+    return table[max(prefixes, key=len)]
@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import mmap
+import array
+import bisect
+import functools
+import itertools
+import multiprocessing
+
+from .constants import TEXT_MODEL, DEBUG
+from .logger import log
+from .prompt import get_encoding, token_boundaries
+
+# File names inside a corpus directory written by prepare_corpus
+CORPUS_TOKENS = "tokens.u32"
+CORPUS_DOCUMENTS = "documents.i64"
+CORPUS_CHUNKS = "chunks.i64"
+CORPUS_META = "meta.json"
+
+
+def chunk_boundaries(text, tokens, encoding, chunk_length):
+    """
+    Returns the token offsets that split a document's tokens into chunks of at most chunk_length tokens.
+
+    Chunks end at the last sentence or paragraph boundary that fits, unless
+    that keeps less than half of the chunk, in which case they end at the limit.
+
+    Returns:
+        An array of offsets starting with 0 and ending with len(tokens).
+    """
+    boundaries = array.array("q", [0])
+    if len(tokens) <= chunk_length:
+        boundaries.append(len(tokens))
+        return boundaries
+
+    natural = [index for index, _ in token_boundaries(text, tokens, encoding)]
+
+    start = 0
+    while len(tokens) - start > chunk_length:
+        limit = start + chunk_length
+        position = bisect.bisect_right(natural, limit) - 1
+        end = natural[position] if position >= 0 else start
+        if (end - start) * 2 < chunk_length:
+            end = limit
+        boundaries.append(end)
+        start = end
+    boundaries.append(len(tokens))
+    return boundaries
+
+
+def read_document(document, read_files):
+    if not read_files:
+        return document
+    with open(document, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def tokenize_document(document, model=TEXT_MODEL, chunk_length=None, read_files=False):
+    """
+    Tokenizes one document. Runs in worker processes, so it must stay a module-level function.
+
+    Returns:
+        A tuple of (tokens, chunk boundaries or None), both as arrays.
+    """
+    text = read_document(document, read_files)
+    encoding = get_encoding(model)
+    # Corpora may contain special token text, which is tokenized as ordinary text
+    tokens = encoding.encode_ordinary(text)
+    boundaries = chunk_boundaries(text, tokens, encoding, chunk_length) if chunk_length else None
+    return array.array("I", tokens), boundaries
+
+
+def tokenize_corpus(documents, model=TEXT_MODEL, chunk_length=None, processes=None, shard_size=64, read_files=False):
+    """
+    Tokenizes documents in parallel, yielding (tokens, boundaries) for each document in input order.
+
+    Args:
+        documents: An iterable of texts, or of file paths if read_files is True.
+            Documents are read lazily, so the corpus does not have to fit in memory.
+        model: The model to use for tokenization.
+        chunk_length: If set, chunk boundaries of at most this many tokens are computed for each document.
+        processes: Number of worker processes. Default is one per core. 0 tokenizes in this process,
+            using tiktoken's native threads.
+        shard_size: Number of documents sent to a worker at a time.
+        read_files: If True, documents are paths that the workers read themselves.
+    """
+    if processes == 0:
+        # tiktoken releases the GIL while encoding a batch; boundaries still need Python
+        encoding = get_encoding(model)
+        iterator = iter(documents)
+        while True:
+            shard = [read_document(document, read_files) for document in itertools.islice(iterator, shard_size)]
+            if not shard:
+                return
+            for text, tokens in zip(shard, encoding.encode_ordinary_batch(shard, num_threads=os.cpu_count())):
+                boundaries = chunk_boundaries(text, tokens, encoding, chunk_length) if chunk_length else None
+                yield array.array("I", tokens), boundaries
+
+    worker = functools.partial(tokenize_document, model=model, chunk_length=chunk_length, read_files=read_files)
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(worker, documents, chunksize=shard_size)
+
+
+def prepare_corpus(
+    documents,
+    output_path=None,
+    model=TEXT_MODEL,
+    chunk_length=None,
+    processes=None,
+    shard_size=64,
+    read_files=False,
+    debug=DEBUG,
+):
+    """
+    Tokenizes a corpus using every core, returning token counts and chunk boundaries and optionally saving the tokens.
+
+    With an output_path, tokens are written to a directory of flat binary files
+    that open_corpus memory-maps, so a prepared corpus can be reused without
+    tokenizing it again or loading it into memory.
+
+    Args:
+        documents: An iterable of texts, or of file paths if read_files is True.
+        output_path (str | None): Directory to write the tokens to.
+        model (str): The model to use for tokenization.
+        chunk_length (int | None): If set, each document is split into chunks of at most this many tokens,
+            ending at sentence boundaries where possible.
+        processes (int | None): Number of worker processes, default one per core. 0 uses tiktoken's threads instead.
+        shard_size (int): Number of documents sent to a worker at a time.
+        read_files (bool): If True, documents are file paths, read by the workers.
+
+    Returns:
+        dict: "documents" (count), "tokens" (total), "token_counts" (per document), "chunks" (per document,
+        token offsets of chunk boundaries, or None without chunk_length) and "error".
+
+    Example:
+        >>> prepare_corpus(paths, "corpus/", chunk_length=1024, read_files=True)
+    """
+    token_counts = array.array("q")
+    chunks = [] if chunk_length else None
+    document_offsets = array.array("q", [0])
+    chunk_offsets = array.array("q")
+    total = 0
+
+    tokens_file = None
+    if output_path is not None:
+        os.makedirs(output_path, exist_ok=True)
+        tokens_file = open(os.path.join(output_path, CORPUS_TOKENS), "wb")
+
+    try:
+        for tokens, boundaries in tokenize_corpus(
+            documents, model, chunk_length, processes, shard_size, read_files
+        ):
+            token_counts.append(len(tokens))
+            if chunk_length:
+                chunks.append(boundaries)
+                # Stored as offsets into the whole token file, without each document's final offset
+                chunk_offsets.extend(total + boundary for boundary in boundaries[:-1])
+            total += len(tokens)
+            document_offsets.append(total)
+            if tokens_file is not None:
+                tokens.tofile(tokens_file)
+    except Exception as e:
+        log(f"Preparing corpus failed:\n{e}", type="error", log=debug)
+        return {"documents": len(token_counts), "tokens": total, "token_counts": token_counts, "chunks": chunks, "error": str(e)}
+    finally:
+        if tokens_file is not None:
+            tokens_file.close()
+
+    if output_path is not None:
+        chunk_offsets.append(total)
+        with open(os.path.join(output_path, CORPUS_DOCUMENTS), "wb") as f:
+            document_offsets.tofile(f)
+        with open(os.path.join(output_path, CORPUS_CHUNKS), "wb") as f:
+            chunk_offsets.tofile(f)
+        with open(os.path.join(output_path, CORPUS_META), "w") as f:
+            json.dump(
+                {
+                    "model": model,
+                    "chunk_length": chunk_length,
+                    "documents": len(token_counts),
+                    "tokens": total,
+                    "byteorder": sys.byteorder,
+                },
+                f,
+            )
+
+    log(f"Prepared corpus of {len(token_counts)} documents and {total} tokens", log=debug)
+    return {
+        "documents": len(token_counts),
+        "tokens": total,
+        "token_counts": token_counts,
+        "chunks": chunks,
+        "error": None,
+    }
+
+
+def map_array(path, typecode):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array.array(typecode))
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+
+class TokenCorpus:
+    """
+    A corpus written by prepare_corpus, memory-mapped so only the tokens that are read are loaded.
+
+    Usage:
+        corpus = open_corpus("corpus/")
+        for chunk in corpus.chunks():
+            ...
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, CORPUS_META)) as f:
+            self.meta = json.load(f)
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"Corpus at {path} was written with {self.meta['byteorder']}-endian byte order")
+        self.model = self.meta["model"]
+        self.tokens = map_array(os.path.join(path, CORPUS_TOKENS), "I")
+        self.document_offsets = map_array(os.path.join(path, CORPUS_DOCUMENTS), "q")
+        self.chunk_offsets = map_array(os.path.join(path, CORPUS_CHUNKS), "q")
+
+    def __len__(self):
+        return len(self.document_offsets) - 1
+
+    def token_count(self, index):
+        return self.document_offsets[index + 1] - self.document_offsets[index]
+
+    def document(self, index):
+        """
+        Returns the tokens of a document, as a memoryview into the mapped file.
+        """
+        return self.tokens[self.document_offsets[index] : self.document_offsets[index + 1]]
+
+    def chunks(self):
+        """
+        Yields the tokens of every chunk in order, if the corpus was prepared with a chunk_length.
+        """
+        for start, end in zip(self.chunk_offsets, self.chunk_offsets[1:]):
+            if end > start:
+                yield self.tokens[start:end]
+
+    def decode(self, tokens):
+        return get_encoding(self.model).decode(list(tokens))
+
+
+def open_corpus(path):
+    """
+    Opens a corpus directory written by prepare_corpus.
+    """
+    return TokenCorpus(path)
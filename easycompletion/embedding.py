@@ -0,0 +1,444 @@
+import os
+import json
+import hashlib
+import asyncio
+import functools
+import threading
+import openai
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .constants import (
+    EMBEDDING_MODEL,
+    EMBEDDING_MAX_BATCH_SIZE,
+    EMBEDDING_MAX_INPUT_TOKENS,
+    EMBEDDING_MAX_BATCH_TOKENS,
+    DEBUG,
+)
+from .logger import log
+from .ledger import get_ledger
+from .config import get_config
+from .prompt import chunk_prompt, count_tokens, get_encoding
+
+NUMPY_REQUIRED_ERROR = (
+    "numpy is required for embeddings. Install it with: pip install easycompletion[embeddings]"
+)
+
+
+def hash_embedding_input(text, model=EMBEDDING_MODEL):
+    """
+    Return the cache key for an embedding input: a hash of the model and the text.
+    """
+    return hashlib.sha256((model + "\0" + text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Stores embedding vectors on disk, keyed by content hash.
+
+    Vectors are appended to a flat float32 file that is read through a memory
+    map, so looking up cached vectors does not load the whole cache into memory.
+    An append-only index maps each key to its row. Rows written without an index
+    entry (for example after a crash) are ignored, and a partly written row is
+    overwritten by the next append.
+
+    Usage:
+        cache = EmbeddingCache("~/.cache/easycompletion/embeddings")
+        response = embed(["first document", "second document"], cache=cache)
+    """
+
+    def __init__(self, path):
+        if np is None:
+            raise ImportError(NUMPY_REQUIRED_ERROR)
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.index_path = os.path.join(self.path, "index.jsonl")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.dim = None
+        self._mmap = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                self.dim = json.load(f)["dim"]
+
+        if os.path.exists(self.index_path):
+            stored_rows = self._stored_rows()
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written last line
+                    if entry["row"] < stored_rows:
+                        self.rows[entry["key"]] = entry["row"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def _stored_rows(self):
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 4)
+
+    def _vectors(self):
+        # Remap only when rows have been appended since the last mapping
+        needed = max(self.rows.values()) + 1
+        if self._mmap is None or self._mmap.shape[0] < needed:
+            self._mmap = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self._stored_rows(), self.dim),
+            )
+        return self._mmap
+
+    def get_many(self, keys):
+        """
+        Return a dictionary of key to vector for every key that is cached.
+        """
+        with self.lock:
+            found = [key for key in keys if key in self.rows]
+            if not found:
+                return {}
+            vectors = self._vectors()
+            return {key: np.array(vectors[self.rows[key]]) for key in found}
+
+    def put_many(self, keys, vectors):
+        """
+        Append vectors to the cache. Keys that are already cached are skipped.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self.meta_path, "w") as f:
+                    json.dump({"dim": self.dim, "dtype": "float32"}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match cache dimension {self.dim}"
+                )
+
+            new = [
+                (key, vector)
+                for key, vector in dict(zip(keys, vectors)).items()
+                if key not in self.rows
+            ]
+            if not new:
+                return
+
+            row = self._stored_rows()
+            # Vectors are written before the index, so the index never points
+            # at a row that is not on disk
+            with open(self.vectors_path, "ab") as f:
+                # A crash can leave part of a vector at the end, which would shift every row after it
+                f.truncate(row * self.dim * 4)
+                for _, vector in new:
+                    f.write(vector.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, "a") as f:
+                for i, (key, _) in enumerate(new):
+                    f.write(json.dumps({"key": key, "row": row + i}) + "\n")
+                    self.rows[key] = row + i
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_cache(path):
+    """
+    Return the EmbeddingCache for a directory, opening it once per process.
+    """
+    return EmbeddingCache(path)
+
+
+def split_embedding_input(text, max_tokens=EMBEDDING_MAX_INPUT_TOKENS, model=EMBEDDING_MODEL):
+    """
+    Split text that is too long to embed into pieces that fit the input limit.
+
+    Returns:
+        A list of (piece, token_count) tuples. Text within the limit is returned as one piece.
+    """
+    token_count = count_tokens(text, model=model)
+    if token_count <= max_tokens:
+        return [(text, max(token_count, 1))]
+
+    pieces = []
+    encoding = get_encoding(model)
+    for chunk in chunk_prompt(text, chunk_length=max_tokens):
+        tokens = encoding.encode(chunk)
+        # A single sentence can still be over the limit, so cut it by tokens
+        for start in range(0, len(tokens), max_tokens):
+            piece_tokens = tokens[start : start + max_tokens]
+            if piece_tokens:
+                pieces.append((encoding.decode(piece_tokens), len(piece_tokens)))
+    return pieces
+
+
+def plan_embedding_batches(
+    texts,
+    model=EMBEDDING_MODEL,
+    batch_size=EMBEDDING_MAX_BATCH_SIZE,
+    max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+    max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS,
+):
+    """
+    Split texts into request batches that respect the provider's limits.
+
+    Returns:
+        A list of batches. Each batch is a list of (text_index, piece, token_count) tuples.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for index, text in enumerate(texts):
+        for piece, token_count in split_embedding_input(text, max_input_tokens, model):
+            if batch and (
+                len(batch) >= batch_size or batch_tokens + token_count > max_batch_tokens
+            ):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append((index, piece, token_count))
+            batch_tokens += token_count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def combine_embedding_pieces(count, pieces):
+    """
+    Combine per-piece vectors into one vector per text.
+
+    Texts that were split are averaged weighted by token count and re-normalized.
+
+    Args:
+        count: Number of texts.
+        pieces: A list of (text_index, token_count, vector) tuples.
+    """
+    grouped = [[] for _ in range(count)]
+    for index, token_count, vector in pieces:
+        grouped[index].append((token_count, vector))
+
+    vectors = []
+    for group in grouped:
+        if len(group) == 1:
+            # Texts embedded in a single piece keep the provider's vector as-is
+            vectors.append(np.asarray(group[0][1], dtype=np.float32))
+            continue
+        total = sum(
+            token_count * np.asarray(vector, dtype=np.float64)
+            for token_count, vector in group
+        )
+        norm = np.linalg.norm(total)
+        vectors.append(total / norm if norm > 0 else total)
+    return np.stack(vectors).astype(np.float32)
+
+
+def prepare_embedding(texts, model, cache):
+    if isinstance(texts, str):
+        texts = [texts]
+    if isinstance(cache, str):
+        cache = get_embedding_cache(cache)
+    keys = [hash_embedding_input(text, model) for text in texts]
+    cached = cache.get_many(keys) if cache is not None else {}
+    # Each distinct uncached text is embedded once, however often it repeats
+    missing = list(dict.fromkeys(key for key in keys if key not in cached))
+    text_by_key = dict(zip(keys, texts))
+    return texts, keys, cache, cached, missing, [text_by_key[key] for key in missing]
+
+
+def finish_embedding(keys, cache, cached, missing, pieces, usage):
+    if missing:
+        vectors = combine_embedding_pieces(len(missing), pieces)
+        if cache is not None:
+            cache.put_many(missing, vectors)
+        cached.update(zip(missing, vectors))
+    if not keys:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    else:
+        embeddings = np.stack([cached[key] for key in keys]).astype(np.float32)
+    return {
+        "embeddings": embeddings,
+        "usage": usage,
+        "cached": len(keys) - len(missing),
+        "error": None,
+    }
+
+
+def embedding_error(message):
+    return {"embeddings": None, "usage": None, "cached": 0, "error": message}
+
+
+def add_embedding_response(batch, response, pieces, usage):
+    for item in sorted(response["data"], key=lambda item: item["index"]):
+        index, _, token_count = batch[item["index"]]
+        pieces.append((index, token_count, item["embedding"]))
+    for key in usage:
+        usage[key] += response["usage"].get(key, 0)
+
+
+def embed(
+    texts,
+    model=None,
+    cache=None,
+    batch_size=EMBEDDING_MAX_BATCH_SIZE,
+    max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+    max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS,
+    model_failure_retries=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    ledger=None,
+    tag=None,
+):
+    """
+    Embed one or more texts, batching requests and caching vectors by content.
+
+    Inputs are grouped into as few requests as the provider's per-request item
+    and token limits allow. Inputs longer than max_input_tokens are split with
+    chunk_prompt and their piece vectors averaged. Cached texts and repeated
+    texts are never sent again.
+
+    Parameters:
+        texts (str | list[str]): Text or list of texts to embed.
+        model (str, optional): The embedding model. Default is EMBEDDING_MODEL defined in constants.py.
+        cache (EmbeddingCache | str, optional): A cache, or a directory to cache vectors in.
+        batch_size (int, optional): Maximum number of inputs per request.
+        max_batch_tokens (int, optional): Maximum number of tokens per request.
+        max_input_tokens (int, optional): Maximum number of tokens per input.
+        model_failure_retries (int, optional): Number of retries if a request fails. Default is 5.
+        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+        api_base (str, optional): API endpoint for this call. Default is EASYCOMPLETION_API_ENDPOINT.
+        ledger (UsageLedger, optional): Ledger to record usage to. Default is the shared ledger; False disables it.
+        tag (str, optional): Label to record usage under in the ledger.
+
+    Returns:
+        dict: "embeddings" (numpy array with one row per text), "usage", "cached"
+        (number of texts served from the cache) and "error".
+
+    Example:
+        >>> embed(["Hello", "World"], cache="~/.cache/easycompletion/embeddings")["embeddings"].shape
+        (2, 1536)
+    """
+    if np is None:
+        return embedding_error(NUMPY_REQUIRED_ERROR)
+
+    # Settings that are not given come from the default Config
+    config = get_config()
+    model = model or config.embedding_model
+    model_failure_retries = config.model_failure_retries if model_failure_retries is None else model_failure_retries
+    api_key = config.api_key if api_key is None else api_key
+    api_base = config.api_base if api_base is None else api_base
+
+    texts, keys, cache, cached, missing, missing_texts = prepare_embedding(texts, model, cache)
+    batches = plan_embedding_batches(
+        missing_texts, model, batch_size, max_batch_tokens, max_input_tokens
+    )
+
+    pieces = []
+    usage = {"prompt_tokens": 0, "total_tokens": 0}
+    for batch in batches:
+        response = None
+        for _ in range(model_failure_retries):
+            try:
+                response = openai.Embedding.create(
+                    model=model, input=[piece for _, piece, _ in batch], api_key=api_key, api_base=api_base
+                )
+                break
+            except Exception as e:
+                log(f"OpenAI Error: {e}", type="error", log=debug)
+        if response is None:
+            return embedding_error(
+                "Error: Could not get a successful response from OpenAI API"
+            )
+        add_embedding_response(batch, response, pieces, usage)
+
+    log(
+        f"Embedded {len(missing)} texts in {len(batches)} requests, {len(keys) - len(missing)} cached",
+        log=debug,
+    )
+    ledger = get_ledger() if ledger is None else ledger
+    if ledger and batches:
+        ledger.record(model, usage, api_key=api_key, tag=tag)
+    return finish_embedding(keys, cache, cached, missing, pieces, usage)
+
+
+async def embed_async(
+    texts,
+    model=None,
+    cache=None,
+    batch_size=EMBEDDING_MAX_BATCH_SIZE,
+    max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+    max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS,
+    model_failure_retries=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    concurrency=4,
+    ledger=None,
+    tag=None,
+):
+    """
+    Embed one or more texts asynchronously. See embed for details.
+
+    Parameters:
+        concurrency (int, optional): Maximum number of batch requests in flight at once.
+
+    Returns:
+        dict: "embeddings" (numpy array with one row per text), "usage", "cached" and "error".
+    """
+    if np is None:
+        return embedding_error(NUMPY_REQUIRED_ERROR)
+
+    # Settings that are not given come from the default Config
+    config = get_config()
+    model = model or config.embedding_model
+    model_failure_retries = config.model_failure_retries if model_failure_retries is None else model_failure_retries
+    api_key = config.api_key if api_key is None else api_key
+    api_base = config.api_base if api_base is None else api_base
+
+    texts, keys, cache, cached, missing, missing_texts = prepare_embedding(texts, model, cache)
+    batches = plan_embedding_batches(
+        missing_texts, model, batch_size, max_batch_tokens, max_input_tokens
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(batch):
+        async with semaphore:
+            for _ in range(model_failure_retries):
+                try:
+                    return await openai.Embedding.acreate(
+                        model=model, input=[piece for _, piece, _ in batch], api_key=api_key, api_base=api_base
+                    )
+                except Exception as e:
+                    log(f"OpenAI Error: {e}", type="error", log=debug)
+        return None
+
+    responses = await asyncio.gather(*(request(batch) for batch in batches))
+
+    pieces = []
+    usage = {"prompt_tokens": 0, "total_tokens": 0}
+    for batch, response in zip(batches, responses):
+        if response is None:
+            return embedding_error(
+                "Error: Could not get a successful response from OpenAI API"
+            )
+        add_embedding_response(batch, response, pieces, usage)
+
+    log(
+        f"Embedded {len(missing)} texts in {len(batches)} requests, {len(keys) - len(missing)} cached",
+        log=debug,
+    )
+    ledger = get_ledger() if ledger is None else ledger
+    if ledger and batches:
+        ledger.record(model, usage, api_key=api_key, tag=tag)
+    return finish_embedding(keys, cache, cached, missing, pieces, usage)
@@ -0,0 +1,649 @@
+import re
+import enum
+import json
+import math
+import heapq
+import typing
+import inspect
+import threading
+import dataclasses
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .constants import TEXT_MODEL
+from .prompt import count_tokens
+
+try:
+    from typing import is_typeddict
+except ImportError:  # Python < 3.10
+    def is_typeddict(annotation):
+        return isinstance(annotation, type) and issubclass(annotation, dict) and hasattr(annotation, "__total__")
+
+PRIMITIVE_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+# Python types a value of each JSON schema type may have. bool is an int, so it is excluded explicitly.
+JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+    "null": type(None),
+}
+DOCSTRING_SECTIONS = ("args:", "arguments:", "parameters:", "params:")
+# Words are split at case changes, so "getWeather" and "get_weather" both give "get" and "weather"
+TERM_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do for from how i in is it me my of on or please the this that to what with you your".split()
+)
+# BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant, for combining keyword and embedding rankings
+RRF_K = 60
+DOCSTRING_PARAMETER = re.compile(r"^\s*\*{0,2}(\w+)\s*(?:\([^)]*\))?\s*:\s*(.+)$")
+
+
+class CompiledFunctions(list):
+    """
+    A list of function schemas that is already in canonical form, so it is sent as is without being serialized again.
+    """
+
+
+def parse_docstring(obj):
+    """
+    Returns (description, parameter descriptions) from a Google-style docstring.
+    """
+    docstring = inspect.getdoc(obj) or ""
+    if dataclasses.is_dataclass(obj) and docstring.startswith(obj.__name__ + "("):
+        # Generated by dataclass from the signature, it describes nothing
+        docstring = ""
+    description = docstring.split("\n\n")[0].strip().replace("\n", " ")
+    if description.split("\n")[0].lower().split(" ")[0] in DOCSTRING_SECTIONS:
+        description = ""
+    parameters = {}
+    in_section = False
+    name = None
+    for line in docstring.splitlines():
+        stripped = line.strip()
+        if stripped.lower() in DOCSTRING_SECTIONS:
+            in_section = True
+            continue
+        if not in_section:
+            continue
+        if not stripped or (stripped.endswith(":") and " " not in stripped):
+            # A blank line or the next section ends the arguments
+            in_section = False
+            name = None
+            continue
+        match = DOCSTRING_PARAMETER.match(line)
+        if match:
+            name = match.group(1)
+            parameters[name] = match.group(2).strip()
+        elif name is not None:
+            # Continuation of the previous argument's description
+            parameters[name] += " " + stripped
+    return description, parameters
+
+
+def type_schema(annotation):
+    """
+    Returns the JSON schema for a type annotation.
+    """
+    if annotation is inspect.Parameter.empty or annotation is typing.Any:
+        return {}
+    origin = typing.get_origin(annotation)
+    arguments = typing.get_args(annotation)
+
+    if origin is typing.Annotated:
+        schema = dict(type_schema(arguments[0]))
+        descriptions = [metadata for metadata in arguments[1:] if isinstance(metadata, str)]
+        if descriptions:
+            schema["description"] = descriptions[0]
+        return schema
+    if origin is typing.Union or type(annotation).__name__ == "UnionType":
+        options = [argument for argument in arguments if argument is not type(None)]
+        if len(options) == 1:
+            schema = type_schema(options[0])
+        else:
+            schema = {"anyOf": [type_schema(option) for option in options]}
+        if len(options) < len(arguments):
+            schema = nullable_schema(schema)
+        return schema
+    if origin is typing.Literal:
+        schema = {"enum": list(arguments)}
+        types = {PRIMITIVE_TYPES.get(type(argument)) for argument in arguments}
+        if len(types) == 1 and None not in types:
+            schema["type"] = types.pop()
+        return schema
+    if origin in (list, tuple, set, frozenset) or annotation in (list, tuple, set, frozenset):
+        schema = {"type": "array"}
+        if arguments:
+            schema["items"] = type_schema(arguments[0])
+        return schema
+    if origin is dict or annotation is dict:
+        return {"type": "object"}
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        values = [member.value for member in annotation]
+        schema = {"enum": values}
+        types = {PRIMITIVE_TYPES.get(type(value)) for value in values}
+        if len(types) == 1 and None not in types:
+            schema["type"] = types.pop()
+        return schema
+    if dataclasses.is_dataclass(annotation) or is_typeddict(annotation):
+        return object_schema(annotation)[1]
+    if annotation in PRIMITIVE_TYPES:
+        return {"type": PRIMITIVE_TYPES[annotation]}
+    return {}
+
+
+def nullable_schema(schema):
+    """
+    Returns a copy of a schema that also allows null, for Optional[...] types.
+    """
+    if not schema:
+        return schema
+    schema = dict(schema)
+    if "anyOf" in schema:
+        schema["anyOf"] = schema["anyOf"] + [{"type": "null"}]
+        return schema
+    if "enum" in schema:
+        schema["enum"] = schema["enum"] + [None]
+    if isinstance(schema.get("type", None), str):
+        schema["type"] = [schema["type"], "null"]
+    return schema
+
+
+def object_schema(obj):
+    """
+    Returns (description, parameters schema) for a callable, a dataclass or a TypedDict.
+    """
+    description, descriptions = parse_docstring(obj)
+    hints = typing.get_type_hints(obj, include_extras=True)
+
+    if dataclasses.is_dataclass(obj):
+        fields = [
+            (
+                field.name,
+                hints.get(field.name, field.type),
+                field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING,
+                field.metadata.get("description", None),
+            )
+            for field in dataclasses.fields(obj)
+            if field.init
+        ]
+    elif is_typeddict(obj):
+        required_keys = getattr(obj, "__required_keys__", set(hints) if obj.__total__ else set())
+        fields = [(name, annotation, name in required_keys, None) for name, annotation in hints.items()]
+    else:
+        fields = [
+            (
+                name,
+                hints.get(name, inspect.Parameter.empty),
+                parameter.default is inspect.Parameter.empty,
+                None,
+            )
+            for name, parameter in inspect.signature(obj).parameters.items()
+            if name not in ("self", "cls")
+            and parameter.kind not in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD)
+        ]
+
+    properties = {}
+    required = []
+    for name, annotation, is_required, field_description in fields:
+        schema = dict(type_schema(annotation))
+        field_description = field_description or descriptions.get(name, None)
+        if field_description and "description" not in schema:
+            schema["description"] = field_description
+        properties[name] = schema
+        # Optional[...] arguments may be left out, like arguments with defaults
+        if is_required and type(None) not in typing.get_args(annotation):
+            required.append(name)
+    return description, {"type": "object", "properties": properties, "required": required}
+
+
+def function_schema(obj, name=None, description=None):
+    """
+    Derives a function definition, like the ones compose_function returns, from Python types.
+
+    Args:
+        obj: A type-annotated function, a dataclass or a TypedDict. Descriptions come from the docstring:
+            its first paragraph describes the function, and an Args section describes the arguments.
+            Dataclass fields can also be described with field(metadata={"description": ...}),
+            and any argument with Annotated[type, "description"].
+        name (str, optional): The function name. Default is the name of obj.
+        description (str, optional): The function description. Default is the first paragraph of the docstring.
+
+    Returns:
+        A dictionary representing a function.
+
+    Example:
+        >>> def summarize_text(summary: str, topics: list[str]):
+        ...     \"\"\"Summarize the text.\"\"\"
+        >>> function_schema(summarize_text)["parameters"]["required"]
+        ['summary', 'topics']
+    """
+    docstring_description, parameters = object_schema(obj)
+    return {
+        "name": name or obj.__name__,
+        "description": description or docstring_description,
+        "parameters": parameters,
+    }
+
+
+def compile_validator(schema):
+    """
+    Compiles a JSON schema into a function that returns an error for an invalid value, or None.
+
+    Covers the parts of JSON schema used for function arguments: type, enum,
+    properties, required, items and anyOf.
+    """
+    checks = []
+
+    if "anyOf" in schema:
+        options = [compile_validator(option) for option in schema["anyOf"]]
+
+        def check_any(value, path):
+            if all(option(value, path) is not None for option in options):
+                return f"{path} does not match any of the allowed types"
+            return None
+
+        checks.append(check_any)
+
+    expected = schema.get("type", None)
+    # A list of types, e.g. ["string", "null"], allows a value of any of them
+    types = [name for name in (expected if isinstance(expected, list) else [expected]) if name in JSON_TYPES]
+    if types:
+        allowed_types = [
+            (JSON_TYPES[name], name in ("integer", "number"))
+            for name in types
+        ]
+        type_names = " or ".join(types)
+
+        def check_type(value, path):
+            for python_types, exclude_bool in allowed_types:
+                if isinstance(value, python_types) and not (exclude_bool and isinstance(value, bool)):
+                    return None
+            return f"{path} must be of type {type_names}"
+
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value, path):
+            if value not in allowed:
+                return f"{path} must be one of {', '.join(map(str, allowed))}"
+            return None
+
+        checks.append(check_enum)
+
+    if "object" in types:
+        required = schema.get("required", [])
+        properties = {name: compile_validator(property) for name, property in schema.get("properties", {}).items()}
+        closed = schema.get("additionalProperties", True) is False
+
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                return None
+            missing = [name for name in required if name not in value]
+            if missing:
+                return f"Missing required properties: {', '.join(missing)}"
+            if closed:
+                unexpected = [name for name in value if name not in properties]
+                if unexpected:
+                    return f"Unexpected properties: {', '.join(unexpected)}"
+            for name, validate in properties.items():
+                if name in value:
+                    error = validate(value[name], f"{path}.{name}" if path else name)
+                    if error:
+                        return error
+            return None
+
+        checks.append(check_object)
+
+    if "array" in types and "items" in schema:
+        items = compile_validator(schema["items"])
+
+        def check_items(value, path):
+            if not isinstance(value, list):
+                return None
+            for index, item in enumerate(value):
+                error = items(item, f"{path}[{index}]")
+                if error:
+                    return error
+            return None
+
+        checks.append(check_items)
+
+    def validate(value, path=""):
+        for check in checks:
+            error = check(value, path)
+            if error:
+                return error
+        return None
+
+    return validate
+
+
+def compile_converter(annotation):
+    """
+    Compiles a type annotation into a function that converts a JSON value into that type, or None if no conversion is needed.
+
+    Nested dataclasses and enums are constructed, lists are converted item by item.
+    """
+    origin = typing.get_origin(annotation)
+    arguments = typing.get_args(annotation)
+
+    if origin is typing.Annotated:
+        return compile_converter(arguments[0])
+    if origin is typing.Union or type(annotation).__name__ == "UnionType":
+        options = [argument for argument in arguments if argument is not type(None)]
+        convert = compile_converter(options[0]) if len(options) == 1 else None
+        if convert is None:
+            return None
+        return lambda value: None if value is None else convert(value)
+    if origin in (list, tuple, set, frozenset) and arguments:
+        convert = compile_converter(arguments[0])
+        if convert is None and origin is list:
+            return None
+        convert = convert or (lambda item: item)
+        return lambda value: origin(convert(item) for item in value)
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        return annotation
+    if dataclasses.is_dataclass(annotation):
+        fields = arguments_converter(annotation)
+        return lambda value: annotation(**fields(value))
+    return None
+
+
+def arguments_converter(obj):
+    """
+    Compiles a converter for the arguments of a callable or the fields of a dataclass.
+    """
+    hints = typing.get_type_hints(obj, include_extras=True)
+    converters = {name: convert for name, convert in ((name, compile_converter(hint)) for name, hint in hints.items()) if convert}
+    # Fields the model made up would make the dataclass constructor raise
+    names = {field.name for field in dataclasses.fields(obj) if field.init} if dataclasses.is_dataclass(obj) else None
+    if not converters and names is None:
+        return dict
+
+    def convert(arguments):
+        return {
+            name: converters[name](value) if name in converters else value
+            for name, value in arguments.items()
+            if names is None or name in names
+        }
+
+    return convert
+
+
+def index_terms(text):
+    """
+    Splits text into lowercase search terms, without stopwords.
+    """
+    terms = (term.lower() for term in TERM_PATTERN.findall(text))
+    return [term for term in terms if term not in STOPWORDS]
+
+
+def function_text(schema):
+    """
+    Returns the searchable text of a function: its name, description and argument names and descriptions.
+    """
+    parts = [schema["name"], schema.get("description", None) or ""]
+    for name, property in schema.get("parameters", {}).get("properties", {}).items():
+        parts.append(name)
+        if isinstance(property, dict):
+            parts.append(property.get("description", ""))
+    return " ".join(parts)
+
+
+class SearchIndex:
+    """
+    A BM25 index over the functions of a registry.
+    """
+
+    def __init__(self, schemas, embed_function=None):
+        self.names = [schema["name"] for schema in schemas]
+        texts = [function_text(schema) for schema in schemas]
+        self.postings = {}
+        self.lengths = []
+        for position, text in enumerate(texts):
+            terms = index_terms(text)
+            self.lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((position, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.vectors = None
+        if embed_function is not None and texts:
+            vectors = np.asarray(embed_function(texts), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            self.vectors = vectors / np.where(norms == 0, 1, norms)
+
+    def keyword_scores(self, query):
+        scores = {}
+        count = len(self.names)
+        for term in set(index_terms(query)):
+            postings = self.postings.get(term, None)
+            if postings is None:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings:
+                length = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / self.average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + length)
+        return scores
+
+    def search(self, query, k, embed_function=None):
+        """
+        Returns the names of the k functions most relevant to the query, best first.
+        """
+        scores = self.keyword_scores(query)
+        if self.vectors is not None:
+            # Both rankings count, so a function can be found by its wording or by its meaning
+            query_vector = np.asarray(embed_function([query])[0], dtype=np.float32)
+            similarities = self.vectors @ query_vector
+            keyword_ranking = sorted(scores, key=lambda position: -scores[position])
+            scores = {}
+            for rank, position in enumerate(keyword_ranking):
+                scores[position] = 1 / (RRF_K + rank + 1)
+            for rank, position in enumerate(np.argsort(-similarities).tolist()):
+                scores[position] = scores.get(position, 0.0) + 1 / (RRF_K + rank + 1)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [self.names[position] for position, _ in best]
+
+
+class RegisteredFunction:
+    """
+    A function compiled by a FunctionRegistry: its schema, token cost, validator and handler.
+    """
+
+    __slots__ = ("name", "schema", "tokens", "validate", "convert", "handler", "properties")
+
+    def __init__(self, schema, handler=None, convert=dict, model=TEXT_MODEL):
+        # Canonical form, so every request that includes this function serializes it identically
+        self.schema = json.loads(json.dumps(schema, sort_keys=True))
+        self.name = self.schema["name"]
+        self.tokens = count_tokens(json.dumps(self.schema, sort_keys=True), model=model)
+        parameters = self.schema.get("parameters", {"type": "object"})
+        self.validate = compile_validator(parameters)
+        self.convert = convert
+        self.handler = handler
+        # The arguments passed to the handler, or None to pass every argument
+        self.properties = frozenset(parameters["properties"]) if "properties" in parameters else None
+
+
+class FunctionRegistry:
+    """
+    Functions compiled once and reused for every request: schemas, token costs, validators and handlers.
+
+    Pass the registry as functions= to function_completion. Its schemas are
+    sent without being counted or serialized again, and dispatch() calls the
+    Python function the model chose with the validated arguments.
+
+    Usage:
+        registry = FunctionRegistry()
+
+        @registry.register
+        def create_event(title: str, attendees: list[str], duration_minutes: int = 30):
+            \"\"\"Create a calendar event.\"\"\"
+            ...
+
+        result = function_completion(text, functions=registry)
+        registry.dispatch(result)
+    """
+
+    def __init__(self, model=TEXT_MODEL, embed_function=None):
+        """
+        Args:
+            model (str): The model to count tokens for.
+            embed_function (callable, optional): Takes a list of texts and returns their vectors. If set, select()
+                ranks functions by embedding similarity as well as by keywords. Requires numpy.
+        """
+        if embed_function is not None and np is None:
+            raise ImportError("numpy is required to select functions with embeddings")
+        self.model = model
+        self.embed_function = embed_function
+        self.lock = threading.Lock()
+        self.registered = {}
+        self.compiled = CompiledFunctions()
+        self.functions_by_name = {}
+        # Built on the first select() after a change
+        self.search_index = None
+
+    def register(self, obj=None, name=None, description=None, handler=None):
+        """
+        Registers a type-annotated function, dataclass or TypedDict. Can be used as a decorator, with or without arguments.
+
+        The handler that dispatch() calls defaults to the function itself, or to the dataclass,
+        which constructs an instance. TypedDicts have no handler, so dispatch() returns their arguments.
+        """
+        if obj is None:
+            return lambda obj: self.register(obj, name=name, description=description, handler=handler)
+        if handler is None and not is_typeddict(obj):
+            handler = obj
+        convert = dict if is_typeddict(obj) else arguments_converter(obj)
+        self._add(RegisteredFunction(function_schema(obj, name, description), handler, convert, self.model))
+        return obj
+
+    def add(self, function, handler=None):
+        """
+        Registers a function definition, e.g. from compose_function, with an optional handler.
+        """
+        self._add(RegisteredFunction(function, handler, model=self.model))
+        return function
+
+    def _add(self, registered):
+        with self.lock:
+            registered_functions = dict(self.registered)
+            registered_functions[registered.name] = registered
+            # Replaced rather than changed, so requests in flight keep a consistent view
+            self.compiled = CompiledFunctions(
+                registered_functions[name].schema for name in sorted(registered_functions)
+            )
+            self.functions_by_name = {name: registered.schema for name, registered in registered_functions.items()}
+            self.registered = registered_functions
+            self.search_index = None
+
+    @property
+    def functions(self):
+        """
+        The function schemas in canonical order, ready to send.
+        """
+        return self.compiled
+
+    def select(self, query, k=5, include=()):
+        """
+        Returns the k functions most relevant to a query, ranked by BM25 over their names, descriptions and arguments.
+
+        The selection is returned in canonical order, so requests that select the
+        same functions share a cacheable prefix. If no function matches the query
+        at all, every function is returned rather than none.
+
+        Args:
+            query (str): The text of the request.
+            k (int): The number of functions to select.
+            include (list): Names of functions to include regardless, e.g. a forced function_call.
+
+        Returns:
+            CompiledFunctions: The selected function schemas.
+        """
+        index = self.search_index
+        if index is None:
+            with self.lock:
+                if self.search_index is None:
+                    self.search_index = SearchIndex(self.compiled, self.embed_function)
+                index = self.search_index
+        names = index.search(query, k, self.embed_function)
+        if not names:
+            return self.compiled
+        selected = set(names).union(name for name in include if name in self.registered)
+        return CompiledFunctions(schema for schema in self.compiled if schema["name"] in selected)
+
+    def token_count(self, names=None):
+        """
+        Returns the precomputed token cost of the named functions, or of all of them.
+        """
+        registered = self.registered
+        if names is None:
+            return sum(function.tokens for function in registered.values())
+        return sum(registered[name].tokens for name in names)
+
+    def validate(self, name, arguments):
+        """
+        Returns an error if the arguments do not match the function's schema, or None if they do.
+        """
+        function = self.registered.get(name, None)
+        if function is None:
+            return f"There is no function named {name}"
+        return function.validate(arguments)
+
+    def validate_calls(self, calls):
+        """
+        Returns the first error in a list of function calls, as returned by validate_function_calls, or None.
+        """
+        for call in calls:
+            error = self.validate(call["function_name"], call["arguments"])
+            if error:
+                return error
+        return None
+
+    def dispatch(self, result):
+        """
+        Calls the handler of every function call in a function_completion result with its validated arguments.
+
+        Arguments that are not in the function's schema are left out, so properties
+        the model made up can't break the call.
+
+        Returns:
+            dict: "results" (the return value of each call, in order) and "error".
+        """
+        if result.get("error", None):
+            return {"results": None, "error": result["error"]}
+        calls = result.get("function_calls", None) or []
+        error = self.validate_calls(calls)
+        if error:
+            return {"results": None, "error": error}
+        results = []
+        for call in calls:
+            function = self.registered[call["function_name"]]
+            arguments = call["arguments"]
+            if function.properties is not None:
+                arguments = {name: value for name, value in arguments.items() if name in function.properties}
+            arguments = function.convert(arguments)
+            results.append(arguments if function.handler is None else function.handler(**arguments))
+        return {"results": results, "error": None}
+
+    def __len__(self):
+        return len(self.registered)
+
+    def __contains__(self, name):
+        return name in self.registered
+
+    def __iter__(self):
+        return iter(sorted(self.registered))
@@ -0,0 +1,186 @@
+import time
+import hashlib
+import threading
+
+from .constants import MODEL_PRICES, match_model
+
+# Counter positions in each ledger entry
+REQUESTS, PROMPT_TOKENS, COMPLETION_TOKENS, RETRY_TOKENS, COST = range(5)
+COUNTER_NAMES = ("requests", "prompt_tokens", "completion_tokens", "retry_tokens", "cost")
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    """
+    Estimates the cost in USD of a request, using MODEL_PRICES in constants.py.
+
+    Returns:
+        The estimated cost, or 0.0 if the model has no known price.
+    """
+    prices = match_model(MODEL_PRICES, model)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+
+def key_fingerprint(api_key):
+    """
+    Identifies an API key in the ledger without storing the key itself.
+    """
+    if not api_key:
+        return None
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+class UsageLedger:
+    """
+    Aggregates token usage and estimated cost across requests.
+
+    Usage is totalled per model, per API key, per caller tag, and per time
+    window, counting tokens spent on retries separately. Budgets set with
+    set_budget are checked before each request and either stop the request or
+    switch it to a cheaper model. Recording is a few dictionary updates under
+    a lock, so the ledger can stay on for every request.
+
+    Usage:
+        ledger = get_ledger()
+        ledger.set_budget(50.0, per_window=True)  # at most $50 per hour
+        ledger.summary("model")
+    """
+
+    def __init__(self, window=3600, retention=24):
+        self.window = window
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.windows = {}
+        self.budgets = []
+
+    def _add(self, entries, key, counters):
+        entry = entries.get(key, None)
+        if entry is None:
+            entry = entries[key] = [0, 0, 0, 0, 0.0]
+        for i, value in enumerate(counters):
+            entry[i] += value
+
+    def record(self, model, usage, api_key=None, tag=None, retry=False):
+        """
+        Records the usage of one response.
+
+        Args:
+            model (str): The model the request was sent to.
+            usage (dict): The response's usage, with prompt_tokens and completion_tokens.
+            api_key (str | None): The API key the request was sent with.
+            tag (str | None): A caller-chosen label, e.g. a feature or tenant name.
+            retry (bool): True if the request repeated an earlier one, e.g. after an invalid function call.
+        """
+        if usage is None:
+            return
+        prompt_tokens = usage.get("prompt_tokens", 0) or 0
+        completion_tokens = usage.get("completion_tokens", 0) or 0
+        counters = (
+            1,
+            prompt_tokens,
+            completion_tokens,
+            prompt_tokens + completion_tokens if retry else 0,
+            estimate_cost(model, prompt_tokens, completion_tokens),
+        )
+        keys = [("total", None), ("model", model), ("api_key", key_fingerprint(api_key)), ("tag", tag)]
+        window = int(time.time() // self.window) * self.window
+
+        with self.lock:
+            entries = self.windows.get(window, None)
+            if entries is None:
+                entries = self.windows[window] = {}
+                # Forget the oldest windows beyond the retention limit
+                for old in sorted(self.windows)[: -self.retention]:
+                    del self.windows[old]
+            for key in keys:
+                self._add(self.totals, key, counters)
+                self._add(entries, key, counters)
+
+    def summary(self, dimension="total", window=None):
+        """
+        Returns aggregated usage.
+
+        Args:
+            dimension (str): "total", "model", "api_key" or "tag".
+            window (int | None): Start time of a window (a multiple of the window length) or None for all time.
+
+        Returns:
+            A dictionary of dimension value to a dictionary of requests, prompt_tokens,
+            completion_tokens, retry_tokens and cost.
+        """
+        with self.lock:
+            entries = self.totals if window is None else self.windows.get(window, {})
+            return {
+                value: dict(zip(COUNTER_NAMES, counters))
+                for (entry_dimension, value), counters in entries.items()
+                if entry_dimension == dimension
+            }
+
+    def window_summaries(self, dimension="total"):
+        """
+        Returns summary() for every retained window, keyed by window start time.
+        """
+        with self.lock:
+            windows = sorted(self.windows)
+        return {window: self.summary(dimension, window) for window in windows}
+
+    def set_budget(self, limit, dimension="total", value=None, per_window=False, action="stop", downgrade_model=None):
+        """
+        Adds a spending limit that is checked before every request.
+
+        Args:
+            limit (float): Maximum estimated cost in USD.
+            dimension (str): What the limit applies to: "total", "model", "api_key" or "tag".
+            value (str | None): The model, API key or tag the limit applies to. None applies it to each one separately.
+            per_window (bool): If True, the limit applies to each time window rather than all time.
+            action (str): "stop" to reject requests over budget, "downgrade" to send them to downgrade_model.
+            downgrade_model (str | None): The cheaper model to use when action is "downgrade".
+        """
+        if dimension == "api_key" and value is not None:
+            value = key_fingerprint(value)
+        with self.lock:
+            self.budgets.append((limit, dimension, value, per_window, action, downgrade_model))
+
+    def check(self, model, api_key=None, tag=None):
+        """
+        Checks a request against the budgets.
+
+        Returns:
+            A tuple of (model, error). model may be a cheaper model if a budget
+            downgraded the request, error is set if a budget stopped it.
+        """
+        if not self.budgets:
+            return model, None
+        window = int(time.time() // self.window) * self.window
+        with self.lock:
+            for limit, dimension, value, per_window, action, downgrade_model in self.budgets:
+                request_value = {
+                    "total": None,
+                    "model": model,
+                    "api_key": key_fingerprint(api_key),
+                    "tag": tag,
+                }[dimension]
+                if value is not None and value != request_value:
+                    continue
+                entries = self.windows.get(window, {}) if per_window else self.totals
+                entry = entries.get((dimension, request_value), None)
+                if entry is None or entry[COST] < limit:
+                    continue
+                if action == "downgrade" and downgrade_model and downgrade_model != model:
+                    model = downgrade_model
+                    continue
+                scope = dimension if request_value is None else f"{dimension} {request_value}"
+                return model, f"Budget of ${limit} for {scope} exceeded"
+        return model, None
+
+
+default_ledger = UsageLedger()
+
+
+def get_ledger():
+    """
+    Returns the ledger that completions record to unless they are given another one.
+    """
+    return default_ledger
@@ -0,0 +1,247 @@
+import time
+import threading
+
+# Histograms keep 2^PRECISION_BITS buckets per power of two: values are exact below 128 microseconds
+# and within 1.6% above, at a fixed cost per bucket however many samples are recorded
+PRECISION_BITS = 7
+SUB_BUCKETS = 1 << PRECISION_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+
+PHASES = ("prepare", "queue", "network", "validation", "retry_sleep", "total")
+# Bucket boundaries in seconds for the Prometheus export
+PROMETHEUS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def bucket_index(value):
+    """
+    Returns the histogram bucket of a value in microseconds.
+    """
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - PRECISION_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def bucket_upper_bound(index):
+    """
+    Returns the largest value in microseconds that falls in a bucket.
+    """
+    if index < SUB_BUCKETS:
+        return index
+    shift, offset = divmod(index - SUB_BUCKETS, HALF_SUB_BUCKETS)
+    shift += 1
+    return ((offset + HALF_SUB_BUCKETS + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    A log-linear (HDR-style) histogram of durations.
+
+    Recording a value is one dictionary update, and percentiles are accurate
+    to within 1.6% of the value at any scale, from microseconds to minutes.
+    Not thread-safe by itself; LatencyMetrics locks around it.
+    """
+
+    __slots__ = ("counts", "count", "total", "minimum", "maximum")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, seconds):
+        microseconds = max(0, int(seconds * 1_000_000))
+        index = bucket_index(microseconds)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+        if other.maximum is not None and (self.maximum is None or other.maximum > self.maximum):
+            self.maximum = other.maximum
+        return self
+
+    def percentile(self, percentile):
+        """
+        Returns the duration in seconds that percentile percent of the samples are at or below.
+        """
+        if not self.count:
+            return 0.0
+        target = max(1, percentile / 100 * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(bucket_upper_bound(index) / 1_000_000, self.maximum)
+        return self.maximum
+
+    def count_within(self, seconds):
+        """
+        Returns the number of samples at or below a duration, counting a bucket only if all of it is.
+        """
+        limit = int(seconds * 1_000_000)
+        return sum(count for index, count in self.counts.items() if bucket_upper_bound(index) <= limit)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.minimum or 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.maximum or 0.0,
+        }
+
+
+class LatencyMetrics:
+    """
+    Latency histograms for each phase of a completion, per model and backend.
+
+    Phases are "prepare" (sanity checks, token counting and building the
+    request), "queue" (waiting for the scheduler and limiter), "network" (the
+    request itself), "validation" (parsing and validating responses, repairs
+    and building follow-up requests), "retry_sleep" (waiting before retries)
+    and "total" (the whole call).
+
+    Usage:
+        metrics = get_metrics()
+        text_completion("Hello")
+        metrics.summary("network")
+        metrics.slo(2.0, target=0.99)
+        print(metrics.prometheus())
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (phase, model, backend) -> LatencyHistogram
+        self.histograms = {}
+
+    def record(self, phase, seconds, model=None, backend=None):
+        key = (phase, model or "", backend or "")
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def histogram(self, phase="total", model=None, backend=None):
+        """
+        Returns one histogram merging every model and backend that match. None matches all of them.
+        """
+        merged = LatencyHistogram()
+        with self.lock:
+            for (key_phase, key_model, key_backend), histogram in self.histograms.items():
+                if (
+                    key_phase == phase
+                    and (model is None or key_model == model)
+                    and (backend is None or key_backend == backend)
+                ):
+                    merged.merge(histogram)
+        return merged
+
+    def summary(self, phase=None):
+        """
+        Returns count, mean, min, p50, p90, p99, p999 and max (in seconds) for every (phase, model, backend).
+
+        Args:
+            phase (str | None): Only report this phase.
+        """
+        with self.lock:
+            items = [(key, LatencyHistogram().merge(histogram)) for key, histogram in self.histograms.items()]
+        return {key: histogram.summary() for key, histogram in sorted(items) if phase is None or key[0] == phase}
+
+    def slo(self, threshold, target=0.99, phase="total", model=None, backend=None):
+        """
+        Checks a latency objective: that at least target of the calls took at most threshold seconds.
+
+        Returns:
+            dict: "count", "within" (calls at most threshold), "ratio" and "met".
+        """
+        histogram = self.histogram(phase, model, backend)
+        within = histogram.count_within(threshold)
+        ratio = within / histogram.count if histogram.count else 1.0
+        return {"count": histogram.count, "within": within, "ratio": ratio, "met": ratio >= target}
+
+    def prometheus(self, name="easycompletion_latency_seconds"):
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        """
+        with self.lock:
+            items = sorted((key, LatencyHistogram().merge(histogram)) for key, histogram in self.histograms.items())
+        lines = [
+            f"# HELP {name} Latency of each phase of a completion.",
+            f"# TYPE {name} histogram",
+        ]
+        for (phase, model, backend), histogram in items:
+            labels = f'phase="{phase}",model="{escape_label(model)}",backend="{escape_label(backend)}"'
+            for bound in PROMETHEUS_BUCKETS:
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {histogram.count_within(bound)}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PhaseTimer:
+    """
+    Times consecutive phases of one call, recording each to metrics. Does nothing if metrics is falsy.
+    """
+
+    __slots__ = ("metrics", "backend", "model", "started", "phase_started")
+
+    def __init__(self, metrics, backend=None):
+        self.metrics = metrics
+        self.backend = backend
+        self.model = None
+        self.started = self.phase_started = time.perf_counter()
+
+    def record(self, phase):
+        """
+        Records the time since the last phase ended as phase.
+        """
+        now = time.perf_counter()
+        if self.metrics:
+            self.metrics.record(phase, now - self.phase_started, self.model, self.backend)
+        self.phase_started = now
+
+    def skip(self):
+        """
+        Starts the next phase now, without recording the time since the last one.
+        """
+        self.phase_started = time.perf_counter()
+
+    def finish(self):
+        if self.metrics:
+            self.metrics.record("total", time.perf_counter() - self.started, self.model, self.backend)
+
+
+default_metrics = LatencyMetrics()
+
+
+def get_metrics():
+    """
+    Returns the shared LatencyMetrics that completions record to by default.
+    """
+    return default_metrics
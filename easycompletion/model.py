@@ -1,10 +1,10 @@
 import os
 import time
-import openai
 import re
 import json
 import ast
 import asyncio
+from contextlib import nullcontext
 
 from dotenv import load_dotenv
 
@@ -12,19 +12,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from .constants import (
-    EASYCOMPLETION_API_ENDPOINT,
     TEXT_MODEL,
-    LONG_TEXT_MODEL,
-    EASYCOMPLETION_API_KEY,
-    DEFAULT_CHUNK_LENGTH,
     DEBUG,
+    CONTEXT_WINDOWS,
+    DEFAULT_CONTEXT_WINDOW,
+    CONTINUE_PROMPT,
+    match_model,
 )
 
 from .logger import log
 
 from .prompt import count_tokens
-
-openai.api_base = EASYCOMPLETION_API_ENDPOINT
+from .scheduler import RequestRejected, resolve_priority
+from .results import Usage, CompletionResult, FunctionCallResult
+from .ledger import get_ledger
+from .prefix import canonical_functions, describe_prefix
+from .backends import get_backend
+from .functions import FunctionRegistry
+from .config import get_config
+from .metrics import PhaseTimer, get_metrics
 
 def parse_arguments(arguments, debug=DEBUG):
     """
@@ -64,83 +70,231 @@ def parse_arguments(arguments, debug=DEBUG):
     return arguments
 
 
-def validate_functions(response, functions, function_call, debug=DEBUG):
+def normalize_key(key):
+    """
+    Normalizes a property or function name for loose matching: "Song-Lyrics" and "song_lyrics" both become "songlyrics".
+    """
+    return re.sub(r"[^a-z0-9]", "", str(key).lower())
+
+
+def fix_json(arguments):
     """
-    Validates if the function returned matches the intended function call.
+    Fixes common problems in JSON written by a model: code fences, text around
+    the object, trailing commas and output that was cut off before the end.
 
     Parameters:
-        response (dict): The response from the model.
-        functions (list): A list of function definitions.
-        function_call (dict or str): The expected function call.
+        arguments (str): The JSON string to fix.
 
     Returns:
-        True if function call matches with the response, False otherwise.
+        The fixed string. It is not guaranteed to be valid JSON.
 
     Usage:
-        isValid = validate_functions(response, functions, function_call)
+        fix_json('```json {"a": [1, 2,')
+        Output: '{"a": [1, 2]}'
     """
-    print('response')
-    print(response)
-    response_function_call = response["choices"][0]["message"].get(
-        "function_call", None
-    )
-    if response_function_call is None:
-        log(f"No function call in response\n{response}", type="error", log=debug)
-        return False
+    # Strip markdown code fences and anything outside the outermost object
+    arguments = re.sub(r"```[a-zA-Z]*", "", arguments)
+    start = arguments.find("{")
+    if start != -1:
+        arguments = arguments[start:]
+    end = arguments.rfind("}")
+    if end != -1 and arguments[: end + 1].count("{") <= arguments[: end + 1].count("}"):
+        arguments = arguments[: end + 1]
+
+    # Close any strings, arrays and objects left open by truncated output
+    closers = []
+    in_string = False
+    escaped = False
+    for char in arguments:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if in_string:
+        arguments += '"'
+    arguments = arguments.rstrip().rstrip(",") + "".join(reversed(closers))
+
+    # Remove trailing commas before closing brackets
+    return re.sub(r",\s*([}\]])", r"\1", arguments)
+
+
+def coerce_value(value, schema):
+    """
+    Converts a value to the JSON schema type it should have, where that can be done safely.
 
-    # If function_call is not "auto" and the name does not match with the response, return False
-    if (
-        function_call != "auto"
-        and response_function_call["name"] != function_call["name"]
-    ):
-        log("Function call does not match", type="error", log=debug)
-        return False
+    Returns:
+        The converted value, or the value unchanged if it cannot be converted.
+    """
+    expected = schema.get("type", None) if isinstance(schema, dict) else None
+    if isinstance(expected, list):
+        # A nullable type, e.g. ["string", "null"]: null is kept, anything else is coerced to the other type
+        if value is None:
+            return value
+        expected = next((name for name in expected if name != "null"), None)
+    try:
+        if expected == "string" and isinstance(value, (int, float, bool)):
+            return json.dumps(value) if isinstance(value, bool) else str(value)
+        if expected == "integer" and isinstance(value, str):
+            return int(value.strip())
+        if expected == "integer" and isinstance(value, float) and value.is_integer():
+            return int(value)
+        if expected == "number" and isinstance(value, str):
+            return float(value.strip())
+        if expected == "boolean" and isinstance(value, str):
+            lowered = value.strip().lower()
+            if lowered in ("true", "yes", "1"):
+                return True
+            if lowered in ("false", "no", "0"):
+                return False
+        if expected == "array":
+            if isinstance(value, str):
+                parsed = parse_arguments(value)
+                value = parsed if isinstance(parsed, list) else [value]
+            elif not isinstance(value, list):
+                value = [value]
+            return [coerce_value(item, schema.get("items", {})) for item in value]
+        if expected == "object" and isinstance(value, str):
+            parsed = parse_arguments(fix_json(value))
+            return parsed if isinstance(parsed, dict) else value
+    except (ValueError, TypeError):
+        pass
+    return value
+
+
+def repair_arguments(arguments, function, debug=DEBUG):
+    """
+    Repairs function call arguments locally, without asking the model again.
 
-    # If function_call is "auto", extract the name from the response
-    function_call_name = (
-        function_call["name"]
-        if function_call != "auto"
-        else response_function_call["name"]
-    )
+    Fixes broken JSON, maps keys to the schema's property names when they only
+    differ in case or punctuation, and coerces values to the property types.
 
-    # Parse the arguments from the response
-    arguments = parse_arguments(response_function_call["arguments"])
+    Parameters:
+        arguments (str or dict): The arguments from the function call.
+        function (dict): The function definition the arguments are for.
 
-    # Get the function that matches the function name from the list of functions
-    function = next(
-        (item for item in functions if item["name"] == function_call_name), None
-    )
+    Returns:
+        A dictionary of repaired arguments, or None if they could not be parsed.
 
-    # If no matching function is found, return False
+    Usage:
+        repair_arguments('{"Count": "3",}', function)
+        Output: {"count": 3}
+    """
+    if isinstance(arguments, str):
+        parsed = parse_arguments(arguments)
+        if not isinstance(parsed, dict):
+            parsed = parse_arguments(fix_json(arguments))
+        arguments = parsed
+    if not isinstance(arguments, dict):
+        return None
+
+    properties = function["parameters"].get("properties", {})
+    property_names = {normalize_key(name): name for name in properties}
+    repaired = {}
+    for key, value in arguments.items():
+        if key not in properties:
+            key = property_names.get(normalize_key(key), key)
+        repaired[key] = coerce_value(value, properties.get(key, {}))
+
+    log(f"Repaired arguments:\n{str(repaired)}", log=debug)
+    return repaired
+
+
+def get_function_calls(response):
+    """
+    Returns every function call in a response.
+
+    Handles both responses with parallel tool calls ("tool_calls") and the
+    single "function_call" format.
+
+    Parameters:
+        response (dict): The response from the model.
+
+    Returns:
+        A list of dictionaries with "id", "name" and "arguments" (unparsed) keys.
+    """
+    message = response["choices"][0]["message"]
+    tool_calls = message.get("tool_calls", None)
+    if tool_calls:
+        return [
+            {
+                "id": tool_call.get("id", None),
+                "name": tool_call["function"]["name"],
+                "arguments": tool_call["function"]["arguments"],
+            }
+            for tool_call in tool_calls
+            if tool_call.get("type", "function") == "function"
+        ]
+    function_call = message.get("function_call", None)
+    if function_call is None:
+        return []
+    return [
+        {
+            "id": None,
+            "name": function_call["name"],
+            "arguments": function_call["arguments"],
+        }
+    ]
+
+
+def validate_function_call(call, functions_by_name, function_call, debug=DEBUG):
+    """
+    Validates a single function call against the function definitions.
+
+    Parameters:
+        call (dict): A function call as returned by get_function_calls.
+        functions_by_name (dict): Function definitions indexed by name.
+        function_call (dict or str): The expected function call, or "auto".
+
+    Returns:
+        A tuple of (arguments, error). arguments is the parsed arguments if the
+        call is valid, error is a description of the problem otherwise.
+    """
+    # If function_call is not "auto" and the name does not match with the response, the call is invalid
+    if function_call != "auto" and call["name"] != function_call["name"]:
+        log("Function call does not match", type="error", log=debug)
+        return None, f"Expected a call to {function_call['name']}, got {call['name']}"
+
+    # Get the function that matches the function name
+    function = functions_by_name.get(call["name"], None)
     if function is None:
         log(
             "No matching function found"
-            + f"\nExpected function name:\n{str(function_call_name)}"
-            + f"\n\nResponse:\n{str(response)}",
+            + f"\nExpected function name:\n{str(call['name'])}",
             type="error",
             log=debug,
         )
-        return False
+        return None, f"There is no function named {call['name']}"
 
-    # If arguments are None, return False
-    if arguments is None:
+    # Parse the arguments from the response
+    arguments = parse_arguments(call["arguments"])
+    if not isinstance(arguments, dict):
         log(
             "Arguments are None"
             + f"\nExpected arguments:\n{str(function['parameters']['properties'].keys())}"
-            + f"\n\nResponse function call:\n{str(response_function_call)}",
+            + f"\n\nResponse function call:\n{str(call)}",
             type="error",
             log=debug,
         )
-        #
-        return False
+        return None, "The arguments are not a valid JSON object"
 
     required_properties = function["parameters"].get("required", [])
 
     # Check that arguments.keys() contains all of the required properties
-    if not all(
-        required_property in arguments.keys()
+    missing_properties = [
+        required_property
         for required_property in required_properties
-    ):
+        if required_property not in arguments
+    ]
+    if missing_properties:
         log(
             "ERROR: Response did not contain all required properties.\n"
             + f"\nExpected keys:\n{str(function['parameters']['properties'].keys())}"
@@ -148,25 +302,162 @@ def validate_functions(response, functions, function_call, debug=DEBUG):
             type="error",
             log=debug,
         )
+        return None, f"Missing required properties: {', '.join(missing_properties)}"
+
+    return arguments, None
 
-        return False
+
+def validate_function_calls(response, functions_by_name, function_call, debug=DEBUG):
+    """
+    Validates every function call in a response in one pass.
+
+    Parameters:
+        response (dict): The response from the model.
+        functions_by_name (dict): Function definitions indexed by name.
+        function_call (dict or str): The expected function call, or "auto".
+
+    Returns:
+        A tuple of (calls, error). On success calls is a list of dictionaries with
+        "id", "function_name" and "arguments" (parsed) and error is None.
+    """
+    response_calls = get_function_calls(response)
+    if not response_calls:
+        log(f"No function call in response\n{response}", type="error", log=debug)
+        return None, "No function call in response"
+
+    calls = []
+    for call in response_calls:
+        arguments, error = validate_function_call(
+            call, functions_by_name, function_call, debug=debug
+        )
+        if error:
+            return None, error
+        calls.append(
+            {"id": call["id"], "function_name": call["name"], "arguments": arguments}
+        )
 
     log("Function call is valid", type="success", log=debug)
-    return True
+    return calls, None
 
-def sanity_check(prompt, model=None, chunk_length=DEFAULT_CHUNK_LENGTH, api_key=EASYCOMPLETION_API_KEY, debug=DEBUG):
-    # Validate the API key
-    if not api_key.strip():
-        return model, {"error": "Invalid OpenAI API key"}
 
-    openai.api_key = api_key
+def repair_function_calls(response, functions_by_name, function_call, debug=DEBUG):
+    """
+    Repairs and validates every function call in a response. See repair_arguments.
+
+    Function names that only differ from a known function in case or punctuation are corrected too.
+
+    Returns:
+        A tuple of (calls, error), as returned by validate_function_calls.
+    """
+    response_calls = get_function_calls(response)
+    if not response_calls:
+        return None, "No function call in response"
+
+    function_names = {normalize_key(name): name for name in functions_by_name}
+    calls = []
+    for call in response_calls:
+        name = call["name"]
+        if name not in functions_by_name:
+            name = function_names.get(normalize_key(name), name)
+        function = functions_by_name.get(name, None)
+        if function is None:
+            return None, f"There is no function named {call['name']}"
+        arguments, error = validate_function_call(
+            {"id": call["id"], "name": name, "arguments": repair_arguments(call["arguments"], function, debug=debug)},
+            functions_by_name,
+            function_call,
+            debug=debug,
+        )
+        if error:
+            return None, error
+        calls.append({"id": call["id"], "function_name": name, "arguments": arguments})
+
+    log("Function call is valid after repair", type="success", log=debug)
+    return calls, None
+
+
+def correction_messages(response, error):
+    """
+    Builds the messages for a follow-up turn that tells the model why its function call was invalid.
+
+    Parameters:
+        response (dict): The response with the invalid function call.
+        error (str): The validation error.
+
+    Returns:
+        A list of messages to append to the conversation.
+    """
+    message = response["choices"][0]["message"]
+    instruction = f"Error: {error}. Call the function again with corrected arguments."
+    if message.get("tool_calls"):
+        # Every tool call must be answered before the next assistant turn
+        return [
+            {"role": "assistant", "content": message.get("content"), "tool_calls": message["tool_calls"]},
+        ] + [
+            {"role": "tool", "tool_call_id": tool_call["id"], "content": instruction}
+            for tool_call in message["tool_calls"]
+        ]
+    if message.get("function_call"):
+        return [
+            {"role": "assistant", "content": message.get("content"), "function_call": message["function_call"]},
+            {"role": "function", "name": message["function_call"]["name"], "content": instruction},
+        ]
+    return [
+        {"role": "assistant", "content": message.get("content") or ""},
+        {"role": "user", "content": "Respond by calling one of the functions."},
+    ]
+
+
+def validate_functions(response, functions, function_call, debug=DEBUG):
+    """
+    Validates if the function calls returned match the intended function call.
+
+    Parameters:
+        response (dict): The response from the model.
+        functions (list or dict): A list of function definitions, or definitions indexed by name.
+        function_call (dict or str): The expected function call.
+
+    Returns:
+        True if every function call in the response is valid, False otherwise.
+
+    Usage:
+        isValid = validate_functions(response, functions, function_call)
+    """
+    if isinstance(functions, list):
+        functions = {function["name"]: function for function in functions}
+    calls, error = validate_function_calls(response, functions, function_call, debug=debug)
+    return error is None
+
+
+def sanity_check(prompt, model=None, chunk_length=None, api_key=None, debug=DEBUG, require_api_key=True,
+                 extra_tokens=0, long_text_model=None):
+    """
+    Validates the API key and prompt length, switching to the long text model if needed.
+
+    The key is only checked here: it is sent with each request rather than set
+    globally on the openai module, so calls with different keys can run at once.
+
+    Args:
+        extra_tokens (int): Tokens already counted elsewhere, such as the precomputed cost of registered functions.
+        long_text_model (str | None): The model to switch to for long prompts. Default is the Config's long_text_model.
+
+    Returns:
+        A tuple of (model, error, prompt token count).
+    """
+    config = get_config()
+    api_key = config.api_key if api_key is None else api_key
+    chunk_length = config.chunk_length if chunk_length is None else chunk_length
+
+    # Validate the API key
+    if require_api_key and (not api_key or not api_key.strip()):
+        return model, {"error": "Invalid OpenAI API key"}, 0
 
     # Count tokens in the input text
-    total_tokens = count_tokens(prompt, model=model)
+    total_tokens = count_tokens(prompt, model=model) + extra_tokens
 
     # If text is longer than chunk_length and model is not for long texts, switch to the long text model
     if total_tokens > chunk_length and "16k" not in model:
-        model = LONG_TEXT_MODEL
+        model = config.long_text_model if long_text_model is None else long_text_model
         if not os.environ.get("SUPPRESS_WARNINGS"):
             print(
                 "Warning: Message is long. Using 16k model (to hide this message, set SUPPRESS_WARNINGS=1)"
@@ -180,309 +471,475 @@ def sanity_check(prompt, model=None, chunk_length=DEFAULT_CHUNK_LENGTH, api_key=
             "usage": None,
             "finish_reason": None,
             "error": "Message too long",
-        }
+        }, total_tokens
 
-    if isinstance(prompt, dict):
+    # Counting each part again is only worth it when it is logged
+    if debug and isinstance(prompt, dict):
         for key, value in prompt.items():
             if value:
                 log(f"Prompt {key} ({count_tokens(value)} tokens):\n{str(value)}", type="prompt", log=debug)
-    else:
+    elif debug:
         log(f"Prompt ({total_tokens} tokens):\n{str(prompt)}", type="prompt", log=debug)
 
-    return model, None
+    return model, None, total_tokens
 
-def do_chat_completion(
-        messages, model=TEXT_MODEL, temperature=0.8, functions=None, function_call=None, model_failure_retries=5, debug=DEBUG):
-    # Try to make a request for a specified number of times
-    response = None
-    for i in range(model_failure_retries):
-        try:
-            if functions is not None:
-                response = openai.ChatCompletion.create(
-                    model=model, messages=messages, temperature=temperature,
-                    functions=functions, function_call=function_call,
-                )
-            else:
-                response = openai.ChatCompletion.create(
-                    model=model, messages=messages, temperature=temperature
-                )
-            print('response')
-            print(response)
-            break
-        except Exception as e:
-            log(f"OpenAI Error: {e}", type="error", log=debug)
 
-    # If response is not valid, print an error message and return None
+def output_budget(model, messages, prompt_tokens, max_tokens):
+    """
+    Returns the max_tokens to send: the requested limit, capped to what is left of the model's context window.
+
+    Args:
+        max_tokens: A number of tokens, "auto" for all of the remaining context window, or None for no limit.
+    """
+    if max_tokens is None:
+        return None
+    # Each message costs a few tokens on top of its content
+    remaining = match_model(CONTEXT_WINDOWS, model, DEFAULT_CONTEXT_WINDOW) - prompt_tokens - 4 * len(messages) - 3
+    return remaining if max_tokens == "auto" else min(max_tokens, remaining)
+
+
+def error_response(error):
+    return {
+        "text": None,
+        "usage": None,
+        "finish_reason": None,
+        "error": error,
+    }
+
+
+def build_chat_request(
+        messages, model=TEXT_MODEL, temperature=0.8, functions=None, function_call=None, parallel_calls=False,
+        max_tokens=None, stop=None):
+    """
+    Builds the keyword arguments for a chat completion request.
+
+    Functions are put in canonical order, so requests with the same functions
+    and system message share a byte-identical prefix that providers can cache.
+    """
+    request = {"model": model, "messages": messages, "temperature": temperature}
+    functions = canonical_functions(functions)
+    if functions is not None and parallel_calls:
+        # Tools let the model return several function calls in one response
+        request["tools"] = [{"type": "function", "function": function} for function in functions]
+        request["tool_choice"] = function_call if function_call == "auto" else {"type": "function", "function": function_call}
+    elif functions is not None:
+        request["functions"] = functions
+        request["function_call"] = function_call
+    if max_tokens is not None:
+        request["max_tokens"] = max_tokens
+    if stop is not None:
+        request["stop"] = stop
+    return request
+
+
+def check_chat_response(response):
+    # If response is not valid, return an error
     if (
         response is None
         or response["choices"] is None
         or response["choices"][0] is None
     ):
-        return None, {
-            "text": None,
-            "usage": None,
-            "finish_reason": None,
-            "error": "Error: Could not get a successful response from OpenAI API",
-        }
+        return None, error_response("Error: Could not get a successful response from OpenAI API")
     return response, None
 
-def chat_completion(
-    messages,
-    model_failure_retries=5,
-    model=None,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
-    api_key=EASYCOMPLETION_API_KEY,
-    debug=DEBUG,
-    temperature=0.0,
-):
-    """
-    Function for sending chat messages and returning a chat response.
-
-    Parameters:
-        messages (str): Messages to send to the model. In the form {<role>: string, <content>: string} - roles are "user" and "assistant"
-        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
-        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
-        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
-        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
-
-    Returns:
-        str: The response content from the model.
 
-    Example:
-        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+def time_left(deadline):
     """
-    openai.api_key = api_key
-
-    # Use the default model if no model is specified
-    model = model or TEXT_MODEL
-    model, error = sanity_check(messages, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug)
-    if error:
-        return error
+    Returns the seconds left before a time.monotonic() deadline, or None if there is no deadline.
+    """
+    return None if deadline is None else deadline - time.monotonic()
 
-    # Try to make a request for a specified number of times
-    response, error = do_chat_completion(
-        model=model, messages=messages, temperature=temperature, model_failure_retries=model_failure_retries, debug=debug)
 
-    if error:
-        return error
+def resolve_deadline(deadline=None, timeout=None):
+    """
+    Returns the earlier of a deadline and a timeout in seconds from now, or None if neither is set.
+    """
+    if timeout is None:
+        return deadline
+    timeout_deadline = time.monotonic() + timeout
+    return timeout_deadline if deadline is None else min(deadline, timeout_deadline)
 
-    # Extract content from the response
-    text = response["choices"][0]["message"]["content"]
-    finish_reason = response["choices"][0]["finish_reason"]
-    usage = response["usage"]
 
-    return {
-        "text": text,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
+def deadline_response():
+    return error_response("Error: Deadline passed before a response was received")
 
 
-async def chat_completion_async(
-    messages,
-    model_failure_retries=5,
-    model=None,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
-    api_key=EASYCOMPLETION_API_KEY,
-    debug=DEBUG,
-    temperature=0.0,
-):
+def record_send(metrics, request, backend, queued, sent):
     """
-    Function for sending chat messages and returning a chat response.
-
-    Parameters:
-        messages (str): Messages to send to the model. In the form {<role>: string, <content>: string} - roles are "user" and "assistant"
-        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
-        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
-        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
-        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+    Records how long a request waited for its turn, and how long the backend took to answer it.
+    """
+    if metrics:
+        now = time.perf_counter()
+        metrics.record("queue", sent - queued, request["model"], backend.name)
+        metrics.record("network", now - sent, request["model"], backend.name)
 
-    Returns:
-        str: The response content from the model.
 
-    Example:
-        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+def send_chat_request(
+        request, model_failure_retries=None, debug=DEBUG, limiter=None, scheduler=None, priority="default", tenant=None,
+        deadline=None, backend=None, api_key=None, api_base=None, metrics=None):
     """
+    Sends a chat completion request, retrying failed requests.
 
-    # Use the default model if no model is specified
-    model = model or TEXT_MODEL
-    model, error = sanity_check(messages, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug)
-    if error:
-        return error
+    Settings that are None are taken from the default Config. The time each
+    attempt waits for the scheduler and limiter, and the time the backend takes,
+    are recorded to metrics (default get_metrics(), False disables it).
 
-    # Try to make a request for a specified number of times
-    response, error = await asyncio.to_thread(lambda: do_chat_completion(
-        model=model, messages=messages, temperature=temperature, model_failure_retries=model_failure_retries, debug=debug))
+    With a deadline, waiting for the scheduler and limiter and each HTTP request
+    are cut off when it passes, and no attempt is started after it.
 
-    if error:
-        return error
+    Returns:
+        A tuple of (response, error).
+    """
+    backend = get_backend(backend)
+    metrics = get_metrics() if metrics is None else metrics
+    if model_failure_retries is None:
+        model_failure_retries = get_config().model_failure_retries
+    if scheduler is not None:
+        # An invalid priority is the caller's mistake, retrying would not fix it
+        try:
+            priority = resolve_priority(priority)
+        except ValueError as e:
+            log(str(e), type="error", log=debug)
+            return None, error_response(str(e))
+    response = None
+    for i in range(model_failure_retries):
+        if deadline is not None and time_left(deadline) <= 0:
+            log("Deadline passed, not sending request", type="warning", log=debug)
+            return None, deadline_response()
+        queued = time.perf_counter()
+        try:
+            # The scheduler decides when it is this request's turn, the limiter
+            # holds a slot for it and learns from its latency and errors
+            with scheduler.slot(priority, tenant, deadline) if scheduler is not None else nullcontext():
+                with limiter.slot(deadline) if limiter is not None else nullcontext():
+                    sent = time.perf_counter()
+                    try:
+                        response = backend.create(
+                            request, api_key=api_key, api_base=api_base, timeout=time_left(deadline))
+                    finally:
+                        record_send(metrics, request, backend, queued, sent)
+            break
+        except RequestRejected as e:
+            log(f"Request rejected: {e}", type="warning", log=debug)
+            return None, error_response(str(e))
+        except Exception as e:
+            log(f"{backend.name} error: {e}", type="error", log=debug)
+    if response is None and deadline is not None and time_left(deadline) <= 0:
+        return None, deadline_response()
+    return check_chat_response(response)
 
-    # Extract content from the response
-    text = response["choices"][0]["message"]["content"]
-    finish_reason = response["choices"][0]["finish_reason"]
-    usage = response["usage"]
 
-    return {
-        "text": text,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
+async def send_chat_request_async(
+        request, model_failure_retries=None, debug=DEBUG, limiter=None, scheduler=None, priority="default", tenant=None,
+        deadline=None, backend=None, api_key=None, api_base=None, metrics=None):
+    """
+    Sends a chat completion request without blocking the event loop. See send_chat_request.
+    """
+    backend = get_backend(backend)
+    metrics = get_metrics() if metrics is None else metrics
+    if model_failure_retries is None:
+        model_failure_retries = get_config().model_failure_retries
+    if scheduler is not None:
+        # An invalid priority is the caller's mistake, retrying would not fix it
+        try:
+            priority = resolve_priority(priority)
+        except ValueError as e:
+            log(str(e), type="error", log=debug)
+            return None, error_response(str(e))
+    response = None
+    for i in range(model_failure_retries):
+        if deadline is not None and time_left(deadline) <= 0:
+            log("Deadline passed, not sending request", type="warning", log=debug)
+            return None, deadline_response()
+        queued = time.perf_counter()
+        try:
+            async with scheduler.slot(priority, tenant, deadline) if scheduler is not None else nullcontext():
+                async with limiter.slot(deadline) if limiter is not None else nullcontext():
+                    sent = time.perf_counter()
+                    try:
+                        # Cancelling the request at the deadline closes its connection instead of leaving it open
+                        timeout = time_left(deadline)
+                        response = await asyncio.wait_for(
+                            backend.acreate(request, api_key=api_key, api_base=api_base, timeout=timeout), timeout)
+                    finally:
+                        record_send(metrics, request, backend, queued, sent)
+            break
+        except RequestRejected as e:
+            log(f"Request rejected: {e}", type="warning", log=debug)
+            return None, error_response(str(e))
+        except Exception as e:
+            log(f"{backend.name} error: {e}", type="error", log=debug)
+    if response is None and deadline is not None and time_left(deadline) <= 0:
+        return None, deadline_response()
+    return check_chat_response(response)
 
 
-def text_completion(
-    text,
-    model_failure_retries=5,
-    model=None,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
-    api_key=EASYCOMPLETION_API_KEY,
-    debug=DEBUG,
-    temperature=0.0,
-):
+def do_chat_completion(
+        messages, model=TEXT_MODEL, temperature=0.8, functions=None, function_call=None, model_failure_retries=None, debug=DEBUG,
+        parallel_calls=False, limiter=None, scheduler=None, priority="default", tenant=None, deadline=None,
+        backend=None, api_key=None, api_base=None):
+    request = build_chat_request(messages, model, temperature, functions, function_call, parallel_calls)
+    return send_chat_request(
+        request, model_failure_retries, debug, limiter, scheduler, priority, tenant, deadline, backend, api_key, api_base)
+
+
+async def do_chat_completion_async(
+        messages, model=TEXT_MODEL, temperature=0.8, functions=None, function_call=None, model_failure_retries=None, debug=DEBUG,
+        parallel_calls=False, limiter=None, scheduler=None, priority="default", tenant=None, deadline=None,
+        backend=None, api_key=None, api_base=None):
+    request = build_chat_request(messages, model, temperature, functions, function_call, parallel_calls)
+    return await send_chat_request_async(
+        request, model_failure_retries, debug, limiter, scheduler, priority, tenant, deadline, backend, api_key, api_base)
+
+
+# The completions below are written once, as generators that do no I/O of their
+# own. They yield ("request", request_kwargs) to send a chat request and receive
+# (response, error) back, or ("sleep", seconds) to wait, and return the result.
+# A request that repeats failed work, such as resending after an invalid
+# function call, is yielded as ("retry", request_kwargs) so its usage is
+# recorded as retry tokens; it is sent the same way.
+# run_completion and run_completion_async carry out those steps with blocking
+# and non-blocking I/O respectively.
+
+
+def budget_request(request, ledger, api_key, tag):
     """
-    Function for sending text and returning a text completion response.
-
-    Parameters:
-        text (str): Text to send to the model.
-        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
-        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
-        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
-        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+    Checks a request against the ledger's budgets, switching its model if a budget downgrades it.
 
     Returns:
-        str: The response content from the model.
-
-    Example:
-        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+        A tuple of (request, result). result is set to an error if a budget stopped the request.
     """
-
-    # Use the default model if no model is specified
-    model = model or TEXT_MODEL
-    model, error = sanity_check(text, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug)
+    if not ledger:
+        return request, None
+    model, error = ledger.check(request["model"], api_key=api_key, tag=tag)
     if error:
-        return error
-
-    # Prepare messages for the API call
-    messages = [{"role": "user", "content": text}]
+        return request, (None, error_response(error))
+    if model != request["model"]:
+        request = {**request, "model": model}
+    return request, None
 
-    # Try to make a request for a specified number of times
-    response, error = do_chat_completion(
-        model=model, messages=messages, temperature=temperature, model_failure_retries=model_failure_retries, debug=debug)
-    if error:
-        return error
 
-    # Extract content from the response
-    text = response["choices"][0]["message"]["content"]
-    finish_reason = response["choices"][0]["finish_reason"]
-    usage = response["usage"]
+def record_usage(ledger, request, result, api_key, tag, retry):
+    response, error = result
+    if ledger and response is not None:
+        ledger.record(request["model"], response.get("usage", None), api_key=api_key, tag=tag, retry=retry)
 
-    return {
-        "text": text,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
 
-async def text_completion_async(
-    text,
-    model_failure_retries=5,
-    model=None,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
-    api_key=EASYCOMPLETION_API_KEY,
-    debug=DEBUG,
-    temperature=0.0,
-):
+def cache_query(text, model, temperature, **context):
     """
-    Function for sending text and returning a text completion response.
-
-    Parameters:
-        text (str): Text to send to the model.
-        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
-        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
-        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
-        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+    Returns the (prompt, context) a completion is cached under. The context holds everything else the response depends on.
+    """
+    if isinstance(context.get("functions", None), FunctionRegistry):
+        context["functions"] = context["functions"].functions
+    return text, dict(model=model or get_config().text_model, temperature=temperature, **context)
 
-    Returns:
-        str: The response content from the model.
 
-    Example:
-        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+def run_completion(completion, ledger=None, tag=None, api_key=None, cache=None, query=None, metrics=None, **transport):
     """
+    Runs a completion generator, sending its requests and sleeps with blocking I/O.
 
+    Parameters:
+        completion (generator): A completion generator such as text_completion_steps(...).
+        ledger (UsageLedger | False | None): Ledger to check budgets against and record usage to.
+            None uses the default ledger, False disables it.
+        tag (str | None): Label to record usage under.
+        api_key (str | None): The API key to send requests with, also used to record usage per key.
+            Default is the key in the default Config.
+        cache (SemanticCache | None): Cache to serve the result from, and to store it in.
+        query (tuple | None): The (prompt, context) from cache_query to look the result up by.
+        metrics (LatencyMetrics | False | None): Metrics to record the time of each phase of the call to.
+            None uses get_metrics(), False disables them.
+        **transport: Keyword arguments for send_chat_request.
+    """
+    if cache is not None:
+        lookup = cache.lookup(*query, api_key=api_key)
+        if lookup[0] is not None:
+            completion.close()
+            return lookup[0]
+    ledger = get_ledger() if ledger is None else ledger
+    api_key = get_config().api_key if api_key is None else api_key
+    metrics = get_metrics() if metrics is None else metrics
+    deadline = transport.get("deadline", None)
+    timer = PhaseTimer(metrics, get_backend(transport.get("backend", None)).name)
+    # Time spent in the generator is preparing the first request, and validating responses after that
+    phase = "prepare"
+    try:
+        step, value = next(completion)
+        while True:
+            if step != "sleep":
+                timer.model = value["model"]
+            timer.record(phase)
+            if step == "sleep":
+                # Sleeping past the deadline would only delay the timeout error
+                time.sleep(value if deadline is None else max(0, min(value, time_left(deadline))))
+                timer.record("retry_sleep")
+                result = None
+            else:
+                request, result = budget_request(value, ledger, api_key, tag)
+                if result is None:
+                    result = send_chat_request(request, api_key=api_key, metrics=metrics, **transport)
+                    record_usage(ledger, request, result, api_key, tag, retry=step == "retry")
+                # Queue and network time are recorded by send_chat_request
+                timer.skip()
+            phase = "validation"
+            step, value = completion.send(result)
+    except StopIteration as stop:
+        result = stop.value
+    timer.record(phase)
+    timer.finish()
+    if cache is not None:
+        cache.store(lookup, result)
+    return result
+
+
+async def run_completion_async(completion, ledger=None, tag=None, api_key=None, cache=None, query=None, metrics=None, **transport):
+    """
+    Runs a completion generator without blocking the event loop. See run_completion.
+    """
+    if cache is not None:
+        lookup = await cache.lookup_async(*query, api_key=api_key)
+        if lookup[0] is not None:
+            completion.close()
+            return lookup[0]
+    ledger = get_ledger() if ledger is None else ledger
+    api_key = get_config().api_key if api_key is None else api_key
+    metrics = get_metrics() if metrics is None else metrics
+    deadline = transport.get("deadline", None)
+    timer = PhaseTimer(metrics, get_backend(transport.get("backend", None)).name)
+    phase = "prepare"
+    try:
+        step, value = next(completion)
+        while True:
+            if step != "sleep":
+                timer.model = value["model"]
+            timer.record(phase)
+            if step == "sleep":
+                await asyncio.sleep(value if deadline is None else max(0, min(value, time_left(deadline))))
+                timer.record("retry_sleep")
+                result = None
+            else:
+                request, result = budget_request(value, ledger, api_key, tag)
+                if result is None:
+                    result = await send_chat_request_async(request, api_key=api_key, metrics=metrics, **transport)
+                    record_usage(ledger, request, result, api_key, tag, retry=step == "retry")
+                timer.skip()
+            phase = "validation"
+            step, value = completion.send(result)
+    except StopIteration as stop:
+        result = stop.value
+    timer.record(phase)
+    timer.finish()
+    if cache is not None:
+        cache.store(lookup, result)
+    return result
+
+
+def chat_completion_steps(messages, model=None, chunk_length=None, api_key=None,
+                          debug=DEBUG, temperature=0.0, prompt=None, return_raw=False, max_tokens=None, stop=None,
+                          continuations=0, backend=None, long_text_model=None):
     # Use the default model if no model is specified
-    model = model or TEXT_MODEL
-    model, error = sanity_check(text, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug)
+    model = model or get_config().text_model
+    model, error, prompt_tokens = sanity_check(
+        messages if prompt is None else prompt, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug,
+        require_api_key=get_backend(backend).requires_api_key, long_text_model=long_text_model)
     if error:
-        return error
-
-    # Prepare messages for the API call
-    messages = [{"role": "user", "content": text}]
+        return CompletionResult(error=error["error"])
+
+    texts = []
+    usage = Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+    request_messages = messages
+    while True:
+        budget = output_budget(model, request_messages, prompt_tokens, max_tokens)
+        if budget is not None and budget <= 0:
+            return CompletionResult(error="No room is left in the context window for a response")
+        request = build_chat_request(request_messages, model, temperature, max_tokens=budget, stop=stop)
+        response, error = yield "request", request
+        if error:
+            return CompletionResult(error=error["error"])
 
-    # Try to make a request for a specified number of times
-    response, error = await asyncio.to_thread(lambda: do_chat_completion(
-        model=model, messages=messages, temperature=temperature, model_failure_retries=model_failure_retries, debug=debug))
+        text = response["choices"][0]["message"]["content"] or ""
+        texts.append(text)
+        finish_reason = response["choices"][0]["finish_reason"]
+        response_usage = Usage.from_response(response["usage"])
+        for field in usage.fields():
+            usage[field] += response_usage[field]
 
-    if error:
-        return error
+        if finish_reason != "length" or continuations <= 0:
+            break
+        # The response was cut off at max_tokens, ask for the rest
+        continuations -= 1
+        log("Response reached max_tokens, continuing", type="warning", log=debug)
+        request_messages = messages + [
+            {"role": "assistant", "content": "".join(texts)},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+        prompt_tokens += count_tokens(text, model=model) + count_tokens(CONTINUE_PROMPT, model=model)
+
+    if finish_reason == "length" and not os.environ.get("SUPPRESS_WARNINGS"):
+        print(
+            "Warning: Response was cut off at max_tokens (set continuations to continue it, or SUPPRESS_WARNINGS=1 to hide this message)"
+        )
 
     # Extract content from the response
-    text = response["choices"][0]["message"]["content"]
-    finish_reason = response["choices"][0]["finish_reason"]
-    usage = response["usage"]
+    return CompletionResult(
+        text="".join(texts),
+        usage=usage,
+        finish_reason=finish_reason,
+        error=None,
+        prefix=describe_prefix(request, response),
+        raw=response if return_raw else None,
+    )
 
-    return {
-        "text": text,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
 
+def text_completion_steps(text, model=None, chunk_length=None, api_key=None,
+                          debug=DEBUG, temperature=0.0, return_raw=False, max_tokens=None, stop=None,
+                          continuations=0, backend=None, long_text_model=None):
+    # Prepare messages for the API call
+    messages = [{"role": "user", "content": text}]
+    return (yield from chat_completion_steps(
+        messages, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug, temperature=temperature,
+        prompt=text, return_raw=return_raw, max_tokens=max_tokens, stop=stop, continuations=continuations,
+        backend=backend, long_text_model=long_text_model))
 
-def function_completion(
+
+def function_completion_steps(
     text=None,
     messages=None,
     system_message=None,
     functions=None,
-    model_failure_retries=5,
     function_call=None,
-    function_failure_retries=10,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
+    function_failure_retries=None,
+    chunk_length=None,
     model=None,
-    api_key=EASYCOMPLETION_API_KEY,
+    api_key=None,
     debug=DEBUG,
     temperature=0.0,
+    parallel_calls=False,
+    repair=True,
+    repair_turns=1,
+    deadline=None,
+    return_raw=False,
+    backend=None,
+    top_k_functions=None,
+    long_text_model=None,
 ):
-    """
-    Send text and a list of functions to the model and return optional text and a function call.
-    The function call is validated against the functions array.
-    The input text is sent to the chat model and is treated as a user message.
-
-    Args:
-        text (str): Text that will be sent as the user message to the model.
-        functions (list[dict] | dict | None): List of functions or a single function dictionary to be sent to the model.
-        model_failure_retries (int): Number of times to retry the request if it fails (default is 5).
-        function_call (str | dict | None): 'auto' to let the model decide, or a function name or a dictionary containing the function name (default is "auto").
-        function_failure_retries (int): Number of times to retry the request if the function call is invalid (default is 10).
-        chunk_length (int): The length of each chunk to be processed.
-        model (str | None): The model to use (default is the TEXT_MODEL, i.e. gpt-3.5-turbo).
-        api_key (str | None): If you'd like to pass in a key to override the environment variable EASYCOMPLETION_API_KEY.
-
-    Returns:
-        dict: On most errors, returns a dictionary with an "error" key. On success, returns a dictionary containing
-        "text" (response from the model), "function_name" (name of the function called), "arguments" (arguments for the function), "error" (None).
-
-    Example:
-        >>> function = {'name': 'function1', 'parameters': {'param1': 'value1'}}
-        >>> function_completion("Call the function.", function)
-    """
-
     # Use the default model if no model is specified
-    model = model or TEXT_MODEL
+    model = model or get_config().text_model
 
     # Ensure that functions are provided
     if functions is None:
-        return {"error": "functions is required"}
+        return FunctionCallResult(error="functions is required")
+
+    # A registry's functions are compiled once: their schemas, names and token costs are reused as they are
+    registry = functions if isinstance(functions, FunctionRegistry) else None
+    if registry is not None:
+        functions = registry.functions
+        if not functions:
+            return FunctionCallResult(error="functions is required")
+        # Only the functions relevant to the text are sent, so large catalogs don't cost tokens on every request
+        if top_k_functions and text is not None:
+            forced = function_call if isinstance(function_call, str) else (function_call or {}).get("name", None)
+            functions = registry.select(text, top_k_functions, include=[forced] if forced else [])
 
     # Check if a list of functions is provided
     if not isinstance(functions, list):
@@ -495,9 +952,7 @@ def function_completion(
             functions = [functions]
         else:
             # Functions must be either a list of dictionaries or a single dictionary
-            return {
-                "error": "functions must be a list of functions or a single function"
-            }
+            return FunctionCallResult(error="functions must be a list of functions or a single function")
 
     # Set the function call to the name of the function if only one function is provided
     # If there are multiple functions, use "auto"
@@ -507,13 +962,18 @@ def function_completion(
     # Make sure text is provided
     if text is None:
         log("Text is required", type="error", log=debug)
-        return {"error": "text is required"}
+        return FunctionCallResult(error="text is required")
 
     function_call_names = [function["name"] for function in functions]
+    functions_by_name = (
+        registry.functions_by_name
+        if registry is not None and functions is registry.functions
+        else {function["name"]: function for function in functions}
+    )
     # check that all function_call_names are unique and in the text
-    if len(function_call_names) != len(set(function_call_names)):
+    if len(function_call_names) != len(functions_by_name):
         log("Function names must be unique", type="error", log=debug)
-        return {"error": "Function names must be unique"}
+        return FunctionCallResult(error="Function names must be unique")
 
     if len(function_call_names) > 1 and not any(
         function_call_name in text for function_call_name in function_call_names
@@ -530,22 +990,16 @@ def function_completion(
             function_call = {"name": function_call}
         elif "name" not in function_call:
             log("function_call must have a name property", type="error", log=debug)
-            return {
-                "error": "function_call had an invalid name. Should be a string of the function name or an object with a name property"
-            }
-
-    model, error = sanity_check(dict(
-        text=text, functions=functions, messages=messages, system_message=system_message
-        ), model=model, chunk_length=chunk_length, api_key=api_key)
+            return FunctionCallResult(error="function_call had an invalid name. Should be a string of the function name or an object with a name property")
+
+    model, error, _ = sanity_check(dict(
+        text=text, functions=functions if registry is None else None, messages=messages, system_message=system_message
+        ), model=model, chunk_length=chunk_length, api_key=api_key, debug=debug,
+        require_api_key=get_backend(backend).requires_api_key,
+        extra_tokens=registry.token_count(function_call_names) if registry is not None else 0,
+        long_text_model=long_text_model)
     if error:
-        return error
-
-    # Count the number of tokens in the message
-    message_tokens = count_tokens(text, model=model)
-    total_tokens = message_tokens
-
-    function_call_tokens = count_tokens(functions, model=model)
-    total_tokens += function_call_tokens + 3  # Additional tokens for the user
+        return FunctionCallResult(error=error["error"])
 
     all_messages = []
 
@@ -560,24 +1014,62 @@ def function_completion(
         all_messages.append({"role": "user", "content": text})
 
     # Retry function call and model calls according to the specified retry counts
+    if function_failure_retries is None:
+        function_failure_retries = get_config().function_failure_retries
     response = None
-    for _ in range(function_failure_retries):
+    request_messages = all_messages
+    # Whether the next request resends one that failed
+    retry = False
+    for attempt in range(function_failure_retries):
+        # Waiting before the last attempt's retry would only delay the error, or the next model in a cascade
+        last_attempt = attempt == function_failure_retries - 1
         # Try to make a request for a specified number of times
-        response, error = do_chat_completion(
-            model=model, messages=all_messages, temperature=temperature, function_call=function_call,
-            functions=functions, model_failure_retries=model_failure_retries, debug=debug)
+        request = build_chat_request(
+            request_messages, model, temperature, functions, function_call, parallel_calls)
+        response, error = yield ("retry" if retry else "request"), request
+        retry = True
         if error:
-            time.sleep(1)
+            # Once the deadline has passed, nobody is waiting for a retry
+            if last_attempt or (deadline is not None and time.monotonic() >= deadline):
+                break
+            yield "sleep", 1
             continue
-        print('***** response')
-        print(response)
-        if validate_functions(response, functions, function_call):
+        calls, error = validate_function_calls(
+            response, functions_by_name, function_call, debug=debug
+        )
+        # A registry's compiled validators also check argument types, enums and nested objects
+        if error is None and registry is not None:
+            error = registry.validate_calls(calls)
+        if error is None:
             break
-        time.sleep(1)
+        # Repairing locally costs nothing, so try that before another round-trip
+        if repair:
+            calls, repair_error = repair_function_calls(
+                response, functions_by_name, function_call, debug=debug
+            )
+            if repair_error is None and registry is not None:
+                repair_error = registry.validate_calls(calls)
+            if repair_error is None:
+                error = None
+                break
+        # Then ask the model to correct its call, then fall back to resending the request
+        if repair_turns > 0:
+            repair_turns -= 1
+            request_messages = all_messages + correction_messages(response, error)
+            # A correction turn is a new request, not a resend
+            retry = False
+            continue
+        request_messages = all_messages
+        if not last_attempt:
+            yield "sleep", 1
 
     # Check if we have a valid response from the model
     if not response:
-        return error
+        return FunctionCallResult(error=error["error"])
+
+    # If no valid function call in response, return an error
+    if error:
+        return FunctionCallResult(error=error)
 
     # Extracting the content and function call response from API response
     response_data = response["choices"][0]["message"]
@@ -585,42 +1077,306 @@ def function_completion(
     usage = response["usage"]
 
     text = response_data["content"]
-    function_call_response = response_data.get("function_call", None)
-
-    # If no function call in response, return an error
-    if function_call_response is None:
-        log(f"No function call in response\n{response}", type="error", log=debug)
-        return {"error": "No function call in response"}
-    function_name = function_call_response["name"]
-    arguments = parse_arguments(function_call_response["arguments"])
+    function_name = calls[0]["function_name"]
+    arguments = calls[0]["arguments"]
     log(
         f"Response\n\nFunction Name: {function_name}\n\nArguments:\n{arguments}\n\nText:\n{text}\n\nFinish Reason: {finish_reason}\n\nUsage:\n{usage}",
         type="response",
         log=debug,
     )
     # Return the final result with the text response, function name, arguments and no error
-    return {
-        "text": text,
-        "function_name": function_name,
-        "arguments": arguments,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
+    return FunctionCallResult(
+        text=text,
+        function_name=function_name,
+        arguments=arguments,
+        function_calls=calls,
+        usage=Usage.from_response(usage),
+        finish_reason=finish_reason,
+        error=None,
+        prefix=describe_prefix(request, response),
+        raw=response if return_raw else None,
+    )
 
-async def function_completion_async(
+
+def chat_completion(
+    messages,
+    model_failure_retries=None,
+    model=None,
+    chunk_length=None,
+    long_text_model=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    temperature=0.0,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    max_tokens=None,
+    stop=None,
+    continuations=0,
+    ledger=None,
+    tag=None,
+    backend=None,
+    metrics=None,
+):
+    """
+    Function for sending chat messages and returning a chat response.
+
+    Parameters:
+        messages (str): Messages to send to the model. In the form {<role>: string, <content>: string} - roles are "user" and "assistant"
+        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
+        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
+        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
+        long_text_model (str, optional): The model to switch to when the prompt is longer than chunk_length.
+            Default is the Config's long_text_model.
+        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+        api_base (str, optional): API endpoint for this call. Default is EASYCOMPLETION_API_ENDPOINT.
+        limiter (AdaptiveLimiter, optional): Shared concurrency limiter that adapts to the backend's latency and errors.
+        scheduler (Scheduler, optional): Shared scheduler that orders requests by priority and tenant.
+        priority (str | int, optional): Scheduling priority: "interactive", "default" or "batch".
+        tenant (str, optional): Scheduling capacity is shared fairly between tenants.
+        deadline (float, optional): time.monotonic() value by which the call gives up: queued requests are dropped,
+            requests in flight are cut off and no more retries are made.
+        timeout (float, optional): Seconds the whole call may take, including retries. Sets the deadline.
+        return_raw (bool, optional): If True, the full API response is kept in the result's "raw" field.
+        max_tokens (int | str, optional): Maximum number of tokens in the response, capped to what is left of the
+            context window. "auto" uses all of the remaining context window. Default is no limit.
+        stop (str | list, optional): Up to 4 sequences where the model stops generating.
+        continuations (int, optional): Number of times to ask the model to continue a response that was cut off at
+            max_tokens. The parts are joined into one text and their usage is added up.
+        ledger (UsageLedger, optional): Ledger to check budgets against and record usage to. Default is the
+            shared ledger from get_ledger(); False disables recording.
+        tag (str, optional): Label to record usage under in the ledger.
+        backend (str | backend, optional): Where to send the request: a backend such as LocalBackend, or the name of a
+            registered backend. Default is the OpenAI API.
+        metrics (LatencyMetrics, optional): Where to record the time of each phase of the call. Default is the
+            shared metrics from get_metrics(); False disables recording.
+
+    Returns:
+        CompletionResult: "text" (the response content from the model), "usage", "finish_reason" and "error".
+        It can be read like a dictionary.
+
+    Example:
+        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+    """
+    deadline = resolve_deadline(deadline, timeout)
+    return run_completion(
+        chat_completion_steps(
+            messages, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug, temperature=temperature,
+            return_raw=return_raw, max_tokens=max_tokens, stop=stop, continuations=continuations,
+            backend=backend, long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics)
+
+
+async def chat_completion_async(
+    messages,
+    model_failure_retries=None,
+    model=None,
+    chunk_length=None,
+    long_text_model=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    temperature=0.0,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    max_tokens=None,
+    stop=None,
+    continuations=0,
+    ledger=None,
+    tag=None,
+    backend=None,
+    metrics=None,
+):
+    """
+    Function for sending chat messages and returning a chat response, without blocking the event loop.
+
+    Takes the same parameters and returns the same response as chat_completion.
+    """
+    deadline = resolve_deadline(deadline, timeout)
+    return await run_completion_async(
+        chat_completion_steps(
+            messages, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug, temperature=temperature,
+            return_raw=return_raw, max_tokens=max_tokens, stop=stop, continuations=continuations,
+            backend=backend, long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics)
+
+
+def text_completion(
+    text,
+    model_failure_retries=None,
+    model=None,
+    chunk_length=None,
+    long_text_model=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    temperature=0.0,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    max_tokens=None,
+    stop=None,
+    continuations=0,
+    ledger=None,
+    tag=None,
+    cache=None,
+    backend=None,
+    metrics=None,
+):
+    """
+    Function for sending text and returning a text completion response.
+
+    Parameters:
+        text (str): Text to send to the model.
+        model_failure_retries (int, optional): Number of retries if the request fails. Default is 5.
+        model (str, optional): The model to use. Default is the TEXT_MODEL defined in constants.py.
+        chunk_length (int, optional): Maximum length of text chunk to process. Default is defined in constants.py.
+        long_text_model (str, optional): The model to switch to when the prompt is longer than chunk_length.
+            Default is the Config's long_text_model.
+        api_key (str, optional): OpenAI API key. If not provided, it uses the one defined in constants.py.
+        api_base (str, optional): API endpoint for this call. Default is EASYCOMPLETION_API_ENDPOINT.
+        limiter (AdaptiveLimiter, optional): Shared concurrency limiter that adapts to the backend's latency and errors.
+        scheduler (Scheduler, optional): Shared scheduler that orders requests by priority and tenant.
+        priority (str | int, optional): Scheduling priority: "interactive", "default" or "batch".
+        tenant (str, optional): Scheduling capacity is shared fairly between tenants.
+        deadline (float, optional): time.monotonic() value by which the call gives up: queued requests are dropped,
+            requests in flight are cut off and no more retries are made.
+        timeout (float, optional): Seconds the whole call may take, including retries. Sets the deadline.
+        return_raw (bool, optional): If True, the full API response is kept in the result's "raw" field.
+        max_tokens (int | str, optional): Maximum number of tokens in the response, capped to what is left of the
+            context window. "auto" uses all of the remaining context window. Default is no limit.
+        stop (str | list, optional): Up to 4 sequences where the model stops generating.
+        continuations (int, optional): Number of times to ask the model to continue a response that was cut off at
+            max_tokens. The parts are joined into one text and their usage is added up.
+        ledger (UsageLedger, optional): Ledger to check budgets against and record usage to. Default is the
+            shared ledger from get_ledger(); False disables recording.
+        tag (str, optional): Label to record usage under in the ledger.
+        backend (str | backend, optional): Where to send the request: a backend such as LocalBackend, or the name of a
+            registered backend. Default is the OpenAI API.
+        metrics (LatencyMetrics, optional): Where to record the time of each phase of the call. Default is the
+            shared metrics from get_metrics(); False disables recording.
+        cache (SemanticCache, optional): Cache that serves stored responses for the same or near-identical text.
+
+    Returns:
+        CompletionResult: "text" (the response content from the model), "usage", "finish_reason" and "error".
+        It can be read like a dictionary.
+
+    Example:
+        >>> text_completion("Hello, how are you?", model_failure_retries=3, model='gpt-3.5-turbo', chunk_length=1024, api_key='your_openai_api_key')
+    """
+    deadline = resolve_deadline(deadline, timeout)
+    return run_completion(
+        text_completion_steps(
+            text, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug, temperature=temperature,
+            return_raw=return_raw, max_tokens=max_tokens, stop=stop, continuations=continuations,
+            backend=backend, long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics,
+        cache=cache, query=cache_query(
+            text, model, temperature, type="text", max_tokens=max_tokens, stop=stop, continuations=continuations,
+            long_text_model=long_text_model,
+            backend=get_backend(backend).name,
+        ) if cache is not None else None)
+
+
+async def text_completion_async(
+    text,
+    model_failure_retries=None,
+    model=None,
+    chunk_length=None,
+    long_text_model=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    temperature=0.0,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    max_tokens=None,
+    stop=None,
+    continuations=0,
+    ledger=None,
+    tag=None,
+    cache=None,
+    backend=None,
+    metrics=None,
+):
+    """
+    Function for sending text and returning a text completion response, without blocking the event loop.
+
+    Takes the same parameters and returns the same response as text_completion.
+    """
+    deadline = resolve_deadline(deadline, timeout)
+    return await run_completion_async(
+        text_completion_steps(
+            text, model=model, chunk_length=chunk_length, api_key=api_key, debug=debug, temperature=temperature,
+            return_raw=return_raw, max_tokens=max_tokens, stop=stop, continuations=continuations,
+            backend=backend, long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics,
+        cache=cache, query=cache_query(
+            text, model, temperature, type="text", max_tokens=max_tokens, stop=stop, continuations=continuations,
+            long_text_model=long_text_model,
+            backend=get_backend(backend).name,
+        ) if cache is not None else None)
+
+
+def function_completion(
     text=None,
     messages=None,
     system_message=None,
     functions=None,
-    model_failure_retries=5,
+    model_failure_retries=None,
     function_call=None,
-    function_failure_retries=10,
-    chunk_length=DEFAULT_CHUNK_LENGTH,
+    function_failure_retries=None,
+    chunk_length=None,
+    long_text_model=None,
     model=None,
-    api_key=EASYCOMPLETION_API_KEY,
+    api_key=None,
+    api_base=None,
     debug=DEBUG,
     temperature=0.0,
+    parallel_calls=False,
+    repair=True,
+    repair_turns=1,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    ledger=None,
+    tag=None,
+    cache=None,
+    backend=None,
+    cascade=None,
+    top_k_functions=None,
+    metrics=None,
 ):
     """
     Send text and a list of functions to the model and return optional text and a function call.
@@ -629,150 +1385,129 @@ async def function_completion_async(
 
     Args:
         text (str): Text that will be sent as the user message to the model.
-        functions (list[dict] | dict | None): List of functions or a single function dictionary to be sent to the model.
+        functions (list[dict] | dict | FunctionRegistry | None): List of functions or a single function dictionary to be
+            sent to the model, or a FunctionRegistry, whose schemas and token costs are compiled once.
         model_failure_retries (int): Number of times to retry the request if it fails (default is 5).
         function_call (str | dict | None): 'auto' to let the model decide, or a function name or a dictionary containing the function name (default is "auto").
         function_failure_retries (int): Number of times to retry the request if the function call is invalid (default is 10).
         chunk_length (int): The length of each chunk to be processed.
+        long_text_model (str | None): The model to switch to when the prompt is longer than chunk_length.
+            Default is the Config's long_text_model.
         model (str | None): The model to use (default is the TEXT_MODEL, i.e. gpt-3.5-turbo).
         api_key (str | None): If you'd like to pass in a key to override the environment variable EASYCOMPLETION_API_KEY.
+        api_base (str | None): API endpoint for this call, overriding EASYCOMPLETION_API_ENDPOINT.
+        parallel_calls (bool): If True, the model may return several function calls in one response. Every call is validated.
+        repair (bool): If True, invalid function calls are first repaired locally (JSON fixes, key names, value types).
+        repair_turns (int): Number of follow-up turns that send the validation error back to the model for it to correct,
+            before falling back to resending the original request.
+        limiter (AdaptiveLimiter | None): Shared concurrency limiter that adapts to the backend's latency and errors.
+        scheduler (Scheduler | None): Shared scheduler that orders requests by priority and tenant.
+        priority (str | int): Scheduling priority: "interactive", "default" or "batch".
+        tenant (str | None): Scheduling capacity is shared fairly between tenants.
+        deadline (float | None): time.monotonic() value by which the call gives up: queued requests are dropped,
+            requests in flight are cut off and no more retries are made.
+        timeout (float | None): Seconds the whole call may take, including retries. Sets the deadline.
+        return_raw (bool): If True, the full API response is kept in the result's "raw" field.
+        ledger (UsageLedger | False | None): Ledger to check budgets against and record usage to. Default is the
+            shared ledger from get_ledger(); False disables recording.
+        tag (str | None): Label to record usage under in the ledger.
+        backend (str | backend | None): Where to send the request: a backend such as LocalBackend, or the name of a
+            registered backend. Default is the OpenAI API. LocalBackend constrains function calls to valid JSON.
+        cache (SemanticCache | None): Cache that serves stored responses for the same or near-identical text,
+            with the same functions and settings.
+        cascade (ModelCascade | None): Tries the cascade's models cheapest first, escalating only when a call is
+            not valid or not accepted. Replaces model.
+        top_k_functions (int | None): With a FunctionRegistry, sends only the functions most relevant to the text,
+            ranked by FunctionRegistry.select.
+        metrics (LatencyMetrics | False | None): Where to record the time of each phase of the call. Default is the
+            shared metrics from get_metrics(); False disables recording.
 
     Returns:
-        dict: On most errors, returns a dictionary with an "error" key. On success, returns a dictionary containing
-        "text" (response from the model), "function_name" (name of the function called), "arguments" (arguments for the function), "error" (None).
+        FunctionCallResult: On most errors, only "error" is set. On success, it contains
+        "text" (response from the model), "function_name" (name of the function called), "arguments" (arguments for the function),
+        "function_calls" (list of every call, each with "id", "function_name" and "arguments"), "usage", "finish_reason",
+        "error" (None). "function_name" and "arguments" are those of the first call. It can be read like a dictionary.
 
     Example:
         >>> function = {'name': 'function1', 'parameters': {'param1': 'value1'}}
         >>> function_completion("Call the function.", function)
     """
+    deadline = resolve_deadline(deadline, timeout)
+    return run_completion(
+        (function_completion_steps if cascade is None else cascade.steps)(
+            text=text, messages=messages, system_message=system_message, functions=functions,
+            function_call=function_call, function_failure_retries=function_failure_retries,
+            chunk_length=chunk_length, model=model, api_key=api_key, debug=debug, temperature=temperature,
+            parallel_calls=parallel_calls, repair=repair, repair_turns=repair_turns, deadline=deadline,
+            return_raw=return_raw, backend=backend, top_k_functions=top_k_functions,
+            long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics,
+        cache=cache, query=cache_query(
+            text, model if cascade is None else tuple(cascade.models), temperature, type="function",
+            messages=messages, system_message=system_message,
+            functions=functions, function_call=function_call, parallel_calls=parallel_calls,
+            top_k_functions=top_k_functions, long_text_model=long_text_model,
+            backend=get_backend(backend).name,
+        ) if cache is not None else None)
 
-    # Use the default model if no model is specified
-    model = model or TEXT_MODEL
-
-    # Ensure that functions are provided
-    if functions is None:
-        return {"error": "functions is required"}
-
-    # Check if a list of functions is provided
-    if not isinstance(functions, list):
-        if (
-            isinstance(functions, dict)
-            and "name" in functions
-            and "parameters" in functions
-        ):
-            # A single function is provided as a dictionary, convert it to a list
-            functions = [functions]
-        else:
-            # Functions must be either a list of dictionaries or a single dictionary
-            return {
-                "error": "functions must be a list of functions or a single function"
-            }
-
-    # Set the function call to the name of the function if only one function is provided
-    # If there are multiple functions, use "auto"
-    if function_call is None:
-        function_call = functions[0]["name"] if len(functions) == 1 else "auto"
-
-    # Make sure text is provided
-    if text is None:
-        log("Text is required", type="error", log=debug)
-        return {"error": "text is required"}
-
-    function_call_names = [function["name"] for function in functions]
-    # check that all function_call_names are unique and in the text
-    if len(function_call_names) != len(set(function_call_names)):
-        log("Function names must be unique", type="error", log=debug)
-        return {"error": "Function names must be unique"}
-
-    if len(function_call_names) > 1 and not any(
-        function_call_name in text for function_call_name in function_call_names
-    ):
-        log(
-            "WARNING: Function and argument names should be in the text",
-            type="warning",
-            log=debug,
-        )
-
-    # Check if the function call is valid
-    if function_call != "auto":
-        if isinstance(function_call, str):
-            function_call = {"name": function_call}
-        elif "name" not in function_call:
-            log("function_call must have a name property", type="error", log=debug)
-            return {
-                "error": "function_call had an invalid name. Should be a string of the function name or an object with a name property"
-            }
-
-    model, error = sanity_check(dict(
-        text=text, functions=functions, messages=messages, system_message=system_message
-        ), model=model, chunk_length=chunk_length, api_key=api_key)
-    if error:
-        return error
-
-    # Count the number of tokens in the message
-    message_tokens = count_tokens(text, model=model)
-    total_tokens = message_tokens
-
-    function_call_tokens = count_tokens(functions, model=model)
-    total_tokens += function_call_tokens + 3  # Additional tokens for the user
-
-    all_messages = []
-
-    if system_message is not None:
-        all_messages.append({"role": "system", "content": system_message})
-
-    if messages is not None:
-        all_messages += messages
-
-    # Prepare the messages to be sent to the API
-    if text is not None and text != "":
-        all_messages.append({"role": "user", "content": text})
-
-    # Retry function call and model calls according to the specified retry counts
-    response = None
-    for _ in range(function_failure_retries):
-        # Try to make a request for a specified number of times
-        response, error = await asyncio.to_thread(lambda: do_chat_completion(
-            model=model, messages=all_messages, temperature=temperature, function_call=function_call,
-            functions=functions, model_failure_retries=model_failure_retries, debug=debug))
-        if error:
-            time.sleep(1)
-            continue
-        print('***** response')
-        print(response)
-        if validate_functions(response, functions, function_call):
-            break
-        time.sleep(1)
 
-    # Check if we have a valid response from the model
-    if not response:
-        return error
-
-    # Extracting the content and function call response from API response
-    response_data = response["choices"][0]["message"]
-    finish_reason = response["choices"][0]["finish_reason"]
-    usage = response["usage"]
-
-    text = response_data["content"]
-    function_call_response = response_data.get("function_call", None)
+async def function_completion_async(
+    text=None,
+    messages=None,
+    system_message=None,
+    functions=None,
+    model_failure_retries=None,
+    function_call=None,
+    function_failure_retries=None,
+    chunk_length=None,
+    long_text_model=None,
+    model=None,
+    api_key=None,
+    api_base=None,
+    debug=DEBUG,
+    temperature=0.0,
+    parallel_calls=False,
+    repair=True,
+    repair_turns=1,
+    limiter=None,
+    scheduler=None,
+    priority="default",
+    tenant=None,
+    deadline=None,
+    timeout=None,
+    return_raw=False,
+    ledger=None,
+    tag=None,
+    cache=None,
+    backend=None,
+    cascade=None,
+    top_k_functions=None,
+    metrics=None,
+):
+    """
+    Send text and a list of functions to the model and return optional text and a function call,
+    without blocking the event loop.
 
-    # If no function call in response, return an error
-    if function_call_response is None:
-        log(f"No function call in response\n{response}", type="error", log=debug)
-        return {"error": "No function call in response"}
-    function_name = function_call_response["name"]
-    arguments = parse_arguments(function_call_response["arguments"])
-    log(
-        f"Response\n\nFunction Name: {function_name}\n\nArguments:\n{arguments}\n\nText:\n{text}\n\nFinish Reason: {finish_reason}\n\nUsage:\n{usage}",
-        type="response",
-        log=debug,
-    )
-    # Return the final result with the text response, function name, arguments and no error
-    return {
-        "text": text,
-        "function_name": function_name,
-        "arguments": arguments,
-        "usage": usage,
-        "finish_reason": finish_reason,
-        "error": None,
-    }
+    Takes the same parameters and returns the same response as function_completion.
+    """
+    deadline = resolve_deadline(deadline, timeout)
+    return await run_completion_async(
+        (function_completion_steps if cascade is None else cascade.steps)(
+            text=text, messages=messages, system_message=system_message, functions=functions,
+            function_call=function_call, function_failure_retries=function_failure_retries,
+            chunk_length=chunk_length, model=model, api_key=api_key, debug=debug, temperature=temperature,
+            parallel_calls=parallel_calls, repair=repair, repair_turns=repair_turns, deadline=deadline,
+            return_raw=return_raw, backend=backend, top_k_functions=top_k_functions,
+            long_text_model=long_text_model),
+        model_failure_retries=model_failure_retries, debug=debug, limiter=limiter, scheduler=scheduler,
+        priority=priority, tenant=tenant, deadline=deadline, ledger=ledger, tag=tag, api_key=api_key,
+        api_base=api_base, backend=backend, metrics=metrics,
+        cache=cache, query=cache_query(
+            text, model if cascade is None else tuple(cascade.models), temperature, type="function",
+            messages=messages, system_message=system_message,
+            functions=functions, function_call=function_call, parallel_calls=parallel_calls,
+            top_k_functions=top_k_functions, long_text_model=long_text_model,
+            backend=get_backend(backend).name,
+        ) if cache is not None else None)
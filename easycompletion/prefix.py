@@ -0,0 +1,100 @@
+import copy
+import json
+import hashlib
+import functools
+import threading
+import collections
+
+from .prompt import count_tokens
+from .results import Prefix
+from .functions import CompiledFunctions
+
+
+# Canonical functions by the identity of the function dictionaries they came from
+CANONICAL_CACHE_SIZE = 256
+canonical_cache = collections.OrderedDict()
+canonical_lock = threading.Lock()
+
+
+def canonical_functions(functions):
+    """
+    Returns the functions sorted by name, with the keys of every object sorted.
+
+    Providers cache prompts by exact prefix, so the same functions must always
+    serialize to the same bytes, however the caller built the dictionaries.
+    Functions compiled by a FunctionRegistry are already canonical and returned as they are.
+
+    The result is cached by the identity of the function dictionaries, so
+    passing the same functions again is not serialized again. A copy taken
+    when they were cached is compared with them, so functions that were
+    changed in place are compiled again. The returned list is shared and
+    must not be modified.
+    """
+    if functions is None or isinstance(functions, CompiledFunctions):
+        return functions
+    functions = list(functions)
+    key = tuple(map(id, functions))
+    with canonical_lock:
+        entry = canonical_cache.get(key, None)
+        if entry is not None:
+            canonical_cache.move_to_end(key)
+    # The originals are kept in the entry, so their ids can't be reused by other objects
+    if entry is not None and entry[1] == functions:
+        return entry[2]
+    canonical = CompiledFunctions(
+        json.loads(json.dumps(sorted(functions, key=lambda function: function["name"]), sort_keys=True))
+    )
+    with canonical_lock:
+        canonical_cache[key] = (functions, copy.deepcopy(functions), canonical)
+        if len(canonical_cache) > CANONICAL_CACHE_SIZE:
+            canonical_cache.popitem(last=False)
+    return canonical
+
+
+def prefix_messages(messages):
+    """
+    Returns the leading system messages, the part of the messages that is the same across requests.
+    """
+    count = 0
+    while count < len(messages) and messages[count]["role"] == "system":
+        count += 1
+    return messages[:count]
+
+
+def serialize_prefix(request):
+    """
+    Returns the static prefix of a chat request (model, functions or tools, leading system messages) as a string.
+    """
+    prefix = {
+        "model": request["model"],
+        "functions": request.get("functions", None) or request.get("tools", None),
+        "messages": prefix_messages(request["messages"]),
+    }
+    return json.dumps(prefix, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def measure_prefix(serialized, model):
+    # Counting tokens is the expensive part, and the prefix is the same for most requests
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16], count_tokens(serialized, model)
+
+
+def describe_prefix(request, response):
+    """
+    Reports the reusable prefix of a request and how much of the prompt the provider served from its cache.
+
+    Returns:
+        Prefix: "hash" (identifies the static prefix), "tokens" (estimated tokens in it),
+        "cached_tokens" (prompt tokens the provider reported as cached) and "cached_ratio" (cached / prompt tokens).
+    """
+    prefix_hash, tokens = measure_prefix(serialize_prefix(request), request["model"])
+    usage = response.get("usage", None) or {}
+    details = usage.get("prompt_tokens_details", None) or {}
+    cached_tokens = details.get("cached_tokens", 0) or 0
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    return Prefix(
+        hash=prefix_hash,
+        tokens=tokens,
+        cached_tokens=cached_tokens,
+        cached_ratio=cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+    )
@@ -1,8 +1,106 @@
 import re
+import bisect
+import functools
+import itertools
 import tiktoken
 
 from .constants import TEXT_MODEL, DEFAULT_CHUNK_LENGTH, DEBUG
 from .logger import log
+from .segmenter import SENTENCE, PARAGRAPH, segment_text, iter_segments
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=TEXT_MODEL):
+    """
+    Return the tiktoken encoding for a model, looked up once per model.
+
+    Args:
+        model: The model to use for tokenization.
+
+    Returns:
+        A tiktoken Encoding object.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+def token_boundaries(text, tokens, encoding, segmenter=None):
+    """
+    Returns the sentence and paragraph boundaries of a text as (token index, level) pairs.
+
+    Only boundaries that fall between two tokens are returned. The text is not
+    encoded again: boundaries are matched to tokens by their byte offsets.
+    """
+    starts = list(itertools.accumulate((len(piece) for piece in encoding.decode_tokens_bytes(tokens)), initial=0))
+    boundaries = []
+    offset = 0
+    for segment, level in segment_text(text, segmenter):
+        offset += len(segment.encode("utf-8"))
+        index = bisect.bisect_left(starts, offset)
+        if index < len(starts) and starts[index] == offset:
+            boundaries.append((index, level))
+    return boundaries
+
+
+# How many tokens to look back for the start of a word before cutting mid-word
+WORD_LOOKBACK = 16
+
+
+def starts_word(piece):
+    """
+    Returns True if cutting before a token (given as bytes) splits neither a word nor a character.
+    """
+    if not piece:
+        return True
+    first = piece[0]
+    if first >= 0x80:
+        # The start of a multibyte character, not a continuation byte
+        return first >= 0xC0
+    return not (chr(first).isalnum() or first == 0x5F)
+
+
+def find_cut(tokens, pieces, boundaries, keep, from_end=False):
+    """
+    Returns where to cut tokens to keep at most 'keep' tokens from the start (or from the end if from_end).
+
+    Prefers a paragraph boundary, then a sentence boundary, as long as at least
+    half of 'keep' is kept, then the start of a word, then any token.
+    """
+    total = len(tokens)
+    limit = total - keep if from_end else keep
+
+    def kept(index):
+        return total - index if from_end else index
+
+    for level in (PARAGRAPH, SENTENCE):
+        candidates = [
+            index for index, boundary_level in boundaries
+            if boundary_level >= level and 0 < kept(index) <= keep and kept(index) * 2 >= keep
+        ]
+        if candidates:
+            return min(candidates) if from_end else max(candidates)
+
+    step = 1 if from_end else -1
+    for index in range(limit, limit + step * WORD_LOOKBACK, step):
+        if 0 < index < total and kept(index) > 0 and starts_word(pieces[index]):
+            return index
+    return limit
+
+
+def trim_tokens(text, tokens, max_tokens, encoding, mode="top", separator="\n...\n", segmenter=None):
+    """
+    Trims already encoded text to max_tokens. See trim_prompt.
+    """
+    pieces = encoding.decode_tokens_bytes(tokens)
+    boundaries = token_boundaries(text, tokens, encoding, segmenter)
+    if mode == "bottom":
+        return encoding.decode(tokens[find_cut(tokens, pieces, boundaries, max_tokens, from_end=True):]).lstrip()
+    if mode == "middle":
+        budget = max_tokens - len(encoding.encode(separator))
+        if budget > 1:
+            head = find_cut(tokens, pieces, boundaries, budget - budget // 2)
+            tail = max(head, find_cut(tokens, pieces, boundaries, budget - head, from_end=True))
+            return encoding.decode(tokens[:head]).rstrip() + separator + encoding.decode(tokens[tail:]).lstrip()
+    return encoding.decode(tokens[: find_cut(tokens, pieces, boundaries, max_tokens)])
 
 
 def trim_prompt(
@@ -11,10 +109,18 @@ def trim_prompt(
     model=TEXT_MODEL,
     preserve_top=True,
     debug=DEBUG,
+    segmenter=None,
+    mode=None,
+    tokens=None,
+    separator="\n...\n",
 ):
     """
     Trim the given text to a maximum number of tokens.
 
+    The text is cut at the nearest paragraph or sentence boundary under the
+    limit if that keeps at least half of the limit, otherwise at the start of
+    a word, so words are not cut in half.
+
     Args:
         text: Input text which needs to be trimmed.
         max_tokens: Maximum number of tokens allowed in the trimmed text.
@@ -22,6 +128,11 @@ def trim_prompt(
         model: The model to use for tokenization.
         preserve_top: If True, the function will keep the first 'max_tokens' tokens,
                       if False, it will keep the last 'max_tokens' tokens.
+        segmenter: The Segmenter that finds sentence and paragraph boundaries.
+        mode: "top" keeps the start, "bottom" keeps the end and "middle" keeps the
+              start and the end, joined by the separator. Overrides preserve_top.
+        tokens: The text's tokens, if they are already known, so the text is not encoded again.
+        separator: Text put in place of the removed middle in "middle" mode.
 
     Returns:
         Trimmed text that fits within the specified token limit.
@@ -30,59 +141,155 @@ def trim_prompt(
         trim_prompt("This is a test.", 3, preserve_top=True)
         Output: "This is"
     """
-    # Encoding the text into tokens.
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
+    mode = mode or ("top" if preserve_top else "bottom")
+    max_tokens = int(max_tokens)
+    encoding = get_encoding(model)
+    if tokens is None:
+        tokens = encoding.encode(text)
     if len(tokens) <= max_tokens:
         return text  # If text is already within limit, return as is.
 
     log(f"Trimming prompt, token len is {str(len(tokens))}", type="warning", log=debug)
 
-    # If 'preserve_top' is True, keep the first 'max_tokens' tokens.
-    # Otherwise, keep the last 'max_tokens' tokens.
-    return encoding.decode(
-        tokens[:max_tokens] if preserve_top else tokens[-max_tokens:]
-    )
+    return trim_tokens(text, tokens, max_tokens, encoding, mode=mode, separator=separator, segmenter=segmenter)
+
+
+def trim_segments(
+    segments,
+    max_tokens=None,
+    budgets=None,
+    model=TEXT_MODEL,
+    mode="top",
+    tokens=None,
+    separator="\n...\n",
+    debug=DEBUG,
+):
+    """
+    Trim several texts at once, e.g. tool outputs, to their own budgets and to a shared total.
+
+    Every text is encoded once. If the texts are over the total, short texts are
+    kept whole and the remaining budget is shared equally between the longer ones.
+
+    Args:
+        segments: A list of texts.
+        max_tokens: Optional total token budget for all texts together.
+        budgets: Optional list with a token budget (or None) for each text.
+        model: The model to use for tokenization.
+        mode: "top", "bottom" or "middle", see trim_prompt.
+        tokens: Optional list with the tokens of each text, if they are already known.
+        separator: Text put in place of the removed middle in "middle" mode.
+
+    Returns:
+        The list of trimmed texts.
+
+    Example:
+        trim_segments([log_output, search_results], max_tokens=2000, budgets=[500, None], mode="middle")
+    """
+    encoding = get_encoding(model)
+    if tokens is None:
+        tokens = encoding.encode_batch(segments)
+    budgets = budgets or [None] * len(segments)
+    limits = [
+        len(segment_tokens) if budget is None else min(budget, len(segment_tokens))
+        for segment_tokens, budget in zip(tokens, budgets)
+    ]
+
+    if max_tokens is not None and sum(limits) > max_tokens:
+        # Fill the smallest segments first, then split what is left evenly
+        remaining = max_tokens
+        order = sorted(range(len(segments)), key=lambda index: limits[index])
+        for position, index in enumerate(order):
+            limits[index] = min(limits[index], remaining // (len(order) - position))
+            remaining -= limits[index]
+
+    log(f"Trimming {len(segments)} segments to {sum(limits)} tokens", log=debug)
+
+    trimmed = []
+    for segment, segment_tokens, limit in zip(segments, tokens, limits):
+        if limit >= len(segment_tokens):
+            trimmed.append(segment)
+        elif limit > 0:
+            trimmed.append(trim_tokens(segment, segment_tokens, limit, encoding, mode=mode, separator=separator))
+        else:
+            trimmed.append("")
+    return trimmed
 
 
-def chunk_prompt(prompt, chunk_length=DEFAULT_CHUNK_LENGTH, debug=DEBUG):
+def chunk_segments(segments, chunk_length=DEFAULT_CHUNK_LENGTH, model=TEXT_MODEL):
+    """
+    Packs (text, level) segments into chunks of at most chunk_length tokens, yielding each chunk when it is full.
+
+    Chunks end at a paragraph boundary if one keeps at least half of the chunk,
+    otherwise at a sentence boundary. Segments longer than a chunk are split by tokens.
+    """
+    encoding = get_encoding(model)
+    chunk_length = int(chunk_length)
+    # The current chunk as [text, level, tokens] entries
+    chunk = []
+    size = 0
+    for text, level in segments:
+        tokens = encoding.encode(text)
+        while chunk and size + len(tokens) > chunk_length:
+            cut = len(chunk)
+            kept = size
+            for index in range(len(chunk) - 1, 0, -1):
+                kept -= chunk[index][2]
+                if chunk[index - 1][1] == PARAGRAPH and kept * 2 >= chunk_length:
+                    cut = index
+                    break
+            yield "".join(entry[0] for entry in chunk[:cut]).strip()
+            chunk = chunk[cut:]
+            size = sum(entry[2] for entry in chunk)
+        # Split a segment that is too long by itself, keeping the rest to fill the next chunk
+        while len(tokens) > chunk_length:
+            yield encoding.decode(tokens[:chunk_length]).strip()
+            tokens = tokens[chunk_length:]
+            text = encoding.decode(tokens)
+        chunk.append([text, level, len(tokens)])
+        size += len(tokens)
+    if chunk:
+        yield "".join(entry[0] for entry in chunk).strip()
+
+
+def chunk_stream(pieces, chunk_length=DEFAULT_CHUNK_LENGTH, model=TEXT_MODEL, segmenter=None):
+    """
+    Chunks text that arrives in pieces, e.g. lines of a file, yielding each chunk as soon as it is complete.
+
+    Example:
+        >>> with open("book.txt") as f:
+        ...     for chunk in chunk_stream(f, chunk_length=1024):
+        ...         ...
+    """
+    for chunk in chunk_segments(iter_segments(pieces, segmenter), chunk_length, model):
+        if chunk:
+            yield chunk
+
+
+def chunk_prompt(prompt, chunk_length=DEFAULT_CHUNK_LENGTH, debug=DEBUG, model=TEXT_MODEL, segmenter=None):
     """
     Split the given prompt into chunks where each chunk has a maximum number of tokens.
 
+    Chunks end at paragraph or sentence boundaries; sentences longer than a
+    chunk are split between tokens.
+
     Args:
         prompt: Input text that needs to be split.
         chunk_length: Maximum number of tokens allowed per chunk.
                       Default value is taken from the constants.
+        model: The model to use for tokenization.
+        segmenter: The Segmenter that finds sentence and paragraph boundaries.
 
     Returns:
         A list of string chunks where each chunk is within the specified token limit.
 
     Example:
-        chunk_prompt("This is a test. I am writing a function.", 4)
-        Output: ['This is', 'a test.', 'I am', 'writing a', 'function.']
+        chunk_prompt("This is a test. I am writing a function.", 6)
+        Output: ['This is a test.', 'I am writing a function.']
     """
-    if count_tokens(prompt) <= chunk_length:
+    if count_tokens(prompt, model) <= chunk_length:
         return [prompt]
 
-    # Splitting the prompt into sentences using regular expressions.
-    sentences = re.split(r"(?<=[.!?])\s+", prompt)
-    current_chunk = ""
-    prompt_chunks = []
-
-    # For each sentence in the input text.
-    for sentence in sentences:
-        # If adding a new sentence doesn't exceed the token limit, add it to the current chunk.
-        if count_tokens(current_chunk + sentence + " ") <= chunk_length:
-            current_chunk += sentence + " "
-        else:
-            # If adding a new sentence exceeds the token limit, add the current chunk to the list.
-            # Then, start a new chunk with the current sentence.
-            prompt_chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
-
-    # If there's any sentence left after looping through all sentences, add it to the list.
-    if current_chunk:
-        prompt_chunks.append(current_chunk.strip())
+    prompt_chunks = list(chunk_stream([prompt], chunk_length, model, segmenter))
 
     log(
         f"Chunked prompt into {str(len(prompt_chunks))} chunks",
@@ -117,7 +324,7 @@ def count_tokens(prompt: str, model=TEXT_MODEL) -> int:
     if not isinstance(prompt, str):
         prompt = str(prompt)
 
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     length = len(
         encoding.encode(prompt)
     )  # Encoding the text into tokens and counting the number of tokens.
@@ -139,20 +346,270 @@ def get_tokens(prompt: str, model=TEXT_MODEL) -> list:
         get_tokens("This is a test.")
         Output: [This, is, a, test, .]
     """
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     return encoding.encode(
         prompt
     )  # Encoding the text into tokens and returning the list of tokens.
 
 
-def compose_prompt(prompt_template, parameters, debug=DEBUG):
+# Matches {{placeholder}} keys. The capture group makes re.split alternate
+# literal text (even indices) and placeholder keys (odd indices).
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(.*?)\}\}", re.DOTALL)
+
+
+def format_parameter(key, value):
+    """
+    Convert a parameter value into the text that replaces its placeholder.
+
+    Args:
+        key: The placeholder key, used for error reporting.
+        value: A string, number, dict, list or None.
+
+    Returns:
+        The value as a string. Dicts become one "key::value" line per entry,
+        lists become one line per item and None becomes "None".
+
+    Example:
+        format_parameter("names", ["John", "Jane"])
+        Output: "John\nJane\n"
+    """
+    try:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)):
+            return str(value)
+        if isinstance(value, dict):
+            return "\n".join(k + "::" + v for k, v in value.items())
+        if isinstance(value, list):
+            return "".join(item + "\n" for item in value)
+        if value is None:
+            return "None"
+    except Exception:
+        pass
+    raise Exception(f"ERROR PARSING:\n{key}\n{value}")
+
+
+class PromptTemplate:
+    """
+    A prompt template parsed once into literal text and {{placeholder}} segments.
+
+    Rendering fills every placeholder in a single pass, so the cost depends on
+    the template length once rather than once per parameter. Placeholders
+    without a matching parameter are left in the output unchanged.
+
+    Usage:
+        template = PromptTemplate("Hello {{name}}!")
+        template.render({"name": "John"})
+        Output: "Hello John!"
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.segments = PLACEHOLDER_PATTERN.split(source)
+        self.literals = self.segments[0::2]
+        self.keys = self.segments[1::2]
+        self.placeholders = list(dict.fromkeys(self.keys))
+        self._static_token_counts = {}
+
+    def missing_keys(self, parameters):
+        """
+        Return the placeholders that have no value in the parameters.
+        """
+        return [key for key in self.placeholders if key not in parameters]
+
+    def unused_keys(self, parameters):
+        """
+        Return the parameter keys that do not appear in the template.
+        """
+        return [key for key in parameters if key not in self.placeholders]
+
+    def fill(self, parameters):
+        """
+        Format the value of every placeholder present in the parameters.
+
+        Returns:
+            A dictionary of placeholder key to replacement text.
+        """
+        return {
+            key: format_parameter(key, parameters[key])
+            for key in self.placeholders
+            if key in parameters
+        }
+
+    def render(self, parameters, values=None):
+        """
+        Render the template with the given parameters.
+
+        Args:
+            parameters: A dictionary of placeholder keys to values.
+            values: Optional pre-formatted replacement text, as returned by fill().
+
+        Returns:
+            The rendered prompt.
+        """
+        if values is None:
+            values = self.fill(parameters)
+        parts = list(self.segments)
+        for i in range(1, len(parts), 2):
+            key = parts[i]
+            parts[i] = values[key] if key in values else "{{" + key + "}}"
+        return "".join(parts)
+
+    def static_token_count(self, model=TEXT_MODEL):
+        """
+        Count the tokens in the literal (non-placeholder) text of the template.
+
+        The count is computed once per model. Adding the token counts of the
+        filled values gives the size of a rendered prompt without tokenizing
+        the template again; it can differ by a token or so where a value merges
+        with the text around it.
+        """
+        if model not in self._static_token_counts:
+            self._static_token_counts[model] = sum(
+                count_tokens(literal, model=model) for literal in self.literals
+            )
+        return self._static_token_counts[model]
+
+    def token_count(self, parameters, model=TEXT_MODEL):
+        """
+        Estimate the token count of the rendered prompt, tokenizing only the
+        filled placeholder values.
+        """
+        value_tokens = {
+            key: count_tokens(value, model=model)
+            for key, value in self.fill(parameters).items()
+        }
+        return self.static_token_count(model) + sum(
+            value_tokens.get(key, 0) for key in self.keys
+        )
+
+    def render_budgeted(self, parameters, max_tokens, slots=None, model=TEXT_MODEL, debug=DEBUG):
+        """
+        Render the template so that the prompt fits within a token budget.
+
+        Each filled placeholder is tokenized once. If the prompt is over budget,
+        the lowest-priority slots are trimmed first, never below their
+        min_tokens, and only the trimmed slots are decoded again. The static
+        template text is never trimmed.
+
+        Args:
+            parameters: A dictionary of placeholder keys to values.
+            max_tokens: Total token budget for the rendered prompt.
+            slots: Optional dictionary of placeholder key to slot settings:
+                priority (int, default 0): Higher priority slots are trimmed last.
+                min_tokens (int, default 0): The slot is never trimmed below this.
+                max_tokens (int, optional): The slot is always trimmed to at most this.
+                preserve_top (bool, default True): Keep the start of the value if True,
+                    the end of the value if False, like trim_prompt.
+            model: The model to use for tokenization.
+
+        Returns:
+            The rendered prompt.
+
+        Example:
+            template = compile_prompt("Summarize:\n{{document}}")
+            template.render_budgeted({"document": text}, 1000, {"document": {"min_tokens": 100}})
+        """
+        slots = slots or {}
+        encoding = get_encoding(model)
+        values = self.fill(parameters)
+        tokens = {key: encoding.encode(value) for key, value in values.items()}
+        occurrences = {key: self.keys.count(key) for key in values}
+        settings = {key: slots.get(key, {}) for key in values}
+
+        # Start from each slot's own cap, then trim lowest priority slots first
+        limits = {
+            key: min(len(tokens[key]), settings[key].get("max_tokens", len(tokens[key])))
+            for key in values
+        }
+        order = sorted(values, key=lambda key: settings[key].get("priority", 0))
+
+        def shrink(overflow):
+            for key in order:
+                if overflow <= 0:
+                    break
+                floor = min(settings[key].get("min_tokens", 0), limits[key])
+                # Each token removed from a slot saves one token per occurrence
+                removable = (limits[key] - floor) * occurrences[key]
+                if removable <= 0:
+                    continue
+                cut = min(removable, overflow)
+                limits[key] -= -(-cut // occurrences[key])
+                overflow -= cut
+            return overflow
+
+        budget = max_tokens - self.static_token_count(model)
+        overflow = sum(limits[key] * occurrences[key] for key in values) - budget
+        if overflow > 0 and shrink(overflow) > 0:
+            log(
+                "Prompt does not fit within the token budget even with every slot at its minimum",
+                type="warning",
+                log=debug,
+            )
+
+        def trimmed_values():
+            trimmed = {}
+            for key, value in values.items():
+                if limits[key] >= len(tokens[key]):
+                    trimmed[key] = value
+                elif settings[key].get("preserve_top", True):
+                    trimmed[key] = encoding.decode(tokens[key][: limits[key]])
+                else:
+                    trimmed[key] = encoding.decode(
+                        tokens[key][len(tokens[key]) - limits[key] :]
+                    )
+            return trimmed
+
+        prompt = self.render(parameters, trimmed_values())
+
+        # Tokens can merge across slot boundaries, so check the final prompt once
+        # and trim whatever small remainder is left.
+        overflow = count_tokens(prompt, model=model) - max_tokens
+        if overflow > 0 and shrink(overflow) < overflow:
+            prompt = self.render(parameters, trimmed_values())
+
+        log(f"Rendered prompt within {max_tokens} tokens", log=debug)
+
+        return prompt
+
+
+@functools.lru_cache(maxsize=256)
+def compile_prompt(prompt_template):
+    """
+    Compile a template string into a PromptTemplate, reusing earlier compilations.
+
+    Args:
+        prompt_template: A template string that contains {{placeholders}}.
+
+    Returns:
+        A PromptTemplate. The same object is returned for the same source string.
+
+    Example:
+        compile_prompt("Hello {{name}}!").placeholders
+        Output: ["name"]
+    """
+    return PromptTemplate(prompt_template)
+
+
+def compose_prompt(
+    prompt_template,
+    parameters,
+    debug=DEBUG,
+    max_tokens=None,
+    slots=None,
+    model=TEXT_MODEL,
+):
     """
     Composes a prompt using a template and parameters.
     Parameter keys are enclosed in double curly brackets and replaced with parameter values.
 
     Args:
-        prompt_template: A template string that contains placeholders for the parameters.
+        prompt_template: A template string (or PromptTemplate) that contains placeholders for the parameters.
         parameters: A dictionary containing key-value pairs to replace the placeholders.
+        max_tokens: Optional token budget. If set, parameter values are trimmed so the
+                    prompt fits, see PromptTemplate.render_budgeted.
+        slots: Optional per-parameter priorities and limits used with max_tokens.
+        model: The model to use for tokenization when max_tokens is set.
 
     Returns:
         A string where all placeholders have been replaced with actual values from the parameters.
@@ -161,31 +618,22 @@ def compose_prompt(prompt_template, parameters, debug=DEBUG):
         compose_prompt("Hello {{name}}!", {"name": "John"})
         Output: "Hello John!"
     """
-    prompt = prompt_template  # Initial prompt template.
-
-    # Replacing placeholders in the template with the actual values from the parameters.
-    for key, value in parameters.items():
-        # check if "{{" + key + "}}" is in prompt
-        # if not, continue
-        if "{{" + key + "}}" not in prompt:
-            continue
-        try:
-            if isinstance(value, str):
-                prompt = prompt.replace("{{" + key + "}}", value)
-            elif isinstance(value, int):
-                prompt = prompt.replace("{{" + key + "}}", str(value))
-            elif isinstance(value, dict):
-                for k, v in value.items():
-                    prompt = prompt.replace("{{" + key + "}}", k + "::" + v)
-            elif isinstance(value, list):
-                for item in value:
-                    prompt = prompt.replace("{{" + key + "}}", item + "\n")
-            elif value is None:
-                prompt = prompt.replace("{{" + key + "}}", "None")
-            else:
-                raise Exception(f"ERROR PARSING:\n{key}\n{value}")
-        except:
-            raise Exception(f"ERROR PARSING:\n{key}\n{value}")
+    template = (
+        prompt_template
+        if isinstance(prompt_template, PromptTemplate)
+        else compile_prompt(prompt_template)
+    )
+    if max_tokens is None:
+        prompt = template.render(parameters)
+    else:
+        prompt = template.render_budgeted(
+            parameters, max_tokens, slots=slots, model=model, debug=debug
+        )
+
+    if debug:
+        missing_keys = template.missing_keys(parameters)
+        if missing_keys:
+            log(f"Prompt is missing parameters: {missing_keys}", type="warning")
 
     log(f"Composed prompt:\n{prompt}", log=debug)
 
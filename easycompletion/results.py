@@ -0,0 +1,134 @@
+class Result:
+    """
+    Base class for compact result objects that can also be read like dictionaries.
+
+    Subclasses list their fields in __slots__, so a result costs a fixed amount
+    of memory and no per-instance dictionary. result["text"], result.get("text"),
+    "text" in result, dict(result) and comparison with a dictionary all work as
+    they did when results were plain dictionaries.
+    """
+
+    __slots__ = ()
+    field_names = ()
+    # Fields that are only listed when they are set
+    optional_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.field_names = cls.field_names + tuple(cls.__dict__.get("__slots__", ()))
+
+    @classmethod
+    def fields(cls):
+        return cls.field_names
+
+    def __init__(self, **values):
+        for field in self.fields():
+            setattr(self, field, values.pop(field, None))
+        if values:
+            raise TypeError(f"Unknown fields for {type(self).__name__}: {', '.join(values)}")
+
+    def keys(self):
+        return [
+            field for field in self.fields()
+            if field not in self.optional_fields or getattr(self, field, None) is not None
+        ]
+
+    def __getitem__(self, key):
+        if key not in self.fields():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields():
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields() else default
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def to_dict(self):
+        """
+        Returns the result as plain dictionaries and lists, e.g. for JSON serialization.
+        """
+        return {
+            key: value.to_dict() if isinstance(value, Result) else value
+            for key, value in self.items()
+            if key != "raw"
+        }
+
+    def __eq__(self, other):
+        if isinstance(other, Result):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == {
+                key: value.to_dict() if isinstance(value, Result) else value
+                for key, value in other.items()
+            }
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{key}={value!r}' for key, value in self.items())})"
+
+
+class Usage(Result):
+    """
+    Token usage of a request.
+    """
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+    @classmethod
+    def from_response(cls, usage):
+        """
+        Copies the token counts out of a response's usage, so the response itself is not kept alive.
+        """
+        if usage is None:
+            return None
+        return cls(
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            total_tokens=usage.get("total_tokens", 0),
+        )
+
+
+class Prefix(Result):
+    """
+    The static prefix of a request (model, functions, system message) and how much of the prompt was served from the provider's cache.
+    """
+
+    __slots__ = ("hash", "tokens", "cached_tokens", "cached_ratio")
+
+
+class CompletionResult(Result):
+    """
+    The result of text_completion and chat_completion.
+
+    "raw" holds the full API response only if it was requested with return_raw=True.
+    "prefix" describes the request's reusable prefix, see describe_prefix.
+    """
+
+    __slots__ = ("text", "usage", "finish_reason", "error", "prefix", "raw")
+    optional_fields = ("prefix", "raw")
+
+
+class FunctionCallResult(CompletionResult):
+    """
+    The result of function_completion.
+    """
+
+    __slots__ = ("function_name", "arguments", "function_calls")
@@ -0,0 +1,306 @@
+import math
+import time
+import asyncio
+import itertools
+import threading
+from collections import deque
+
+from .concurrency import Waiter
+
+# Lower values are served first
+PRIORITIES = {
+    "interactive": 0,
+    "default": 1,
+    "batch": 2,
+}
+
+
+def resolve_priority(priority):
+    """
+    Returns the numeric priority for a priority name or number.
+
+    Raises:
+        ValueError: If priority is neither a known name nor an integer.
+    """
+    if isinstance(priority, str):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority!r}, expected one of {', '.join(PRIORITIES)} or an integer")
+        return PRIORITIES[priority]
+    if isinstance(priority, int) and not isinstance(priority, bool):
+        return priority
+    raise ValueError(f"Invalid priority: {priority!r}, expected one of {', '.join(PRIORITIES)} or an integer")
+
+
+class RequestRejected(Exception):
+    """
+    Raised when the scheduler drops a request, because the queue was full or the deadline passed.
+    """
+
+
+arrivals = itertools.count()
+
+
+class Entry(Waiter):
+    __slots__ = ("priority", "tenant", "deadline", "reason", "arrival")
+
+    def __init__(self, priority, tenant, deadline, **kwargs):
+        super().__init__(**kwargs)
+        self.arrival = next(arrivals)
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.reason = None
+
+    def reject(self, reason):
+        self.reason = reason
+        # Wake the caller the same way a grant does; granted stays False
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+
+class Scheduler:
+    """
+    Orders requests by priority and shares capacity fairly between tenants.
+
+    Requests wait in one queue per priority class and, within a class, in one
+    queue per tenant served round-robin, so one tenant's burst cannot starve
+    another. When the queue is full a new request displaces the newest request
+    of a lower priority class, or is rejected. Requests whose deadline has
+    passed are dropped instead of being sent.
+
+    Capacity is max_concurrency, or the current limit of an AdaptiveLimiter.
+
+    Usage:
+        scheduler = Scheduler(max_concurrency=16)
+        text_completion(text, scheduler=scheduler, priority="interactive", tenant="acme")
+    """
+
+    def __init__(self, max_concurrency=8, max_queue_depth=1000, limiter=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.limiter = limiter
+        self.in_flight = 0
+        self.depth = 0
+        # priority -> tenant -> deque of entries, and the round-robin order of tenants
+        self.queues = {}
+        self.rotations = {}
+        self.lock = threading.Lock()
+        self.granted = 0
+        self.shed = 0
+        self.expired = 0
+
+    def capacity(self):
+        if self.limiter is not None:
+            return max(self.limiter.min_limit, math.floor(self.limiter.limit))
+        return self.max_concurrency
+
+    def _enqueue(self, entry):
+        tenants = self.queues.setdefault(entry.priority, {})
+        if entry.tenant not in tenants:
+            tenants[entry.tenant] = deque()
+            self.rotations.setdefault(entry.priority, deque()).append(entry.tenant)
+        tenants[entry.tenant].append(entry)
+        self.depth += 1
+
+    def _remove(self, entry):
+        tenants = self.queues[entry.priority]
+        tenants[entry.tenant].remove(entry)
+        self.depth -= 1
+        if not tenants[entry.tenant]:
+            del tenants[entry.tenant]
+            self.rotations[entry.priority].remove(entry.tenant)
+
+    def _pop(self):
+        for priority in sorted(self.queues):
+            rotation = self.rotations.get(priority)
+            if not rotation:
+                continue
+            tenant = rotation.popleft()
+            queue = self.queues[priority][tenant]
+            entry = queue.popleft()
+            self.depth -= 1
+            if queue:
+                rotation.append(tenant)
+            else:
+                del self.queues[priority][tenant]
+            return entry
+        return None
+
+    def _shed_for(self, priority):
+        # Displace the newest request from the lowest priority class below this one
+        for lowest in sorted(self.queues, reverse=True):
+            if lowest <= priority:
+                return False
+            rotation = self.rotations.get(lowest)
+            if not rotation:
+                continue
+            newest = max(
+                (self.queues[lowest][tenant][-1] for tenant in rotation),
+                key=lambda entry: entry.arrival,
+            )
+            self._remove(newest)
+            self.shed += 1
+            newest.reject("Request shed: queue is full")
+            return True
+        return False
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.in_flight < self.capacity():
+            entry = self._pop()
+            if entry is None:
+                return
+            if entry.deadline is not None and entry.deadline <= now:
+                self.expired += 1
+                entry.reject("Request dropped: deadline passed while queued")
+                continue
+            self.in_flight += 1
+            self.granted += 1
+            entry.grant()
+
+    def _admit(self, entry):
+        """
+        Queue an entry. Returns True if it was granted immediately.
+        """
+        if entry.deadline is not None and entry.deadline <= time.monotonic():
+            self.expired += 1
+            raise RequestRejected("Request dropped: deadline already passed")
+        if self.depth == 0 and self.in_flight < self.capacity():
+            self.in_flight += 1
+            self.granted += 1
+            entry.granted = True
+            return True
+        if self.depth >= self.max_queue_depth and not self._shed_for(entry.priority):
+            self.shed += 1
+            raise RequestRejected("Request shed: queue is full")
+        self._enqueue(entry)
+        return False
+
+    def _give_up(self, entry):
+        # Called with the lock held when a waiting caller stops waiting
+        if entry.granted:
+            return True
+        if entry.reason is None:
+            self._remove(entry)
+            self.expired += 1
+            entry.reason = "Request dropped: deadline passed while queued"
+        return False
+
+    def acquire(self, priority="default", tenant=None, deadline=None):
+        """
+        Block until the request may be sent.
+
+        Args:
+            priority (str | int): "interactive", "default", "batch" or a number, lower first.
+            tenant (str | None): Requests are shared fairly between tenants of the same priority.
+            deadline (float | None): time.monotonic() value after which the caller no longer wants a response.
+
+        Raises:
+            ValueError: If priority is not a known name or an integer.
+            RequestRejected: If the request was shed or its deadline passed.
+        """
+        entry = Entry(
+            resolve_priority(priority), tenant, deadline, event=threading.Event()
+        )
+        with self.lock:
+            if self._admit(entry):
+                return
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        entry.event.wait(timeout)
+        with self.lock:
+            if self._give_up(entry):
+                return
+        raise RequestRejected(entry.reason)
+
+    async def acquire_async(self, priority="default", tenant=None, deadline=None):
+        """
+        Wait without blocking the event loop until the request may be sent. See acquire.
+        """
+        loop = asyncio.get_running_loop()
+        entry = Entry(
+            resolve_priority(priority),
+            tenant,
+            deadline,
+            loop=loop,
+            future=loop.create_future(),
+        )
+        with self.lock:
+            if self._admit(entry):
+                return
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(entry.future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self.lock:
+                if self._give_up(entry):
+                    self.in_flight -= 1
+                    self._dispatch()
+            raise
+        with self.lock:
+            if self._give_up(entry):
+                return
+        raise RequestRejected(entry.reason)
+
+    def release(self):
+        """
+        Mark a request as finished and let the next queued request through.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def slot(self, priority="default", tenant=None, deadline=None):
+        """
+        Returns a context manager that waits for the request's turn and releases it on exit.
+
+        Works with both "with" and "async with".
+
+        Raises:
+            ValueError: If priority is not a known name or an integer.
+        """
+        return ScheduledSlot(self, resolve_priority(priority), tenant, deadline)
+
+    def stats(self):
+        """
+        Returns the requests in flight, queued per priority, and totals granted, shed and expired.
+        """
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "capacity": self.capacity(),
+                "queued": {
+                    priority: sum(len(queue) for queue in tenants.values())
+                    for priority, tenants in self.queues.items()
+                },
+                "granted": self.granted,
+                "shed": self.shed,
+                "expired": self.expired,
+            }
+
+
+class ScheduledSlot:
+    __slots__ = ("scheduler", "priority", "tenant", "deadline")
+
+    def __init__(self, scheduler, priority, tenant, deadline):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+
+    def __enter__(self):
+        self.scheduler.acquire(self.priority, self.tenant, self.deadline)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler.release()
+
+    async def __aenter__(self):
+        await self.scheduler.acquire_async(self.priority, self.tenant, self.deadline)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
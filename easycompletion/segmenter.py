@@ -0,0 +1,168 @@
+import re
+
+# Boundary strengths. Each segment carries the strength of the boundary that ends it.
+SENTENCE = 1
+PARAGRAPH = 2
+
+BOUNDARY_PATTERN = re.compile(
+    r"\n\s*"  # line and paragraph breaks
+    r"|[.!?…]+[\"'”’)\]»]*(?=\s)"  # sentence ends, which are followed by whitespace
+    r"|[。！？｡．]+[」』”’）)]*"  # CJK sentence ends, which need no whitespace
+)
+
+# Words that end with a period without ending the sentence, lowercased and without the final period
+ABBREVIATIONS = frozenset(
+    [
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "ft", "vs", "etc", "e.g", "i.e", "cf",
+        "al", "approx", "dept", "est", "fig", "figs", "inc", "ltd", "co", "corp", "no", "nos", "vol",
+        "vols", "pp", "ed", "eds", "rev", "gen", "gov", "sen", "rep", "lt", "col", "sgt", "capt",
+        "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    ]
+)
+
+OPENING_PUNCTUATION = "([{\"'“‘«"
+# Characters a boundary may still be forming from at the end of streamed text
+TRAILING_PUNCTUATION = ".!?…\"'”’)]»。！？｡．」』）"
+
+
+class Segmenter:
+    """
+    Splits text into sentences and paragraphs in one linear scan, including text that arrives in pieces.
+
+    Each segment is returned as (text, level), where level is SENTENCE or
+    PARAGRAPH for the boundary that ends it. Whitespace between segments
+    starts the following segment, so joining the segments gives back the
+    input exactly, and token counts of segments add up to about the token
+    count of the whole.
+
+    Periods after abbreviations, initials and before lowercase words do not
+    end sentences. Line breaks end sentences and blank lines end paragraphs.
+    CJK sentence punctuation ends sentences without following whitespace.
+
+    Usage:
+        segmenter = Segmenter()
+        for piece in stream:
+            for text, level in segmenter.feed(piece):
+                ...
+        for text, level in segmenter.flush():
+            ...
+    """
+
+    def __init__(self, abbreviations=ABBREVIATIONS):
+        self.abbreviations = abbreviations
+        self.buffer = ""
+        # Where the next boundary search starts
+        self.scan = 0
+
+    def feed(self, text):
+        """
+        Adds text and returns the segments that are now complete.
+        """
+        self.buffer += text
+        return self._segments(final=False)
+
+    def flush(self):
+        """
+        Returns the remaining segments at the end of the input, and resets the segmenter.
+        """
+        segments = self._segments(final=True)
+        if self.buffer:
+            segments.append((self.buffer, PARAGRAPH))
+        self.buffer = ""
+        self.scan = 0
+        return segments
+
+    def _segments(self, final):
+        buffer = self.buffer
+        segments = []
+        start = 0
+        scan = self.scan
+        for match in BOUNDARY_PATTERN.finditer(buffer, self.scan):
+            boundary = self._boundary(match, start, final)
+            if boundary is None:
+                # Not decidable until more text arrives
+                scan = match.start()
+                break
+            scan = match.end()
+            position, level = boundary
+            if level and position > start:
+                segments.append((buffer[start:position], level))
+                start = position
+        else:
+            # Punctuation at the end may become a boundary once whitespace follows it
+            last = scan
+            scan = len(buffer)
+            while scan > last and buffer[scan - 1] in TRAILING_PUNCTUATION:
+                scan -= 1
+        self.buffer = buffer[start:]
+        self.scan = scan - start
+        return segments
+
+    def _boundary(self, match, start, final):
+        """
+        Returns (position, level) for a candidate boundary, level 0 if it is not a boundary, or None to wait for more text.
+        """
+        buffer = self.buffer
+        text = match.group()
+        end = match.end()
+
+        if text[0] == "\n":
+            if end == len(buffer) and not final:
+                return None
+            return match.start(), PARAGRAPH if text.count("\n") > 1 else SENTENCE
+
+        if text[0] not in ".!?…":
+            # CJK punctuation, which may still be followed by closing quotes
+            if end == len(buffer) and not final:
+                return None
+            return end, SENTENCE
+
+        # Find the next word, which decides whether a period ends the sentence
+        after = end
+        while after < len(buffer) and buffer[after].isspace():
+            after += 1
+        if after == len(buffer) and not final:
+            return None
+        level = PARAGRAPH if buffer.count("\n", end, after) > 1 else SENTENCE
+
+        if text[0] in ".…" and after < len(buffer):
+            following = buffer[after]
+            if following.islower() or following.isdigit():
+                return end, 0
+            if text[0] == "." and len(text.rstrip("\"'”’)]»")) == 1 and self._is_abbreviation(match.start(), start):
+                return end, 0
+        return end, level
+
+    def _is_abbreviation(self, period, start):
+        # Look back at most a short word, so the scan stays linear
+        word_start = period
+        while word_start > max(start, period - 12) and not self.buffer[word_start - 1].isspace():
+            word_start -= 1
+        word = self.buffer[word_start:period].lstrip(OPENING_PUNCTUATION).lower()
+        return word in self.abbreviations or (len(word) == 1 and word.isalpha()) or "." in word
+
+
+def segment_text(text, segmenter=None):
+    """
+    Splits text into (text, level) segments of sentences and paragraphs.
+
+    Args:
+        text: The text to split.
+        segmenter: A Segmenter, or any object with the same feed and flush methods. Default is a new Segmenter.
+
+    Example:
+        >>> segment_text("Dr. Smith arrived. He sat down.\\n\\nThe end.")
+        [('Dr. Smith arrived.', 1), (' He sat down.', 2), ('\\n\\nThe end.', 2)]
+    """
+    segmenter = segmenter or Segmenter()
+    return segmenter.feed(text) + segmenter.flush()
+
+
+def iter_segments(pieces, segmenter=None):
+    """
+    Yields (text, level) segments from an iterable of text pieces as soon as each segment is complete.
+    """
+    segmenter = segmenter or Segmenter()
+    for piece in pieces:
+        yield from segmenter.feed(piece)
+    yield from segmenter.flush()
@@ -1,2 +1,17 @@
 from .model import *
-from .prompt import *
\ No newline at end of file
+from .prompt import *
+from .embedding import *
+from .batch import *
+from .concurrency import *
+from .scheduler import *
+from .results import *
+from .ledger import *
+from .cache import *
+from .prefix import *
+from .segmenter import *
+from .corpus import *
+from .backends import *
+from .cascade import *
+from .config import *
+from .functions import *
+from .metrics import *
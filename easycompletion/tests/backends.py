@@ -0,0 +1,131 @@
+import gc
+import os
+import json
+import weakref
+import itertools
+
+import pytest
+
+from easycompletion.backends import (
+    BackendError,
+    CassetteBackend,
+    LocalBackend,
+    OpenAIBackend,
+    get_backend,
+    register_backend,
+    request_hash,
+)
+from easycompletion.model import build_chat_request, get_function_calls, text_completion
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
+
+classify_function = {
+    "name": "classify",
+    "parameters": {"type": "object", "properties": {"label": {"type": "string"}}, "required": ["label"]},
+}
+summarize_function = {
+    "name": "summarize",
+    "parameters": {"type": "object", "properties": {"summary": {"type": "string"}}, "required": ["summary"]},
+}
+
+
+def test_local_backend_translate():
+    backend = LocalBackend("http://localhost:8080/v1/", model="local-model")
+    messages = [{"role": "user", "content": "Classify this"}]
+    request = build_chat_request(messages, "gpt-3.5-turbo", 0.0, [classify_function, summarize_function], {"name": "classify"})
+    payload = backend.translate(request)
+    assert backend.base_url == "http://localhost:8080/v1"
+    assert payload["model"] == "local-model"
+    assert "functions" not in payload and "function_call" not in payload
+    assert payload["messages"][0]["role"] == "system" and payload["messages"][1:] == messages
+    # A forced function call only allows that function
+    schema = payload["response_format"]["schema"]
+    assert [option["properties"]["name"]["const"] for option in schema["oneOf"]] == ["classify"]
+
+    request = build_chat_request(messages, "gpt-3.5-turbo", 0.0, [classify_function, summarize_function], None, True)
+    schema = backend.translate(request)["response_format"]["schema"]
+    assert schema["type"] == "array" and len(schema["items"]["oneOf"]) == 2
+
+    # Requests without functions are sent as they are
+    assert backend.translate(build_chat_request(messages, "gpt-3.5-turbo", 0.0))["messages"] == messages
+
+
+def test_local_backend_convert():
+    backend = LocalBackend()
+    request = build_chat_request([{"role": "user", "content": "x"}], "gpt-3.5-turbo", 0.0, [classify_function])
+    response = backend.convert(request, chat_response(json.dumps({"name": "classify", "arguments": {"label": "spam"}})))
+    assert response["choices"][0]["finish_reason"] == "function_call"
+    calls = get_function_calls(response)
+    assert [(call["name"], json.loads(call["arguments"])) for call in calls] == [("classify", {"label": "spam"})]
+
+    request = build_chat_request([{"role": "user", "content": "x"}], "gpt-3.5-turbo", 0.0, [classify_function], None, True)
+    content = json.dumps([{"name": "classify", "arguments": {"label": "a"}}, {"name": "classify", "arguments": {"label": "b"}}])
+    response = backend.convert(request, chat_response(content))
+    assert [json.loads(call["arguments"])["label"] for call in get_function_calls(response)] == ["a", "b"]
+
+    # Invalid JSON is left as text for validation to report
+    response = backend.convert(request, chat_response("not json"))
+    assert response["choices"][0]["message"]["content"] == "not json"
+
+
+def test_get_backend():
+    assert isinstance(get_backend(), OpenAIBackend)
+    local = register_backend("test-local", LocalBackend())
+    assert get_backend("test-local") is local
+    assert get_backend(local) is local
+    with pytest.raises(ValueError):
+        get_backend("missing")
+
+
+def content(response):
+    return response["choices"][0]["message"]["content"]
+
+
+def test_cassette_backend(tmp_path):
+    path = str(tmp_path / "cassettes" / "test.json")
+    request = build_chat_request([{"role": "user", "content": "Hi"}], "gpt-3.5-turbo", 0.0)
+    assert request_hash(request) == request_hash(dict(reversed(list(request.items()))))
+
+    sent = itertools.count(1)
+    inner = ScriptedBackend(lambda request: chat_response(f"response {next(sent)}"), requires_api_key=True)
+    recorder = CassetteBackend(path, mode="auto", backend=inner)
+    # A repeated request, like a retry, is sent again while recording, not answered with the same response
+    assert content(recorder.create(request)) == "response 1"
+    assert content(recorder.create(request)) == "response 2"
+    assert len(inner.requests) == 2 and recorder.stats()["recorded"] == 2
+    # Responses are written once, when the cassette is closed
+    assert not os.path.exists(path)
+    recorder.close()
+
+    # A new session replays from the file, in recorded order, without sending anything
+    player = CassetteBackend(path, mode="replay", backend=inner)
+    assert not player.requires_api_key
+    assert content(player.create(request)) == "response 1"
+    assert content(player.create(request)) == "response 2"
+    other = build_chat_request([{"role": "user", "content": "Bye"}], "gpt-3.5-turbo", 0.0)
+    with pytest.raises(BackendError):
+        player.create(other)
+    assert len(inner.requests) == 2
+    assert player.stats() == {"hits": 2, "misses": 1, "recorded": 0, "interactions": 1, "unused": 0}
+
+    # Completions replay through the cassette like any backend; past the end the last response repeats
+    result = text_completion("Hi", model="gpt-3.5-turbo", backend=player, ledger=False)
+    assert result["text"] == "response 2" and result["error"] is None
+
+    # In auto mode, recorded responses are replayed and requests past them are recorded
+    with CassetteBackend(path, mode="auto", backend=inner) as resumed:
+        assert [content(resumed.create(request)) for _ in range(3)] == ["response 1", "response 2", "response 3"]
+        assert len(inner.requests) == 3
+    replayed = CassetteBackend(path, mode="replay")
+    assert [content(replayed.create(request)) for _ in range(3)] == ["response 1", "response 2", "response 3"]
+
+    with CassetteBackend(path, mode="record", backend=inner) as rerecorder:
+        assert content(rerecorder.create(request)) == "response 4"
+    assert content(CassetteBackend(path, mode="replay").create(request)) == "response 4"
+
+    # A closed cassette is no longer held for the save at exit
+    cassette = CassetteBackend(path, mode="auto", backend=inner)
+    reference = weakref.ref(cassette)
+    cassette.close()
+    del cassette
+    gc.collect()
+    assert reference() is None, "Test closed cassette was kept alive"
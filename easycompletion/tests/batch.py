@@ -0,0 +1,65 @@
+import json
+
+from easycompletion import batch
+from easycompletion.batch import run_batch, hash_request
+
+
+def test_hash_request():
+    assert hash_request({"id": 1, "text": "a", "model": "m"}) == hash_request(
+        {"model": "m", "text": "a", "id": 2}
+    ), "Test hash_request failed"
+
+
+def test_run_batch_resumes(tmp_path, monkeypatch):
+    calls = []
+
+    async def fake_completion(text=None, **kwargs):
+        calls.append(text)
+        if text == "bad":
+            return {"error": "failed"}
+        return {"text": text.upper(), "error": None}
+
+    monkeypatch.setitem(batch.BATCH_COMPLETIONS, "function", fake_completion)
+    input_path = str(tmp_path / "requests.jsonl")
+    output_path = str(tmp_path / "results.jsonl")
+    with open(input_path, "w") as f:
+        for i, text in enumerate(["a", "b", "a", "bad"]):
+            f.write(json.dumps({"id": i, "text": text}) + "\n")
+
+    summary = run_batch(input_path, output_path=output_path, concurrency=2)
+    assert summary["total"] == 3 and summary["done"] == 2, "Test run_batch failed"
+    assert sorted(calls) == ["a", "b", "bad"], "Duplicate requests were not skipped"
+
+    with open(input_path, "a") as f:
+        f.write(json.dumps({"id": 4, "text": "c"}) + "\n")
+    summary = run_batch(input_path, output_path=output_path, max_attempts=1)
+    assert sorted(calls) == ["a", "b", "bad", "c"], "Completed requests were run again"
+    assert summary["done"] == 3 and summary["failed"] == 1, "Test run_batch failed"
+
+    with open(output_path) as f:
+        results = [json.loads(line) for line in f]
+    assert [r["id"] for r in results] == [0, 1, 2, 3, 4], "Test run_batch failed"
+    assert results[2]["result"]["text"] == "A", "Test run_batch failed"
+
+
+def test_run_batch_invalid_lines(tmp_path, monkeypatch):
+    async def fake_completion(text=None, **kwargs):
+        return {"text": text, "error": None}
+
+    monkeypatch.setitem(batch.BATCH_COMPLETIONS, "function", fake_completion)
+    input_path = str(tmp_path / "requests.jsonl")
+    output_path = str(tmp_path / "results.jsonl")
+    with open(input_path, "w") as f:
+        for i in range(40):
+            f.write(json.dumps({"id": i, "text": str(i), **({"type": "bogus"} if i < 3 else {})}) + "\n")
+        f.write("not json\n")
+
+    # A bad line must fail on its own, not stop the workers and hang the job
+    summary = run_batch(input_path, output_path=output_path, concurrency=2)
+    assert summary["done"] == 37 and summary["failed"] == 4, "Test run_batch invalid lines failed"
+
+    with open(output_path) as f:
+        results = [json.loads(line) for line in f]
+    assert "Unknown type: bogus" in results[0]["result"]["error"]
+    assert "Invalid JSON" in results[40]["result"]["error"]
+    assert results[3]["result"]["text"] == "3"
@@ -0,0 +1,61 @@
+from easycompletion.cache import SemanticCache, normalize_prompt
+from easycompletion.results import CompletionResult, FunctionCallResult
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  What is  the\ncapital of France?? ") == "what is the capital of france"
+    assert normalize_prompt("ＡＢＣ") == "abc", "Test normalize_prompt failed"
+
+
+def test_semantic_cache_exact():
+    cache = SemanticCache()
+    context = {"model": "gpt-3.5-turbo", "type": "text"}
+    lookup = cache.lookup("What is the capital of France?", context)
+    assert lookup[0] is None
+    cache.store(lookup, CompletionResult(text="Paris", error=None))
+
+    result, *_ = cache.lookup("what is the capital of  france", context)
+    assert result["text"] == "Paris", "Test semantic cache missed a normalized prompt"
+    result, *_ = cache.lookup("what is the capital of france", {"model": "gpt-4", "type": "text"})
+    assert result is None, "Test semantic cache ignored the context"
+
+    # Errors are never cached
+    lookup = cache.lookup("Fail", context)
+    cache.store(lookup, CompletionResult(error="failed"))
+    assert cache.lookup("Fail", context)[0] is None
+    assert cache.stats()["exact_hits"] == 1 and cache.stats()["misses"] == 4
+
+
+def test_semantic_cache_copies_hits():
+    cache = SemanticCache()
+    context = {"model": "gpt-3.5-turbo", "type": "function"}
+    lookup = cache.lookup("Classify this", context)
+    cache.store(lookup, FunctionCallResult(
+        function_name="classify",
+        arguments={"label": "spam"},
+        function_calls=[{"id": None, "function_name": "classify", "arguments": {"label": "spam"}}],
+        usage={"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+        error=None,
+    ))
+
+    # Changing a hit, however deep, must not change what the next hit returns
+    result, *_ = cache.lookup("Classify this", context)
+    result["arguments"]["label"] = "ham"
+    result["function_calls"][0]["arguments"]["label"] = "ham"
+    result["function_calls"].append({})
+    result["usage"]["prompt_tokens"] = 0
+    result, *_ = cache.lookup("Classify this", context)
+    assert result["arguments"] == {"label": "spam"}, "Test cache hit was changed by a caller"
+    assert result["function_calls"] == [{"id": None, "function_name": "classify", "arguments": {"label": "spam"}}]
+    assert result["usage"]["prompt_tokens"] == 10
+
+
+def test_semantic_cache_similarity():
+    vectors = {"capital of france": [1.0, 0.0], "france capital": [0.99, 0.1], "weather": [0.0, 1.0]}
+    cache = SemanticCache(similarity_threshold=0.95, embed_function=lambda texts: [vectors[texts[0]]])
+    lookup = cache.lookup("Capital of France", {})
+    cache.store(lookup, CompletionResult(text="Paris", error=None))
+
+    assert cache.lookup("France capital?", {})[0]["text"] == "Paris"
+    assert cache.lookup("Weather", {})[0] is None
+    assert cache.stats()["similar_hits"] == 1, "Test semantic cache similarity failed"
@@ -0,0 +1,59 @@
+import pytest
+
+from easycompletion.cascade import ModelCascade
+from easycompletion.tests.scripted import chat_response
+
+classify_function = {
+    "name": "classify",
+    "parameters": {"type": "object", "properties": {"label": {"type": "string"}}, "required": ["label"]},
+}
+
+
+def call_response(arguments):
+    return chat_response(function_name="classify", arguments=arguments, prompt_tokens=1000, completion_tokens=10)
+
+
+def run_steps(steps, responses):
+    """
+    Drives a completion generator, answering its requests from responses. Returns (result, models requested).
+    """
+    models = []
+    responses = iter(responses)
+    try:
+        step, value = next(steps)
+        while True:
+            if step != "sleep":
+                models.append(value["model"])
+                step, value = steps.send((next(responses), None))
+            else:
+                step, value = steps.send(None)
+    except StopIteration as stop:
+        return stop.value, models
+
+
+def test_cascade_escalates_invalid_calls():
+    cascade = ModelCascade(["gpt-3.5-turbo", "gpt-4"])
+    options = dict(text="Classify: spam", functions=[classify_function], api_key="test", repair_turns=0)
+
+    result, models = run_steps(cascade.steps(**options), [call_response({"label": "spam"})])
+    assert models == ["gpt-3.5-turbo"] and result["arguments"] == {"label": "spam"}
+
+    # A call missing its required argument can't be repaired, so it goes to the next model
+    result, models = run_steps(cascade.steps(**options), [call_response({}), call_response({"label": "spam"})])
+    assert models == ["gpt-3.5-turbo", "gpt-4"] and result["error"] is None
+    assert result["usage"]["prompt_tokens"] == 2000, "Test cascade usage failed"
+
+    stats = cascade.stats()
+    assert stats["calls"] == 2
+    assert stats["tiers"]["gpt-3.5-turbo"]["attempts"] == 2 and stats["tiers"]["gpt-3.5-turbo"]["acceptance_rate"] == 0.5
+    assert stats["tiers"]["gpt-4"]["accepted"] == 1 and stats["tiers"]["gpt-4"]["cost"] > 0
+
+
+def test_cascade_accept_check():
+    cascade = ModelCascade(["gpt-3.5-turbo", "gpt-4"], accept=lambda result: result["arguments"]["label"] != "unsure")
+    options = dict(text="Classify: spam", functions=[classify_function], api_key="test")
+    result, models = run_steps(cascade.steps(**options), [call_response({"label": "unsure"}), call_response({"label": "spam"})])
+    assert models == ["gpt-3.5-turbo", "gpt-4"] and result["arguments"] == {"label": "spam"}
+
+    with pytest.raises(ValueError):
+        ModelCascade([])
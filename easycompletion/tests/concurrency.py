@@ -0,0 +1,88 @@
+import time
+import asyncio
+import pytest
+
+from easycompletion.concurrency import AdaptiveLimiter
+
+
+class RateLimitError(Exception):
+    pass
+
+
+def test_limiter_grows_and_backs_off():
+    limiter = AdaptiveLimiter(initial_limit=4, max_limit=32)
+    for _ in range(50):
+        for _ in range(4):
+            limiter.acquire()
+        for _ in range(4):
+            limiter.release(latency=0.1)
+    grown = limiter.stats()["limit"]
+    assert grown > 4, "Test limiter did not grow"
+
+    with pytest.raises(RateLimitError):
+        with limiter.slot():
+            raise RateLimitError()
+    assert limiter.stats()["limit"] <= grown / 2, "Test limiter did not back off"
+
+    with pytest.raises(ValueError):
+        with limiter.slot():
+            raise ValueError()
+    assert limiter.stats()["in_flight"] == 0, "Test limiter leaked a slot"
+
+
+@pytest.mark.asyncio
+async def test_limiter_bounds_concurrency():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+    running = 0
+    peak = 0
+
+    async def task():
+        nonlocal running, peak
+        async with limiter.slot():
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(task() for _ in range(10)))
+    assert peak == 2, "Test limiter_bounds_concurrency failed"
+    assert limiter.stats()["in_flight"] == 0, "Test limiter leaked a slot"
+
+
+@pytest.mark.asyncio
+async def test_limiter_slot_deadline():
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+    limiter.acquire()
+    deadline = time.monotonic() + 0.05
+    with pytest.raises(TimeoutError):
+        with limiter.slot(deadline):
+            pass
+    with pytest.raises(TimeoutError):
+        async with limiter.slot(deadline):
+            pass
+    assert limiter.stats()["waiting"] == 0, "Test limiter kept an expired waiter"
+    limiter.release()
+    async with limiter.slot(time.monotonic() + 1):
+        assert limiter.stats()["in_flight"] == 1
+    assert limiter.stats()["in_flight"] == 0, "Test limiter leaked a slot"
+
+
+@pytest.mark.asyncio
+async def test_limiter_slot_caller_deadline():
+    limiter = AdaptiveLimiter(initial_limit=4)
+    # A request cut off by its caller's deadline says nothing about the backend
+    with pytest.raises(asyncio.TimeoutError):
+        async with limiter.slot(time.monotonic() + 0.02):
+            await asyncio.wait_for(asyncio.sleep(1), 0.02)
+    with pytest.raises(TimeoutError):
+        with limiter.slot(time.monotonic()):
+            raise TimeoutError("Request timed out")
+    stats = limiter.stats()
+    assert stats["limit"] == 4 and stats["errors"] == 0 and stats["successes"] == 0, "Test caller deadline was counted"
+    assert stats["in_flight"] == 0, "Test limiter leaked a slot"
+
+    # A timeout before the deadline is still overload
+    with pytest.raises(TimeoutError):
+        with limiter.slot(time.monotonic() + 10):
+            raise TimeoutError("Request timed out")
+    assert limiter.stats()["limit"] == 2, "Test limiter did not back off"
@@ -0,0 +1,64 @@
+import dataclasses
+import threading
+
+import pytest
+
+from easycompletion.client import Client
+from easycompletion.config import Config, configure, get_config
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
+
+
+def key_recording_backend():
+    return ScriptedBackend([chat_response("ok")], name="key-recording", requires_api_key=True)
+
+
+def test_config_is_immutable():
+    config = Config(api_key="sk-one")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.api_key = "sk-two"
+    assert config.replace(api_key="sk-two").api_key == "sk-two" and config.api_key == "sk-one"
+    assert "sk-one" not in repr(config), "Test Config leaked the API key"
+
+    previous = get_config()
+    try:
+        assert configure(text_model="gpt-4").text_model == "gpt-4" and get_config().text_model == "gpt-4"
+    finally:
+        configure(**dataclasses.asdict(previous))
+
+
+def test_clients_send_their_own_keys():
+    backend = key_recording_backend()
+    clients = [
+        Client(api_key=f"sk-{index}", api_base=f"https://tenant-{index}.example/v1", text_model="gpt-3.5-turbo")
+        for index in range(8)
+    ]
+
+    def run(client):
+        for _ in range(5):
+            client.text_completion("Hello", backend=backend, ledger=False)
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(backend.requests) == 40
+    # Every request went out with its own client's key and endpoint
+    for sent in backend.requests:
+        assert sent["api_base"] == f"https://tenant-{sent['api_key'][3:]}.example/v1"
+        assert sent["request"]["model"] == "gpt-3.5-turbo"
+
+    # Arguments passed to a call override the client's settings
+    Client(api_key="sk-a").text_completion("Hello", api_key="sk-b", backend=backend, ledger=False)
+    assert backend.requests[-1]["api_key"] == "sk-b"
+
+
+def test_client_long_text_model():
+    backend = key_recording_backend()
+    client = Client(api_key="sk-long", text_model="gpt-3.5-turbo", long_text_model="tenant-long-model", chunk_length=8)
+    client.text_completion("Hello", backend=backend, ledger=False)
+    assert backend.requests[-1]["request"]["model"] == "gpt-3.5-turbo"
+    # A prompt longer than chunk_length switches to this client's long text model, not the default Config's
+    client.text_completion("Hello there, this message is long enough to need the long model", backend=backend, ledger=False)
+    assert backend.requests[-1]["request"]["model"] == "tenant-long-model", "Test Client long_text_model was not used"
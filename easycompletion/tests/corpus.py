@@ -0,0 +1,24 @@
+from easycompletion.corpus import prepare_corpus, open_corpus
+from easycompletion.prompt import count_tokens
+
+corpus_documents = [
+    "The first sentence is here. The second sentence follows it.\n\nA new paragraph starts now. It ends here.",
+    "",
+    "Short document.",
+] * 4
+
+
+def test_prepare_corpus(tmp_path):
+    in_process = prepare_corpus(corpus_documents, chunk_length=8, processes=0)
+    result = prepare_corpus(corpus_documents, str(tmp_path), chunk_length=8, processes=2, shard_size=2)
+    assert result["error"] is None and result["documents"] == len(corpus_documents)
+    assert list(result["token_counts"]) == list(in_process["token_counts"]), "Test prepare_corpus workers disagree"
+    assert result["token_counts"][0] == count_tokens(corpus_documents[0])
+    boundaries = list(result["chunks"][0])
+    assert boundaries[0] == 0 and boundaries[-1] == result["token_counts"][0]
+    assert all(0 < end - start <= 8 for start, end in zip(boundaries, boundaries[1:]))
+
+    corpus = open_corpus(str(tmp_path))
+    assert len(corpus) == len(corpus_documents)
+    assert corpus.decode(corpus.document(0)) == corpus_documents[0], "Test open_corpus failed"
+    assert corpus.decode(next(corpus.chunks())) == "The first sentence is here."
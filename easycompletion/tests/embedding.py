@@ -0,0 +1,48 @@
+import openai
+
+from easycompletion.embedding import embed, EmbeddingCache
+
+
+def fake_embedding_create(calls):
+    def create(model, input, **kwargs):
+        calls.append(list(input))
+        return {
+            "data": [
+                {"index": i, "embedding": [float(len(text)), 1.0, 0.0]}
+                for i, text in enumerate(input)
+            ],
+            "usage": {"prompt_tokens": len(input), "total_tokens": len(input)},
+        }
+
+    return create
+
+
+def test_embed_batches_and_caches(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(openai.Embedding, "create", fake_embedding_create(calls))
+    cache = EmbeddingCache(str(tmp_path))
+
+    response = embed(["a", "bb", "a", "ccc"], cache=cache, batch_size=2)
+    assert response["error"] is None, "Test embed failed"
+    assert response["embeddings"].shape == (4, 3), "Test embed failed"
+    assert calls == [["a", "bb"], ["ccc"]], "Inputs were not deduplicated and batched"
+    assert response["embeddings"][2][0] == 1.0, "Test embed failed"
+
+    response = embed(["ccc", "a"], cache=EmbeddingCache(str(tmp_path)))
+    assert len(calls) == 2, "Cached inputs were embedded again"
+    assert response["cached"] == 2, "Test embed failed"
+    assert response["embeddings"][0][0] == 3.0, "Test embed failed"
+
+
+def test_embedding_cache_partial_row(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(["a"], [[1.0, 2.0, 3.0]])
+    # A crash in the middle of an append leaves part of a vector at the end of the file
+    with open(cache.vectors_path, "ab") as f:
+        f.write(b"\x00" * 6)
+
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(["b"], [[4.0, 5.0, 6.0]])
+    vectors = EmbeddingCache(str(tmp_path)).get_many(["a", "b"])
+    assert list(vectors["a"]) == [1.0, 2.0, 3.0], "Test partial row failed"
+    assert list(vectors["b"]) == [4.0, 5.0, 6.0], "Rows after a partial row were shifted"
@@ -0,0 +1,176 @@
+import enum
+import typing
+import dataclasses
+
+from easycompletion.functions import FunctionRegistry, function_schema
+from easycompletion.model import function_completion_steps
+from easycompletion.prefix import canonical_functions
+from easycompletion.tests.scripted import chat_response
+
+
+class Priority(enum.Enum):
+    LOW = "low"
+    HIGH = "high"
+
+
+@dataclasses.dataclass
+class Attendee:
+    name: str
+    email: typing.Optional[str] = None
+
+
+def create_event(title: str, attendees: typing.List[Attendee], priority: Priority, duration_minutes: int = 30):
+    """
+    Create a calendar event.
+
+    Args:
+        title: The title of the event.
+        attendees: Everyone who is invited.
+    """
+    return title, attendees, priority, duration_minutes
+
+
+class Sentiment(typing.TypedDict):
+    """Classify the sentiment of the text."""
+
+    label: typing.Literal["positive", "negative"]
+    confidence: float
+
+
+def test_function_schema():
+    schema = function_schema(create_event)
+    assert schema["name"] == "create_event" and schema["description"] == "Create a calendar event."
+    parameters = schema["parameters"]
+    assert parameters["required"] == ["title", "attendees", "priority"]
+    assert parameters["properties"]["title"] == {"type": "string", "description": "The title of the event."}
+    assert parameters["properties"]["priority"] == {"type": "string", "enum": ["low", "high"]}
+    attendee = parameters["properties"]["attendees"]["items"]
+    assert attendee["required"] == ["name"] and attendee["properties"]["email"] == {"type": ["string", "null"]}
+
+    schema = function_schema(Sentiment, name="classify")
+    assert schema["name"] == "classify" and schema["description"] == "Classify the sentiment of the text."
+    assert schema["parameters"]["properties"]["label"] == {"type": "string", "enum": ["positive", "negative"]}
+
+
+def test_function_registry_dispatch():
+    registry = FunctionRegistry()
+    registry.register(create_event)
+    registry.register(Sentiment)
+    assert list(registry) == ["Sentiment", "create_event"] and registry.token_count() > 0
+    assert canonical_functions(registry.functions) is registry.functions
+
+    assert registry.validate("create_event", {"title": "Standup", "attendees": [], "priority": "urgent"}) is not None
+    assert registry.validate("create_event", {"title": "Standup", "attendees": [{}], "priority": "low"}) is not None
+    assert registry.validate("Sentiment", {"label": "positive", "confidence": 1}) is None
+    # Optional arguments may be null
+    attendees = [{"name": "Ada", "email": None}]
+    assert registry.validate("create_event", {"title": "Standup", "attendees": attendees, "priority": "low"}) is None
+
+    result = {
+        "error": None,
+        "function_calls": [
+            {
+                "id": None,
+                "function_name": "create_event",
+                "arguments": {"title": "Standup", "attendees": [{"name": "Ada"}], "priority": "high"},
+            },
+            {"id": None, "function_name": "Sentiment", "arguments": {"label": "negative", "confidence": 0.5}},
+        ],
+    }
+    dispatched = registry.dispatch(result)
+    assert dispatched["error"] is None
+    assert dispatched["results"][0] == ("Standup", [Attendee(name="Ada")], Priority.HIGH, 30)
+    assert dispatched["results"][1] == {"label": "negative", "confidence": 0.5}
+
+
+def test_function_registry_extra_properties():
+    registry = FunctionRegistry()
+    registry.register(create_event)
+    registry.add({"name": "ping", "parameters": {"type": "object", "properties": {"host": {"type": "string"}}}},
+                 handler=lambda host: host)
+    registry.add({"name": "strict", "parameters": {"type": "object", "properties": {}, "additionalProperties": False}})
+    assert registry.validate("strict", {"extra": 1}) == "Unexpected properties: extra"
+
+    # Arguments the model made up are dropped, at the top level and in nested dataclasses
+    result = {
+        "error": None,
+        "function_calls": [
+            {
+                "id": None,
+                "function_name": "create_event",
+                "arguments": {
+                    "title": "Standup",
+                    "attendees": [{"name": "Ada", "phone": "555"}],
+                    "priority": "low",
+                    "location": "Room 1",
+                },
+            },
+            {"id": None, "function_name": "ping", "arguments": {"host": "example.com", "port": 80}},
+        ],
+    }
+    dispatched = registry.dispatch(result)
+    assert dispatched["error"] is None
+    assert dispatched["results"] == [("Standup", [Attendee(name="Ada")], Priority.LOW, 30), "example.com"]
+
+
+def test_function_completion_with_registry():
+    registry = FunctionRegistry()
+    registry.register(create_event)
+    steps = function_completion_steps("Schedule a standup", functions=registry, api_key="test")
+    step, request = next(steps)
+    assert request["functions"] is registry.functions and request["function_call"] == {"name": "create_event"}
+
+    arguments = {"title": "Standup", "attendees": [{"name": "Ada"}], "priority": "low"}
+    response = chat_response(function_name="create_event", arguments=arguments)
+    try:
+        steps.send((response, None))
+    except StopIteration as stop:
+        result = stop.value
+    assert result["arguments"] == arguments
+    assert registry.dispatch(result)["results"][0][0] == "Standup"
+
+
+def test_function_completion_with_registry_validators():
+    registry = FunctionRegistry()
+    registry.register(create_event)
+    steps = function_completion_steps(
+        "Schedule a standup", functions=registry, api_key="test", function_failure_retries=2, repair_turns=1
+    )
+
+    def response(arguments):
+        return chat_response(function_name="create_event", arguments=arguments)
+
+    next(steps)
+    # The required keys are there, but the registry's validator rejects the argument type
+    step, request = steps.send((response({"title": "Standup", "attendees": "Ada", "priority": "low"}), None))
+    assert step == "request", "An invalid argument type was not sent back for correction"
+    assert "attendees must be of type array" in request["messages"][-1]["content"]
+    arguments = {"title": "Standup", "attendees": [{"name": "Ada"}], "priority": "low"}
+    try:
+        steps.send((response(arguments), None))
+    except StopIteration as stop:
+        result = stop.value
+    assert result["error"] is None and result["arguments"] == arguments
+
+
+def test_function_registry_select():
+    registry = FunctionRegistry()
+    registry.register(create_event)
+    registry.register(Sentiment)
+    registry.add({"name": "get_weather", "description": "Get the weather forecast for a city.",
+                  "parameters": {"type": "object", "properties": {"city": {"type": "string"}}, "required": ["city"]}})
+    registry.add({"name": "send_email", "description": "Send an email message to a recipient.",
+                  "parameters": {"type": "object", "properties": {"recipient": {"type": "string"}}, "required": []}})
+
+    selected = registry.select("What's the weather like in Paris?", k=1)
+    assert [function["name"] for function in selected] == ["get_weather"]
+    selected = registry.select("Email the attendees about the event", k=2, include=["Sentiment"])
+    assert [function["name"] for function in selected] == ["Sentiment", "create_event", "send_email"]
+    # Nothing matches, so nothing is left out
+    assert len(registry.select("zzz", k=1)) == 4
+
+    steps = function_completion_steps("Will it rain in Paris tomorrow? Check the weather.", functions=registry,
+                                      top_k_functions=1, api_key="test")
+    step, request = next(steps)
+    assert [function["name"] for function in request["functions"]] == ["get_weather"]
+    assert request["function_call"] == {"name": "get_weather"}
@@ -0,0 +1,55 @@
+from easycompletion.ledger import UsageLedger, estimate_cost
+from easycompletion.model import function_completion, text_completion
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
+
+
+def test_estimate_cost():
+    assert estimate_cost("gpt-4-0613", 1000, 1000) == 0.09, "Test estimate_cost failed"
+    assert estimate_cost("unknown-model", 1000) == 0.0, "Test estimate_cost failed"
+
+
+def test_ledger_records_and_enforces_budgets():
+    ledger = UsageLedger()
+    usage = {"prompt_tokens": 1000, "completion_tokens": 1000}
+    ledger.record("gpt-4", usage, api_key="sk-test", tag="search")
+    ledger.record("gpt-4", usage, api_key="sk-test", tag="search", retry=True)
+
+    summary = ledger.summary("tag")["search"]
+    assert summary["requests"] == 2 and summary["retry_tokens"] == 2000
+    assert round(ledger.summary()[None]["cost"], 2) == 0.18
+
+    ledger.set_budget(0.1, dimension="model", value="gpt-4", action="downgrade", downgrade_model="gpt-3.5-turbo")
+    assert ledger.check("gpt-4") == ("gpt-3.5-turbo", None), "Test ledger did not downgrade"
+
+    ledger.set_budget(0.1, dimension="tag")
+    model, error = ledger.check("gpt-4", tag="search")
+    assert error is not None, "Test ledger did not stop the request"
+    assert ledger.check("gpt-3.5-turbo", tag="other") == ("gpt-3.5-turbo", None)
+
+
+def test_ledger_retry_tokens():
+    classify = {
+        "name": "classify",
+        "parameters": {"type": "object", "properties": {"label": {"type": "string"}}, "required": ["label"]},
+    }
+    ledger = UsageLedger()
+    # An invalid call, a correction turn that is invalid too, then a resend of the original request
+    backend = ScriptedBackend(
+        [
+            chat_response(function_name="classify", arguments={}),
+            chat_response(function_name="classify", arguments={}),
+            chat_response(function_name="classify", arguments={"label": "a"}),
+        ]
+    )
+    result = function_completion(
+        "Classify this", functions=[classify], repair=False, repair_turns=1, function_failure_retries=3,
+        backend=backend, ledger=ledger, metrics=False)
+    assert result["arguments"] == {"label": "a"}
+    summary = ledger.summary()[None]
+    assert summary["requests"] == 3 and summary["retry_tokens"] == 15, "Only the resend is a retry"
+
+    # Continuations are new work, not retries
+    ledger = UsageLedger()
+    backend = ScriptedBackend([chat_response("1 2", finish_reason="length"), chat_response(" 3")])
+    text_completion("Count", max_tokens=2, continuations=1, backend=backend, ledger=ledger, metrics=False)
+    assert ledger.summary()[None]["retry_tokens"] == 0, "Test continuation was counted as a retry"
@@ -0,0 +1,73 @@
+import threading
+
+from easycompletion.metrics import LatencyHistogram, LatencyMetrics, bucket_index, bucket_upper_bound
+from easycompletion.model import text_completion
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
+
+
+def test_histogram_buckets():
+    # Small values have a bucket each, larger ones share buckets within 1.6% of their value
+    for value in list(range(300)) + [1000, 12345, 10**6, 60 * 10**6, 2**40 + 7]:
+        upper = bucket_upper_bound(bucket_index(value))
+        assert value <= upper <= value * 1.016 + 1
+        assert bucket_index(upper) == bucket_index(value)
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for millisecond in range(1, 1001):
+        histogram.record(millisecond / 1000)
+    assert histogram.count == 1000
+    assert abs(histogram.percentile(50) - 0.5) < 0.5 * 0.02
+    assert abs(histogram.percentile(99) - 0.99) < 0.99 * 0.02
+    assert histogram.percentile(100) == 1.0
+    summary = histogram.summary()
+    assert summary["min"] == 0.001 and summary["max"] == 1.0
+    assert abs(summary["mean"] - 0.5005) < 1e-9
+
+
+def test_metrics_slo_and_prometheus():
+    metrics = LatencyMetrics()
+    for _ in range(98):
+        metrics.record("total", 0.2, "gpt-3.5-turbo", "openai")
+    metrics.record("total", 3.0, "gpt-3.5-turbo", "openai")
+    metrics.record("total", 4.0, "gpt-4", "openai")
+
+    slo = metrics.slo(1.0, target=0.99)
+    assert slo == {"count": 100, "within": 98, "ratio": 0.98, "met": False}
+    assert metrics.slo(1.0, target=0.98, model="gpt-3.5-turbo")["met"]
+    assert metrics.histogram("total", model="gpt-4").count == 1
+
+    text = metrics.prometheus()
+    assert "# TYPE easycompletion_latency_seconds histogram" in text
+    labels = 'phase="total",model="gpt-3.5-turbo",backend="openai"'
+    assert f'easycompletion_latency_seconds_bucket{{{labels},le="0.25"}} 98' in text
+    assert f'easycompletion_latency_seconds_bucket{{{labels},le="+Inf"}} 99' in text
+    assert f"easycompletion_latency_seconds_count{{{labels}}} 99" in text
+
+    metrics.reset()
+    assert metrics.summary() == {}
+
+
+def test_metrics_threads():
+    metrics = LatencyMetrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.record("network", 0.01, "gpt-3.5-turbo", "openai")
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.histogram("network").count == 8000
+
+
+def test_text_completion_metrics():
+    metrics = LatencyMetrics()
+    result = text_completion("Hi", model="gpt-3.5-turbo", backend=ScriptedBackend([chat_response("Hello")], name="fixed"), ledger=False, metrics=metrics)
+    assert result["error"] is None
+    summary = metrics.summary()
+    for phase in ("prepare", "queue", "network", "validation", "total"):
+        assert summary[(phase, "gpt-3.5-turbo", "fixed")]["count"] == 1
@@ -1,11 +1,19 @@
+from easycompletion.concurrency import AdaptiveLimiter
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
 from easycompletion.model import (
     chat_completion,
     parse_arguments,
+    validate_function_calls,
+    repair_arguments,
+    text_completion_steps,
     function_completion,
     function_completion_async,
     text_completion,
     text_completion_async,
+    send_chat_request,
+    send_chat_request_async,
 )
+import time
 import pytest
 
 
@@ -14,6 +22,116 @@ def test_parse_arguments():
     expected_output = {"key1": "value1", "key2": 2}
     assert parse_arguments(test_input) == expected_output, "Test parse_arguments failed"
 
+def test_validate_function_calls():
+    functions_by_name = {
+        "get_weather": {
+            "name": "get_weather",
+            "parameters": {
+                "type": "object",
+                "properties": {"city": {"type": "string"}},
+                "required": ["city"],
+            },
+        }
+    }
+    response = {
+        "choices": [
+            {
+                "message": {
+                    "content": None,
+                    "tool_calls": [
+                        {"id": "1", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+                        {"id": "2", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Rome"}'}},
+                    ],
+                }
+            }
+        ]
+    }
+    calls, error = validate_function_calls(response, functions_by_name, "auto")
+    assert error is None, "Test validate_function_calls failed"
+    assert [call["arguments"]["city"] for call in calls] == ["Paris", "Rome"]
+
+    response["choices"][0]["message"]["tool_calls"][1]["function"]["arguments"] = "{}"
+    calls, error = validate_function_calls(response, functions_by_name, "auto")
+    assert calls is None and "city" in error, "Test validate_function_calls failed"
+
+
+def test_repair_arguments():
+    function = {
+        "name": "count_items",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "item_count": {"type": "integer"},
+                "items": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["item_count", "items"],
+        },
+    }
+    repaired = repair_arguments('```json\n{"Item-Count": "2", "items": ["a", "b",', function)
+    assert repaired == {"item_count": 2, "items": ["a", "b"]}, "Test repair_arguments failed"
+
+
+def test_text_completion_steps():
+    steps = text_completion_steps("Hello, how are you?", api_key="test")
+    step, request = next(steps)
+    assert step == "request", "Test text_completion_steps failed"
+    assert request["messages"] == [{"role": "user", "content": "Hello, how are you?"}]
+
+    response = {
+        "choices": [{"message": {"content": "Fine"}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 13},
+    }
+    with pytest.raises(StopIteration) as stop:
+        steps.send((response, None))
+    assert stop.value.value["text"] == "Fine", "Test text_completion_steps failed"
+
+
+def test_text_completion_continuation():
+    steps = text_completion_steps("Count to ten.", api_key="test", max_tokens=5, stop=["11"], continuations=1)
+    step, request = next(steps)
+    assert request["max_tokens"] == 5 and request["stop"] == ["11"], "Test max_tokens and stop failed"
+
+    response = chat_response("1 2 3 4 5", finish_reason="length", prompt_tokens=12)
+    step, request = steps.send((response, None))
+    assert request["messages"][1] == {"role": "assistant", "content": "1 2 3 4 5"}, "Test continuation failed"
+
+    response = chat_response(" 6 7 8 9 10", prompt_tokens=30)
+    with pytest.raises(StopIteration) as stop:
+        steps.send((response, None))
+    result = stop.value.value
+    assert result["text"] == "1 2 3 4 5 6 7 8 9 10" and result["finish_reason"] == "stop"
+    assert result["usage"]["completion_tokens"] == 10, "Test continuation usage failed"
+
+
+def slow_backend():
+    # Sync requests time out at once, async ones take long enough to be cut off
+    return ScriptedBackend([TimeoutError("Request timed out")], name="slow", delay=10)
+
+
+@pytest.mark.asyncio
+async def test_send_chat_request_deadline():
+    request = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "Hi"}]}
+    backend = slow_backend()
+    start = time.monotonic()
+    response, error = await send_chat_request_async(request, backend=backend, deadline=start + 0.1, metrics=False)
+    assert response is None and "Deadline" in error["error"], "Test deadline error failed"
+    assert time.monotonic() - start < 1, "Test request was not cut off at the deadline"
+    assert backend.cancelled == 1 and len(backend.timeouts) == 1, "Test request was retried past the deadline"
+    assert 0 < backend.timeouts[0] <= 0.1
+
+    # Hitting this caller's deadline does not throttle everyone else sharing the limiter
+    limiter = AdaptiveLimiter(initial_limit=4)
+    await send_chat_request_async(request, backend=backend, limiter=limiter, deadline=time.monotonic() + 0.05, metrics=False)
+    assert limiter.stats()["limit"] == 4 and limiter.stats()["errors"] == 0, "Test deadline was counted as overload"
+
+    # Sync requests pass the time left to the backend, and are not sent once it is gone
+    response, error = send_chat_request(request, backend=backend, deadline=time.monotonic() + 0.1, metrics=False)
+    assert response is None and backend.timeouts[-1] <= 0.1
+    sent = len(backend.timeouts)
+    response, error = send_chat_request(request, backend=backend, deadline=time.monotonic() - 1, metrics=False)
+    assert "Deadline" in error["error"] and len(backend.timeouts) == sent
+
+
 @pytest.mark.asyncio
 async def test_text_completion_async():
     response = await text_completion_async("Hello, how are you?")
@@ -93,6 +211,16 @@ def test_function_completion():
     assert prompt_tokens == 76, "Prompt tokens was not expected count"
 
 
+def test_function_completion_timeout():
+    # Without a timeout, 10 attempts with 1 second between them would take 9 seconds
+    start = time.monotonic()
+    response = function_completion(
+        "Write a song about AI", functions={"name": "write_song", "parameters": {"type": "object"}},
+        backend=slow_backend(), timeout=0.5, ledger=False)
+    assert "Deadline" in response["error"], "Test function_completion timeout failed"
+    assert time.monotonic() - start < 1.5, "Test function_completion ran past its timeout"
+
+
 def test_chat_completion():
     response = chat_completion(
         messages=[
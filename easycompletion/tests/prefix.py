@@ -0,0 +1,44 @@
+import json
+
+from easycompletion import prefix
+from easycompletion.model import build_chat_request
+from easycompletion.prefix import canonical_functions, describe_prefix
+
+
+def test_canonical_functions():
+    first = {"name": "b", "parameters": {"type": "object", "properties": {"y": {"type": "string"}, "x": {"type": "number"}}}}
+    second = {"parameters": {"properties": {"x": {"type": "number"}, "y": {"type": "string"}}, "type": "object"}, "name": "b"}
+    other = {"name": "a", "parameters": {"type": "object", "properties": {}}}
+    assert json.dumps(canonical_functions([first, other])) == json.dumps(canonical_functions([other, second]))
+    assert [function["name"] for function in canonical_functions([first, other])] == ["a", "b"]
+
+
+def test_canonical_functions_cached(monkeypatch):
+    functions = [{"name": "f", "parameters": {"type": "object", "properties": {"x": {"type": "string"}}}}]
+    canonical = canonical_functions(functions)
+    # The same functions are not serialized again, even wrapped in a new list
+    dumps = []
+    monkeypatch.setattr(prefix.json, "dumps", lambda *args, **kwargs: dumps.append(args) or "[]")
+    assert canonical_functions(functions) is canonical and canonical_functions(list(functions)) is canonical
+    assert not dumps, "Test canonical functions were serialized again"
+    monkeypatch.undo()
+
+    # Functions changed in place are compiled again
+    functions[0]["parameters"]["properties"]["y"] = {"type": "number"}
+    assert list(canonical_functions(functions)[0]["parameters"]["properties"]) == ["x", "y"]
+
+
+def test_describe_prefix():
+    messages = [{"role": "system", "content": "You are terse."}, {"role": "user", "content": "Hi"}]
+    functions = [{"name": "f", "parameters": {"type": "object", "properties": {}}}]
+    request = build_chat_request(messages, "gpt-3.5-turbo", 0.0, functions, {"name": "f"})
+    response = {"usage": {"prompt_tokens": 100, "prompt_tokens_details": {"cached_tokens": 80}}}
+    prefix = describe_prefix(request, response)
+    assert prefix["cached_tokens"] == 80 and prefix["cached_ratio"] == 0.8
+    assert prefix["tokens"] > 0
+
+    # A different user message keeps the prefix, a different system message does not
+    messages = messages[:1] + [{"role": "user", "content": "Hello there"}]
+    assert describe_prefix(build_chat_request(messages, "gpt-3.5-turbo", 0.0, functions, {"name": "f"}), {})["hash"] == prefix["hash"]
+    messages = [{"role": "system", "content": "You are verbose."}] + messages[1:]
+    assert describe_prefix(build_chat_request(messages, "gpt-3.5-turbo", 0.0, functions, {"name": "f"}), {})["hash"] != prefix["hash"]
@@ -1,7 +1,10 @@
+from easycompletion.constants import DEFAULT_CHUNK_LENGTH
 from easycompletion.model import parse_arguments
 from easycompletion.prompt import (
     compose_prompt,
+    compile_prompt,
     trim_prompt,
+    trim_segments,
     chunk_prompt,
     count_tokens,
     get_tokens,
@@ -12,7 +15,18 @@ from easycompletion.prompt import (
 def test_chunk_prompt():
     test_text = "Write a song about AI"
     chunks = chunk_prompt(test_text, chunk_length=2)
-    assert len(chunks) == 2, "Test chunk_prompt failed"
+    assert len(chunks) == 3, "Test chunk_prompt failed"
+
+    test_text = "The first sentence is short. Dr. Smith wrote the second one.\n\nA new paragraph."
+    chunks = chunk_prompt(test_text, chunk_length=16)
+    assert chunks[0] == "The first sentence is short. Dr. Smith wrote the second one.", "Test chunk_prompt boundaries failed"
+
+    # A sentence longer than the default chunk length is split between tokens
+    test_text = "word " * 8000
+    chunks = chunk_prompt(test_text)
+    assert len(chunks) == 3, "Test chunk_prompt default chunk length failed"
+    assert all(count_tokens(chunk) <= DEFAULT_CHUNK_LENGTH for chunk in chunks), "Test chunk_prompt failed"
+    assert trim_prompt(test_text, 100.0).count("word") == 100, "Test trim_prompt float max_tokens failed"
 
 
 def test_trim_prompt_and_get_tokens():
@@ -25,6 +39,24 @@ def test_trim_prompt_and_get_tokens():
     assert len(tokens) == 5, "Test get_tokens failed"
 
 
+def test_trim_prompt_modes():
+    test_text = "First paragraph is here. It has two sentences.\n\nSecond paragraph starts. It goes on for a while longer.\n\nThird one."
+    top = trim_prompt(test_text, max_tokens=14)
+    assert top == "First paragraph is here. It has two sentences.", "Test trim_prompt top failed"
+    bottom = trim_prompt(test_text, max_tokens=14, mode="bottom")
+    assert bottom.endswith("Third one.") and count_tokens(bottom) <= 14, "Test trim_prompt bottom failed"
+    middle = trim_prompt(test_text, max_tokens=20, mode="middle", tokens=get_tokens(test_text))
+    assert middle.startswith("First paragraph") and middle.endswith("Third one.") and "\n...\n" in middle
+    assert count_tokens(middle) <= 20, "Test trim_prompt middle failed"
+
+
+def test_trim_segments():
+    segments = ["one two three four five six seven eight", "short", "alpha beta gamma delta epsilon zeta eta theta"]
+    trimmed = trim_segments(segments, max_tokens=10, budgets=[4, None, None])
+    assert trimmed[0] == "one two three four" and trimmed[1] == "short", "Test trim_segments failed"
+    assert sum(count_tokens(segment) for segment in trimmed) <= 10
+
+
 def test_parse_arguments():
     test_input = '{"key1": "value1", "key2": 2}'
     expected_output = {"key1": "value1", "key2": 2}
@@ -38,6 +70,36 @@ def test_compose_prompt():
     assert prompt == "I am a towel", "Test compose_prompt failed"
 
 
+def test_compose_prompt_values():
+    test_prompt = "{{greeting}} {{names}}{{count}} {{missing}}"
+    prompt = compose_prompt(
+        test_prompt, {"greeting": "Hi", "names": ["a", "b"], "count": 2, "unused": None}
+    )
+    assert prompt == "Hi a\nb\n2 {{missing}}", "Test compose_prompt_values failed"
+
+
+def test_compile_prompt():
+    template = compile_prompt("I am a {{object}}, a {{object}}")
+    assert template is compile_prompt("I am a {{object}}, a {{object}}")
+    assert template.placeholders == ["object"]
+    assert template.render({"object": "towel"}) == "I am a towel, a towel"
+    assert template.missing_keys({}) == ["object"]
+    assert template.unused_keys({"object": "towel", "other": "x"}) == ["other"]
+
+
+def test_compose_prompt_budget():
+    test_prompt = "Summarize this text:\n{{text}}\nFocus on {{topic}}"
+    text = " ".join(["The towel is important."] * 50)
+    prompt = compose_prompt(
+        test_prompt,
+        {"text": text, "topic": "towels"},
+        max_tokens=40,
+        slots={"topic": {"priority": 1}},
+    )
+    assert count_tokens(prompt) <= 40, "Test compose_prompt_budget failed"
+    assert prompt.endswith("Focus on towels"), "Test compose_prompt_budget failed"
+
+
 def test_compose_function():
     summarization_function = {
         "name": "summarize_text",
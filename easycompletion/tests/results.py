@@ -0,0 +1,25 @@
+import json
+
+from easycompletion.results import CompletionResult, FunctionCallResult, Usage
+
+
+def test_result_dict_access():
+    usage = Usage.from_response({"prompt_tokens": 13, "completion_tokens": 2, "total_tokens": 15})
+    result = CompletionResult(text="Hi", usage=usage, finish_reason="stop", error=None)
+    assert result["text"] == "Hi" and result["usage"]["prompt_tokens"] == 13
+    assert result.get("missing", "default") == "default"
+    assert "raw" not in result and "text" in result
+    assert result == {
+        "text": "Hi",
+        "usage": {"prompt_tokens": 13, "completion_tokens": 2, "total_tokens": 15},
+        "finish_reason": "stop",
+        "error": None,
+    }, "Test result_dict_access failed"
+    assert json.loads(json.dumps(result.to_dict()))["usage"]["total_tokens"] == 15
+    assert not hasattr(result, "__dict__"), "Results should not have a per-instance dict"
+
+
+def test_function_call_result_error():
+    result = FunctionCallResult(error="functions is required")
+    assert result["error"] == "functions is required"
+    assert result["function_name"] is None
@@ -0,0 +1,88 @@
+import time
+import threading
+import pytest
+
+from easycompletion.model import send_chat_request
+from easycompletion.scheduler import Scheduler, RequestRejected
+from easycompletion.tests.scripted import ScriptedBackend, chat_response
+
+
+def test_scheduler_priority_and_fairness():
+    scheduler = Scheduler(max_concurrency=1)
+    order = []
+    scheduler.acquire()  # occupy the only slot
+
+    def request(name, priority, tenant):
+        with scheduler.slot(priority, tenant):
+            order.append(name)
+
+    threads = []
+    for name, priority, tenant in [
+        ("batch", "batch", "a"),
+        ("a1", "default", "a"),
+        ("a2", "default", "a"),
+        ("b1", "default", "b"),
+        ("interactive", "interactive", "c"),
+    ]:
+        thread = threading.Thread(target=request, args=(name, priority, tenant))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)  # queue in a known order
+
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    assert order == ["interactive", "a1", "b1", "a2", "batch"], "Test scheduler failed"
+
+
+def test_scheduler_sheds_and_expires():
+    scheduler = Scheduler(max_concurrency=1, max_queue_depth=1)
+    scheduler.acquire()
+
+    with pytest.raises(RequestRejected):
+        scheduler.acquire(deadline=time.monotonic() + 0.05)
+
+    rejected = []
+
+    def batch_request():
+        try:
+            scheduler.acquire("batch")
+        except RequestRejected as e:
+            rejected.append(str(e))
+
+    thread = threading.Thread(target=batch_request)
+    thread.start()
+    time.sleep(0.02)
+    # A higher priority request displaces the queued batch request
+    with pytest.raises(RequestRejected):
+        scheduler.acquire("interactive", deadline=time.monotonic() + 0.05)
+    thread.join()
+    assert rejected and "shed" in rejected[0], "Test scheduler did not shed"
+    assert scheduler.stats()["expired"] == 2, "Test scheduler failed"
+
+
+def test_scheduler_rejects_unknown_priority():
+    scheduler = Scheduler(max_concurrency=1)
+    for priority in ["interactiv", None, 1.5, True]:
+        with pytest.raises(ValueError):
+            scheduler.acquire(priority)
+        with pytest.raises(ValueError):
+            scheduler.slot(priority)
+
+    # A bad priority must not reach the queue, where it would break ordering for everyone else
+    scheduler.acquire()
+    with pytest.raises(ValueError):
+        scheduler.acquire("bulk")
+    with pytest.raises(RequestRejected):
+        scheduler.acquire(5, deadline=time.monotonic() + 0.02)
+    assert scheduler.stats()["queued"] == {5: 0}, "Test scheduler priority failed"
+
+
+def test_send_chat_request_unknown_priority():
+    backend = ScriptedBackend([chat_response("ok")])
+    request = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "Hi"}]}
+    response, error = send_chat_request(
+        request, scheduler=Scheduler(), priority="interactiv", backend=backend, metrics=False
+    )
+    assert response is None and "Unknown priority" in error["error"], "Test unknown priority was not reported"
+    assert not backend.requests
@@ -0,0 +1,74 @@
+import json
+import asyncio
+
+
+def chat_response(content=None, function_name=None, arguments=None, finish_reason=None, prompt_tokens=10, completion_tokens=5):
+    """
+    Builds a chat completion response, with a function call if function_name is set.
+
+    arguments may be a dictionary, or a string to send invalid JSON.
+    """
+    message = {"role": "assistant", "content": content}
+    if function_name is not None:
+        if not isinstance(arguments, str):
+            arguments = json.dumps(arguments or {})
+        message["function_call"] = {"name": function_name, "arguments": arguments}
+    return {
+        "choices": [
+            {"message": message, "finish_reason": finish_reason or ("function_call" if function_name else "stop")}
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class ScriptedBackend:
+    """
+    A backend that answers from a script and records every request it was sent.
+
+    Args:
+        responses: Responses returned in order, the last one repeating, or a function
+            that takes the request and returns its response. Exceptions are raised.
+        name (str): The backend name, used in metrics.
+        requires_api_key (bool): Whether completions check for an API key.
+        delay (float): Seconds acreate waits before answering, so requests can be cut off.
+    """
+
+    def __init__(self, responses=(), name="scripted", requires_api_key=False, delay=0):
+        self.responses = responses if callable(responses) else list(responses)
+        self.name = name
+        self.requires_api_key = requires_api_key
+        self.delay = delay
+        # A dictionary with "request", "api_key", "api_base" and "timeout" for every request sent
+        self.requests = []
+        self.cancelled = 0
+
+    def respond(self, request):
+        if callable(self.responses):
+            response = self.responses(request)
+        else:
+            response = self.responses[min(len(self.requests), len(self.responses)) - 1]
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    def create(self, request, api_key=None, api_base=None, timeout=None):
+        self.requests.append({"request": request, "api_key": api_key, "api_base": api_base, "timeout": timeout})
+        return self.respond(request)
+
+    async def acreate(self, request, api_key=None, api_base=None, timeout=None):
+        self.requests.append({"request": request, "api_key": api_key, "api_base": api_base, "timeout": timeout})
+        if self.delay:
+            try:
+                await asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        return self.respond(request)
+
+    @property
+    def timeouts(self):
+        return [sent["timeout"] for sent in self.requests]
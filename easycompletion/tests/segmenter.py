@@ -0,0 +1,26 @@
+from easycompletion.segmenter import Segmenter, segment_text, PARAGRAPH, SENTENCE
+
+
+def test_segment_text():
+    text = 'Dr. Smith said "Hi!" He left at 3 p.m. today.\n\nNew paragraph, e.g. this one. 你好。谢谢！'
+    segments = segment_text(text)
+    assert [segment for segment, _ in segments] == [
+        'Dr. Smith said "Hi!"',
+        " He left at 3 p.m. today.",
+        "\n\nNew paragraph, e.g. this one.",
+        " 你好。",
+        "谢谢！",
+    ], "Test segment_text failed"
+    assert segments[1][1] == PARAGRAPH and segments[0][1] == SENTENCE
+    assert "".join(segment for segment, _ in segments) == text
+
+
+def test_segmenter_streaming():
+    text = "One sentence. Another one!\nA line.\n\nA paragraph... and more. U.S. rules apply. 终わり。"
+    expected = segment_text(text)
+    segmenter = Segmenter()
+    segments = []
+    for character in text:
+        segments += segmenter.feed(character)
+    segments += segmenter.flush()
+    assert segments == expected, "Test segmenter streaming failed"
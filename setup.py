@@ -22,6 +22,7 @@ setup(
     license="MIT",
     packages=["easycompletion"],
     install_requires=["openai", "tiktoken", "python-dotenv", "rich"],
+    extras_require={"embeddings": ["numpy"]},
     readme="README.md",
     classifiers=[
         "Development Status :: 3 - Alpha",